@@ -0,0 +1,243 @@
+"""couchdbstub.py
+In-process CouchDB stand-in serving the synthetic DQHL documents of
+synthdata.py as the data-quality database, for the benchmarks.
+
+It answers the requests the couchdb client makes for couchdbtools.py:
+
+    HEAD/GET /data-quality                               database info
+    GET /data-quality/_design/data-quality/_view/runs    run number -> document id,
+        with startkey, endkey, startkey_docid, limit, skip and include_docs
+    GET/POST /data-quality/_all_docs                     by keys, with include_docs
+    GET /data-quality/_changes                           documents added since a
+        sequence number, with include_docs and the longpoll feed
+    GET /data-quality/<id>                               a document
+
+Each request is delayed by a configurable latency, to stand for the
+round trip to the collaboration server. Documents are generated on request;
+add_runs() posts the documents of more runs, as new runs are processed.
+"""
+import json
+import time
+import bisect
+import urllib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+import synthdata
+
+DATABASE = "data-quality"
+VIEW = "_design/data-quality/_view/runs"
+
+class CouchDBStub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """CouchDB stand-in for the runs of a run range.
+    :param: The first and last run numbers (int)
+    :param: The seed of the synthetic documents
+    :param: The latency added to every request (seconds)
+    :param: The (host, port) to listen on, by default a free local port
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, firstrun, lastrun, seed = 0, latency = 0.0, address = ("127.0.0.1", 0)):
+
+        BaseHTTPServer.HTTPServer.__init__(self, address, CouchDBHandler)
+
+        self.seed = seed
+        self.latency = latency
+
+        # Rows of the runs view, sorted by key then document id as CouchDB does
+        self.rows = [(run, docid) for run in xrange(firstrun, lastrun + 1)
+                     for docid in synthdata.dqhl_document_ids(run, seed)]
+
+        # Document ids in the order they were posted, the sequence number of
+        # a document being its position + 1
+        self.posted = [docid for run, docid in self.rows]
+        self.lastrun = lastrun
+        self.changed = threading.Condition()
+
+        self.requests = 0
+
+    def url(self):
+
+        return "http://%s:%i/" % self.server_address
+
+    def start(self):
+        """Serve from a background thread. """
+
+        thread = threading.Thread(target = self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self
+
+    def stop(self):
+
+        self.shutdown()
+        self.server_close()
+
+    def add_runs(self, lastrun):
+        """Post the documents of the runs after the last one, up to lastrun. """
+
+        with self.changed:
+
+            for run in xrange(self.lastrun + 1, lastrun + 1):
+                for docid in synthdata.dqhl_document_ids(run, self.seed):
+                    bisect.insort(self.rows, (run, docid))
+                    self.posted.append(docid)
+
+            self.lastrun = max(self.lastrun, lastrun)
+
+            self.changed.notify_all()
+
+    def document(self, docid):
+
+        return synthdata.dqhl_document(docid, self.seed)
+
+    def view(self, options):
+
+        first = 0
+        last = len(self.rows)
+
+        if 'startkey' in options:
+            first = bisect.bisect_left(self.rows, (options['startkey'], options.get('startkey_docid', '')))
+        if 'endkey' in options:
+            last = max(first, bisect.bisect_right(self.rows, (options['endkey'], u'\uffff')))
+
+        rows = self.rows[first:last]
+        offset = first
+
+        skip = int(options.get('skip', 0))
+        rows = rows[skip:skip + int(options['limit'])] if 'limit' in options else rows[skip:]
+
+        result = []
+
+        for run, docid in rows:
+            row = {'id': docid, 'key': run, 'value': None}
+            if options.get('include_docs'):
+                row['doc'] = self.document(docid)
+            result.append(row)
+
+        return {'total_rows': len(self.rows), 'offset': offset + skip, 'rows': result}
+
+    def all_docs(self, keys, options):
+
+        result = []
+
+        for docid in keys:
+
+            doc = self.document(docid)
+
+            if doc is None:
+                result.append({'key': docid, 'error': 'not_found'})
+                continue
+
+            row = {'id': docid, 'key': docid, 'value': {'rev': doc['_rev']}}
+            if options.get('include_docs'):
+                row['doc'] = doc
+            result.append(row)
+
+        return {'total_rows': len(self.rows), 'offset': 0, 'rows': result}
+
+    def changes(self, options):
+
+        since = int(options.get('since', 0))
+
+        with self.changed:
+
+            # A longpoll feed waits for a change, up to its timeout
+            if options.get('feed') == 'longpoll' and since >= len(self.posted):
+                self.changed.wait(int(options.get('timeout', 60000)) / 1000.0)
+
+            docids = self.posted[since:]
+
+        result = []
+
+        for seq, docid in enumerate(docids, since + 1):
+            doc = self.document(docid)
+            change = {'seq': seq, 'id': docid, 'changes': [{'rev': doc['_rev']}]}
+            if options.get('include_docs'):
+                change['doc'] = doc
+            result.append(change)
+
+        return {'results': result, 'last_seq': since + len(docids)}
+
+def _option(value):
+
+    # View options are JSON values, except the document ids
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+class CouchDBHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep-alive connections, as the couchdb client expects
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+
+        pass
+
+    def reply(self, status, document, body = True):
+
+        text = json.dumps(document)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+
+        if body:
+            self.wfile.write(text)
+
+    def answer(self, body = True):
+
+        self.server.requests += 1
+
+        time.sleep(self.server.latency)
+
+        url = urlparse.urlparse(self.path)
+        path = urllib.unquote(url.path).strip("/")
+
+        options = dict((name, _option(value)) for name, value in urlparse.parse_qsl(url.query))
+
+        keys = None
+
+        if self.command == "POST":
+            length = int(self.headers.getheader("Content-Length") or 0)
+            keys = json.loads(self.rfile.read(length) or "{}").get('keys')
+        elif 'keys' in options:
+            keys = options['keys']
+
+        doc = self.server.document(path[len(DATABASE) + 1:]) if path.startswith(DATABASE + "/") else None
+
+        if path == "":
+            self.reply(200, {'couchdb': 'Welcome', 'version': 'stub'}, body)
+        elif path == DATABASE:
+            self.reply(200, {'db_name': DATABASE, 'doc_count': len(self.server.rows),
+                             'update_seq': len(self.server.posted)}, body)
+        elif path == DATABASE + "/" + VIEW:
+            self.reply(200, self.server.view(options), body)
+        elif path == DATABASE + "/_changes":
+            self.reply(200, self.server.changes(options), body)
+        elif path == DATABASE + "/_all_docs" and keys is not None:
+            self.reply(200, self.server.all_docs(keys, options), body)
+        elif doc is not None:
+            self.reply(200, doc, body)
+        else:
+            self.reply(404, {'error': 'not_found', 'reason': 'missing'}, body)
+
+    def do_HEAD(self):
+
+        self.answer(body = False)
+
+    def do_GET(self):
+
+        self.answer()
+
+    def do_POST(self):
+
+        self.answer()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""dqhlrules.py
+Results and cost of the DQHL rule table (dqhl_criteria.json) against the
+hand-written checks it replaced, on synthetic DQHL documents.
+
+For every document of the run range, the run list row of
+dqhltools.processRunRow() (the rules compiled for one run) and of
+dqhltools.processRunRows() (the columnar path) must equal the row of the
+hand-written checks below, and so must the per-criterion functions of
+dqhlProcChecks.py. The time per run of the single-run path must not be more
+than --max-ratio times that of the hand-written checks.
+
+Example use: 'python benchmarks/dqhlrules.py --runs 5000 --first-run 99000'
+The exit status is 1 if the results or the cost differ.
+"""
+import os
+import sys
+import time
+import argparse
+
+import synthdata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dqhltools
+import dqhlProcChecks
+
+# --- Hand-written checks, as dqhlProcChecks.py had them before the rule table:
+
+def reference(runNumber, data):
+    """Return the hand-written criteria of a run, by name. """
+
+    checks = data['checks']
+    triggerProc, timeProc = checks['dqtriggerproc'], checks['dqtimeproc']
+    runProc, pmtProc = checks['dqrunproc'], checks['dqpmtproc']
+
+    r = {}
+    r['rsMissingGTIDCheckOK'] = int(len(triggerProc['check_params']['missing_gtids']) <= 10)
+    r['rsTriggerProcChecksOK'] = int(triggerProc['n100l_trigger_rate'] == 1 and
+                                     triggerProc['esumh_trigger_rate'] == 1 and
+                                     r['rsMissingGTIDCheckOK'] == 1)
+    bitFlipCount = len(triggerProc['check_params']['bitflip_gtids'])
+    r['modifBitFlipGTIDCountOK'] = int(0 <= bitFlipCount <= 0)
+    r['triggerProcChecksOK'] = int(triggerProc['n100l_trigger_rate'] == 1 and
+                                   triggerProc['esumh_trigger_rate'] == 1 and
+                                   triggerProc['triggerProcMissingGTID'] == 1 and
+                                   triggerProc['triggerProcBitFlipGTID'] == 1)
+    r['nominalTriggerProcChecksOK'] = r['triggerProcChecksOK']
+    if runNumber >= 101266:
+        r['modifTriggerProcChecksOK'] = r['triggerProcChecksOK']
+    else:
+        r['modifTriggerProcChecksOK'] = int(triggerProc['n100l_trigger_rate'] == 1 and
+                                            triggerProc['esumh_trigger_rate'] == 1 and
+                                            r['modifBitFlipGTIDCountOK'] == 1)
+
+    r['rsRetriggerCheckOK'] = int(timeProc['retriggers'] == 1 or
+                                  ('retriggers_value' in timeProc['check_params'] and
+                                   timeProc['check_params']['retriggers_value'] <= 15.0))
+    eventRateCheck = timeProc['event_rate']
+    if eventRateCheck == 0:
+        meanEventRate = timeProc['check_params']['mean_event_rate']
+        if timeProc['criteria']['min_event_rate'] <= meanEventRate <= 7000:
+            eventRateCheck = 1
+    r['modifEventRateCheckOK'] = eventRateCheck
+    otherTimeChecks = (timeProc['event_separation'] == 1 and r['rsRetriggerCheckOK'] == 1 and
+                       timeProc['run_header'] == 1 and timeProc['10Mhz_UT_comparrison'] == 1 and
+                       timeProc['clock_forward'] == 1)
+    r['timeProcChecksOK'] = int(timeProc['event_rate'] == 1 and otherTimeChecks)
+    r['modifTimeProcChecksOK'] = int(r['modifEventRateCheckOK'] == 1 and otherTimeChecks)
+
+    r['runProcChecksOK'] = int(runProc['run_type'] == 1 and runProc['mc_flag'] == 1 and runProc['trigger'] == 1)
+    if runNumber >= 100600:
+        r['modifRunProcChecksOK'] = r['runProcChecksOK']
+    else:
+        r['modifRunProcChecksOK'] = int(runProc['run_type'] == 1 and runProc['mc_flag'] == 1)
+
+    r['pmtProcChecksOK'] = int(pmtProc['general_coverage'] == 1 and pmtProc['crate_coverage'] == 1 and
+                               pmtProc['panel_coverage'] == 1)
+
+    r['dqhlChecksOK'] = int(r['triggerProcChecksOK'] == 1 and r['timeProcChecksOK'] == 1 and
+                            r['runProcChecksOK'] == 1 and r['pmtProcChecksOK'] == 1)
+    r['modifDqhlChecksOK'] = int(r['modifTriggerProcChecksOK'] == 1 and r['modifTimeProcChecksOK'] == 1 and
+                                 r['modifRunProcChecksOK'] == 1 and r['pmtProcChecksOK'] == 1)
+    return r
+
+def referenceRow(runNumber, data):
+    """Return the run list row of the hand-written checks. """
+
+    checks = data['checks']
+    triggerProc, timeProc = checks['dqtriggerproc'], checks['dqtimeproc']
+    runProc, pmtProc = checks['dqrunproc'], checks['dqpmtproc']
+    r = reference(runNumber, data)
+
+    return (" %i%i%i%i    | %i%i%i%i   |" %
+            (r['rsTriggerProcChecksOK'], r['modifTimeProcChecksOK'], r['modifRunProcChecksOK'],
+             r['pmtProcChecksOK'], r['rsTriggerProcChecksOK'], r['timeProcChecksOK'],
+             r['runProcChecksOK'], r['pmtProcChecksOK']) +
+            " %i     %i     %i     |" %
+            (triggerProc['n100l_trigger_rate'], triggerProc['esumh_trigger_rate'], r['rsMissingGTIDCheckOK']) +
+            " %i     %i      %i     %i     " %
+            (timeProc['event_rate'], timeProc['event_separation'], r['rsRetriggerCheckOK'], timeProc['run_header']) +
+            " %i       %i     |" %
+            (timeProc['10Mhz_UT_comparrison'], timeProc['clock_forward']) +
+            " %i       %i     %i    | %i      %i     %i\n" %
+            (runProc['run_type'], runProc['mc_flag'], runProc['trigger'],
+             pmtProc['general_coverage'], pmtProc['crate_coverage'], pmtProc['panel_coverage']))
+
+# Per-criterion functions of dqhlProcChecks.py: name -> (processor, takes the run number)
+PROC_CHECKS = {
+'rsMissingGTIDCheckOK': ('dqtriggerproc', False), 'rsTriggerProcChecksOK': ('dqtriggerproc', False),
+'modifBitFlipGTIDCountOK': ('dqtriggerproc', False), 'triggerProcChecksOK': ('dqtriggerproc', False),
+'nominalTriggerProcChecksOK': ('dqtriggerproc', False), 'modifTriggerProcChecksOK': ('dqtriggerproc', True),
+'rsRetriggerCheckOK': ('dqtimeproc', False), 'modifEventRateCheckOK': ('dqtimeproc', False),
+'timeProcChecksOK': ('dqtimeproc', False), 'modifTimeProcChecksOK': ('dqtimeproc', True),
+'runProcChecksOK': ('dqrunproc', False), 'modifRunProcChecksOK': ('dqrunproc', True),
+'pmtProcChecksOK': ('dqpmtproc', False),
+'dqhlChecksOK': (None, False), 'modifDqhlChecksOK': (None, True)
+}
+
+def differences(docs):
+    """Return the (run, check) whose results differ from the hand-written checks. """
+
+    differ = []
+
+    rows = dqhltools.processRunRows([run for run, doc in docs], [doc for run, doc in docs])
+
+    for (run, doc), batchRow in zip(docs, rows):
+
+        row = referenceRow(run, doc)
+
+        if dqhltools.processRunRow(run, doc) != row:
+            differ.append((run, "processRunRow"))
+        if batchRow != row:
+            differ.append((run, "processRunRows"))
+
+        expected = reference(run, doc)
+
+        for name, (proc, byRun) in sorted(PROC_CHECKS.items()):
+            args = (doc,) if proc is None else (doc['checks'][proc],)
+            if byRun:
+                args = (run,) + args
+            if getattr(dqhlProcChecks, name)(*args) != expected[name]:
+                differ.append((run, name))
+
+    return differ
+
+def seconds_per_run(rowFunctions, docs, repeat):
+    """Return the best time per run of each row function over the documents,
+    timed in alternate passes so both see the same machine load.
+    """
+
+    best = [None] * len(rowFunctions)
+
+    for i in xrange(repeat):
+        for position, rowFunction in enumerate(rowFunctions):
+            start = time.time()
+            for run, doc in docs:
+                rowFunction(run, doc)
+            elapsed = time.time() - start
+            best[position] = elapsed if best[position] is None else min(best[position], elapsed)
+
+    return [seconds / len(docs) for seconds in best]
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Compare the DQHL rule table with the hand-written checks")
+
+    parser.add_argument("--runs", dest = "runs", help = "Number of runs", type = int, default = 5000)
+    parser.add_argument("--first-run", dest = "firstrun", help = "First run number, the rules change at "
+                        "100600 and 101266", type = int, default = 99000)
+    parser.add_argument("--seed", dest = "seed", help = "Seed of the synthetic documents", type = int, default = 0)
+    parser.add_argument("--repeat", dest = "repeat", help = "Timed passes over the documents, the best is kept",
+                        type = int, default = 10)
+    parser.add_argument("--max-ratio", dest = "maxratio", help = "Largest time per run of processRunRow(), "
+                        "relative to the hand-written checks", type = float, default = 1.1)
+
+    args = parser.parse_args()
+
+    docs = []
+
+    for run in xrange(args.firstrun, args.firstrun + args.runs):
+        for docid in synthdata.dqhl_document_ids(run, args.seed)[:1]:
+            docs.append((run, synthdata.dqhl_document(docid, args.seed)))
+
+    differ = differences(docs)
+
+    handWritten, single = seconds_per_run([referenceRow, dqhltools.processRunRow], docs, args.repeat)
+    ratio = single / handWritten
+
+    print "dqhl rules: %i documents, %i differences" % (len(docs), len(differ))
+    for run, check in differ[:10]:
+        print "  run %i: %s" % (run, check)
+    print "  hand-written checks   %.1f us/run" % (handWritten * 1e6)
+    print "  processRunRow         %.1f us/run (%.2f x, at most %.2f x)" % (single * 1e6, ratio, args.maxratio)
+
+    return 1 if differ or ratio > args.maxratio else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
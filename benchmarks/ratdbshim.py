@@ -0,0 +1,344 @@
+"""ratdbshim.py
+Throwaway RATDB and detector database for the benchmarks, filled with the
+synthetic tables of synthdata.py.
+
+Two backends:
+
+    postgres  the ratdb_header_v2, ratdb_data_v2, run_state and
+              evaluated_runs tables are created in a scratch postgresql
+              database, so every query runs unchanged (needs psycopg2);
+              ratdb_tables.py only runs against this one
+    sqlite    the same tables in a SQLite file, opened by rschecks.py and
+              rsdaemon.py through connectiontools.register_postgres_backend();
+              their postgresql queries are translated by SqliteConnection
+"""
+import os
+import json
+import sqlite3
+import datetime
+
+import synthdata
+
+SCHEME = "sqlite"
+
+# Start time of the first run of the synthetic runs, and time between runs
+FIRST_RUN_TIME = datetime.datetime(2018, 1, 1)
+RUN_SPACING = 4000 # seconds
+
+# Tables are loaded in batches of this many rows
+LOAD_BATCH_SIZE = 5000
+
+# Fraction of the runs missing from the detector database and of each
+# critical table, and of the tables with a second pass
+MISSING_RUN_STATE = 0.01
+MISSING_CRITICAL_TABLE = 0.01
+SECOND_PASS = 0.05
+
+POSTGRES_SCHEMA = ["DROP TABLE IF EXISTS ratdb_header_v2, ratdb_data_v2, run_state, evaluated_runs",
+                   "CREATE TABLE ratdb_header_v2 (key integer PRIMARY KEY, type text, index text, "
+                   "run_begin integer, run_end integer, pass integer)",
+                   "CREATE TABLE ratdb_data_v2 (key integer PRIMARY KEY, data json)",
+                   "CREATE TABLE run_state (run integer PRIMARY KEY, run_type integer, "
+                   "timestamp timestamp, end_timestamp timestamp)",
+                   "CREATE TABLE evaluated_runs (run integer, list integer)"]
+
+POSTGRES_INDICES = ["CREATE INDEX ON ratdb_header_v2 (type, run_begin, run_end)",
+                    "ANALYZE"]
+
+SQLITE_SCHEMA = ["CREATE TABLE ratdb_header_v2 (key INTEGER PRIMARY KEY, type TEXT, \"index\" TEXT, "
+                 "run_begin INTEGER, run_end INTEGER, pass INTEGER)",
+                 "CREATE TABLE ratdb_data_v2 (key INTEGER PRIMARY KEY, data TEXT)",
+                 "CREATE TABLE run_state (run INTEGER PRIMARY KEY, run_type INTEGER, "
+                 "timestamp TEXT, end_timestamp TEXT)",
+                 "CREATE TABLE evaluated_runs (run INTEGER, list INTEGER)",
+                 "CREATE TABLE shim (max_span INTEGER)"]
+
+SQLITE_INDICES = ["CREATE INDEX header_runs ON ratdb_header_v2 (type, run_begin, run_end)",
+                  "ANALYZE"]
+
+def _timestamp(seconds):
+
+    return (FIRST_RUN_TIME + datetime.timedelta(seconds = seconds)).strftime("%Y-%m-%d %H:%M:%S")
+
+def headers(firstrun, lastrun, seed = 0, critical_tables = None, max_range = 0):
+    """Generate the RATDB tables of a run range.
+    :param: The first and last run numbers (int)
+    :param: The seed of the synthetic tables
+    :param: The critical tables of ratdb_tables.py to add, name -> indices (optional)
+    :param: The longest validity range of the critical tables without index,
+            in runs after their first run, so that the ranges overlap (by
+            default every table is valid for its own run only)
+    :returns: An iterator of (type, index, run_begin, run_end, pass, data) with
+              the data as JSON text
+    """
+
+    for run in xrange(firstrun, lastrun + 1):
+
+        for table in (synthdata.run_table(run, seed), synthdata.dqll_table(run, seed)):
+            if table is not None:
+                yield table['type'], '', run, run, 0, json.dumps(table)
+
+        for name in sorted(critical_tables or {}):
+
+            rnd = synthdata._random(seed, run, name)
+
+            for index in critical_tables[name] or ['']:
+
+                if rnd.random() < MISSING_CRITICAL_TABLE:
+                    continue
+
+                end = run + rnd.randint(0, max_range) if max_range and not index else run
+
+                data = json.dumps({'type': name, 'index': index, 'version': 1, 'run_range': [run, end]})
+
+                yield name, index, run, end, 0, data
+
+                if rnd.random() < SECOND_PASS:
+                    yield name, index, run, end, 1, data
+
+def run_states(firstrun, lastrun, seed = 0):
+    """Generate the run_state rows of a run range: (run, run_type, timestamp, end_timestamp). """
+
+    for run in xrange(firstrun, lastrun + 1):
+
+        if synthdata._random(seed, run, "run_state").random() < MISSING_RUN_STATE:
+            continue
+
+        start = (run - firstrun) * RUN_SPACING
+
+        yield run, synthdata.run_type(run, seed), _timestamp(start), \
+              _timestamp(start + synthdata.run_length(run, seed))
+
+def _batches(rows):
+
+    batch = []
+
+    for row in rows:
+
+        batch.append(row)
+
+        if len(batch) == LOAD_BATCH_SIZE:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def load_sqlite(path, firstrun, lastrun, seed = 0, critical_tables = None, max_range = 0):
+    """Create a SQLite RATDB and detector database with the synthetic tables of a run range.
+    An existing file is replaced.
+    :returns: The number of RATDB tables loaded
+    """
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    db = sqlite3.connect(path)
+
+    for statement in SQLITE_SCHEMA:
+        db.execute(statement)
+
+    key = 0
+
+    for batch in _batches(headers(firstrun, lastrun, seed, critical_tables, max_range)):
+
+        keys = range(key + 1, key + 1 + len(batch))
+        key += len(batch)
+
+        db.executemany("INSERT INTO ratdb_header_v2 VALUES (?, ?, ?, ?, ?, ?)",
+                       [(k,) + row[:5] for k, row in zip(keys, batch)])
+        db.executemany("INSERT INTO ratdb_data_v2 VALUES (?, ?)",
+                       [(k, row[5]) for k, row in zip(keys, batch)])
+
+    for batch in _batches(run_states(firstrun, lastrun, seed)):
+        db.executemany("INSERT INTO run_state VALUES (?, ?, ?, ?)", batch)
+
+    db.execute("INSERT INTO evaluated_runs SELECT run, 1 FROM run_state WHERE run_type & 4")
+
+    # Longest validity range, which bounds the range lookups of the translated queries
+    db.execute("INSERT INTO shim SELECT COALESCE(MAX(run_end - run_begin), 0) FROM ratdb_header_v2")
+
+    for statement in SQLITE_INDICES:
+        db.execute(statement)
+
+    db.commit()
+    db.close()
+
+    return key
+
+def load_postgres(address, firstrun, lastrun, seed = 0, critical_tables = None, max_range = 0):
+    """Create the RATDB and detector database tables with the synthetic tables of a
+    run range in a scratch postgresql database. Tables of the same names are dropped.
+    :returns: The number of RATDB tables loaded
+    """
+
+    import psycopg2
+    import cStringIO
+
+    def copy(curr, table, rows):
+        buf = cStringIO.StringIO()
+        for row in rows:
+            buf.write("\t".join(str(value).replace("\\", "\\\\") for value in row) + "\n")
+        buf.seek(0)
+        curr.copy_from(buf, table)
+
+    conn = psycopg2.connect(address)
+    curr = conn.cursor()
+
+    for statement in POSTGRES_SCHEMA:
+        curr.execute(statement)
+
+    key = 0
+
+    for batch in _batches(headers(firstrun, lastrun, seed, critical_tables, max_range)):
+
+        keys = range(key + 1, key + 1 + len(batch))
+        key += len(batch)
+
+        copy(curr, "ratdb_header_v2", [(k,) + row[:5] for k, row in zip(keys, batch)])
+        copy(curr, "ratdb_data_v2", [(k, row[5]) for k, row in zip(keys, batch)])
+
+    for batch in _batches(run_states(firstrun, lastrun, seed)):
+        copy(curr, "run_state", batch)
+
+    curr.execute("INSERT INTO evaluated_runs SELECT run, 1 FROM run_state WHERE run_type & 4 <> 0")
+
+    conn.commit()
+
+    conn.autocommit = True
+
+    for statement in POSTGRES_INDICES:
+        curr.execute(statement)
+
+    conn.close()
+
+    return key
+
+# SQLite versions of the bulk queries of ratdbtools: the runs are in a
+# temporary table, the validity ranges are looked up through the header
+# index, and DISTINCT ON is done on the sorted rows
+_LATEST_QUERY = ("SELECT r.run, h.type, %s FROM temp.runs AS r "
+                 "INNER JOIN ratdb_header_v2 AS h INDEXED BY header_runs ON h.type IN (%s) "
+                 "AND h.run_begin BETWEEN r.run - ? AND r.run AND h.run_end >= r.run "
+                 "%s ORDER BY r.run, h.type, h.pass DESC")
+
+def _latest(conn, runs, types, columns, join = ""):
+
+    conn.db.execute("DELETE FROM temp.runs")
+    conn.db.executemany("INSERT INTO temp.runs VALUES (?)", [(run,) for run in runs])
+
+    rows = conn.db.execute(_LATEST_QUERY % (columns, ", ".join("?" * len(types)), join),
+                           list(types) + [conn.max_span])
+
+    latest = []
+    last = None
+
+    for row in rows:
+        if row[:2] != last:
+            latest.append(row)
+            last = row[:2]
+
+    return latest
+
+def _bulk_tables(conn, params):
+
+    runs, types = params
+
+    return _latest(conn, runs, types, "d.data", "INNER JOIN ratdb_data_v2 AS d ON d.key = h.key")
+
+def _bulk_headers(conn, params):
+
+    runs, types = params
+
+    return _latest(conn, runs, types, "h.key, h.pass")
+
+def _bulk_data(conn, params):
+
+    keys, = params
+
+    conn.db.execute("DELETE FROM temp.runs")
+    conn.db.executemany("INSERT INTO temp.runs VALUES (?)", [(key,) for key in keys])
+
+    return conn.db.execute("SELECT key, data FROM ratdb_data_v2 WHERE key IN (SELECT run FROM temp.runs)").fetchall()
+
+def _sync_headers(conn, params):
+
+    lastkey, types, limit = params
+
+    return conn.db.execute("SELECT key, type, \"index\", run_begin, run_end FROM ratdb_header_v2 "
+                           "WHERE key > ? AND type IN (%s) ORDER BY key LIMIT ?" % ", ".join("?" * len(types)),
+                           [lastkey] + list(types) + [limit]).fetchall()
+
+def _translations():
+
+    import ratdbtools
+    import ratdbcoverage
+
+    return {ratdbtools.BULK_TABLES_QUERY: _bulk_tables,
+            ratdbtools.BULK_HEADERS_QUERY: _bulk_headers,
+            ratdbtools.BULK_DATA_QUERY: _bulk_data,
+            ratdbcoverage.SYNC_QUERY: _sync_headers}
+
+class SqliteCursor(object):
+
+    def __init__(self, conn):
+
+        self.conn = conn
+        self.rows = []
+
+    def execute(self, query, params = ()):
+
+        translation = self.conn.translations.get(query)
+
+        if translation is not None:
+            self.rows = translation(self.conn, params)
+        else:
+            # Queries with plain parameters only need the SQLite placeholders
+            self.rows = self.conn.db.execute(query.replace("%s", "?"), params).fetchall()
+
+    def fetchall(self):
+
+        rows, self.rows = self.rows, []
+
+        return rows
+
+    def close(self):
+
+        self.rows = []
+
+class SqliteConnection(object):
+    """DB-API connection to the SQLite shim answering the postgresql queries of rschecks.py.
+    :param: The path of the SQLite file (string)
+    """
+
+    def __init__(self, path):
+
+        # Autocommit, so no read lock is held between the queries; closed by
+        # connectiontools from another thread once its thread has ended
+        self.db = sqlite3.connect(path, isolation_level = None, check_same_thread = False)
+        self.db.execute("CREATE TEMP TABLE runs (run INTEGER)")
+
+        self.max_span, = self.db.execute("SELECT max_span FROM shim").fetchone()
+        self.translations = _translations()
+
+        self.closed = 0
+        self.autocommit = True
+
+    def cursor(self):
+
+        return SqliteCursor(self)
+
+    def close(self):
+
+        self.db.close()
+        self.closed = 1
+
+def address(path):
+    """Return the connector address of a SQLite shim file. """
+
+    return "%s://bench:bench@localhost:0/%s" % (SCHEME, path)
+
+def connect(db_connector_address):
+    """Open the SQLite shim of a connector address made by address(). """
+
+    return SqliteConnection(db_connector_address.split("/", 3)[3])
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+"""rsbench.py
+Throughput benchmarks of the Run Selection checks on synthetic data, without
+access to the collaboration databases.
+
+The synthetic RUN, DQLL and DQHL tables of a run range (synthdata.py) are
+served by a throwaway RATDB (ratdbshim.py, SQLite or postgresql) and a local
+CouchDB stand-in (couchdbstub.py) with a configurable latency. The code under
+test runs in its own process, with a settings module pointing at the
+stand-ins, and the benchmark reports:
+
+    runs/s     runs of the range over the wall time of the process
+    p50, p99   per run latency: for rschecks the time from the start of the
+               download of the chunk of the run to the write of its row, for
+               dqhl each dqhlPassFailList call
+    peak RSS   maximum resident set size of the process
+
+Targets:
+
+    rschecks      rschecks.main() over the range
+    dqhl          dqhltools.dqhlPassFailList() for every run of the range, with the
+                  documents fetched once for the range, or per run with --per-run
+    ratdb_tables  ratdb_tables.py over the range (needs --postgres)
+
+Example use: 'python benchmarks/rsbench.py rschecks --runs 20000 --latency 0.005 -- -j 4'
+Arguments after '--' are passed to the target.
+"""
+import os
+import sys
+import json
+import time
+import bisect
+import shutil
+import argparse
+import tempfile
+import urlparse
+import subprocess
+
+import ratdbshim
+import couchdbstub
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+TARGETS = ["rschecks", "dqhl", "ratdb_tables"]
+
+def _quantile(samples, q):
+    # Nearest rank of sorted samples, as rsmetrics does
+    return samples[min(len(samples) - 1, max(0, int(q * len(samples) + 0.5) - 1))] if samples else None
+
+def settings_values(ratdb_address, couchdb_url):
+    """Return the values of the settings module for the stand-ins. """
+
+    address = urlparse.urlparse(ratdb_address)
+
+    return {'COUCHDB_SERVER_HL': couchdb_url,
+            'RATDB_ADDRESS': address.scheme, 'RATDB_HOST': address.hostname,
+            'RATDB_READ_USER': address.username or "", 'RATDB_READ_PASSWORD': address.password or "",
+            'RATDB_NAME': address.path[1:], 'RATDB_PORT': address.port or 5432}
+
+def time_rschecks(rschecks, latencies):
+    """Wrap the chunk functions of rschecks so that the latency of every run
+    written to the run list, from the start of the download of its chunk to
+    the write of its row, is appended to latencies. The rows of a chunk are
+    written by rschecks.main() before it asks for the next chunk.
+    """
+
+    fetchstarts = {}
+
+    chunk_fetchers = rschecks.chunk_fetchers
+    evaluate_chunks = rschecks.evaluate_chunks
+
+    def timed_fetcher(fetcher):
+
+        def fetch(chunk):
+            fetchstarts.setdefault(chunk[0], time.time())
+            return fetcher(chunk)
+
+        return fetch
+
+    def timed_chunk_fetchers(*args, **kwargs):
+        return dict((name, timed_fetcher(fetcher)) for name, fetcher in chunk_fetchers(*args, **kwargs).items())
+
+    def timed_evaluate_chunks(*args, **kwargs):
+
+        for results in evaluate_chunks(*args, **kwargs):
+
+            yield results
+
+            written = time.time()
+
+            rows = [result for result in results if result.get('row')]
+
+            if rows:
+                # First run of the chunk of the results
+                firstruns = sorted(fetchstarts)
+                start = fetchstarts[firstruns[bisect.bisect_right(firstruns, rows[0]['run']) - 1]]
+                latencies.extend([written - start] * len(rows))
+
+    rschecks.chunk_fetchers = timed_chunk_fetchers
+    rschecks.evaluate_chunks = timed_evaluate_chunks
+
+def worker(config):
+    """Run a target in this process and write its per run latencies to the result file. """
+
+    import imp
+
+    settings = imp.new_module("settings")
+    settings.__dict__.update(config['settings'])
+    sys.modules['settings'] = settings
+
+    sys.path.insert(0, REPO_DIR)
+
+    import connectiontools
+    connectiontools.register_postgres_backend(ratdbshim.SCHEME, ratdbshim.connect)
+
+    latencies = []
+
+    if config['target'] == "rschecks":
+
+        import rschecks
+
+        time_rschecks(rschecks, latencies)
+
+        sys.argv = ["rschecks.py", "-n", str(config['firstrun']), "-i", str(config['lastrun'])] + config['args']
+
+        try:
+            rschecks.main()
+        except SystemExit:
+            pass
+
+    elif config['target'] == "dqhl":
+
+        import dqhltools
+
+        docs = None
+
+        if not config['per_run']:
+            docs = dqhltools.dqhlDocuments(config['firstrun'], config['lastrun'])
+
+        runlist = open(os.devnull, 'w')
+
+        for run in xrange(config['firstrun'], config['lastrun'] + 1):
+            start = time.time()
+            dqhltools.dqhlPassFailList(run, runlist, docs)
+            latencies.append(time.time() - start)
+
+        runlist.close()
+
+    result = open(config['result'], 'w')
+    json.dump({'latencies': latencies}, result)
+    result.close()
+
+def run_process(command, log):
+    """Run a command, return its wall time (seconds) and peak RSS (MB). """
+
+    start = time.time()
+
+    process = subprocess.Popen(command, cwd = os.path.dirname(log), stdout = open(log, 'w'), stderr = subprocess.STDOUT)
+
+    pid, status, rusage = os.wait4(process.pid, 0)
+
+    elapsed = time.time() - start
+
+    if status != 0:
+        sys.stderr.write(open(log).read())
+        sys.stderr.write("rsbench: %s failed with status %i\n" % (os.path.basename(command[1]), os.WEXITSTATUS(status)))
+        sys.exit(1)
+
+    # ru_maxrss is in kB on Linux
+    return elapsed, rusage.ru_maxrss / 1024.0
+
+def benchmark(args, extra, workdir):
+    """Run the benchmark of a target in a work directory and return its report. """
+
+    firstrun = args.firstrun
+    lastrun = args.firstrun + args.runs - 1
+
+    report = {'target': args.target, 'firstrun': firstrun, 'lastrun': lastrun, 'runs': args.runs,
+              'seed': args.seed, 'latency': args.latency, 'backend': "postgres" if args.postgres else "sqlite"}
+
+    critical_tables = None
+
+    if args.target == "ratdb_tables":
+        sys.path.insert(0, REPO_DIR)
+        from ratdb_tables import critical_tables
+
+    # RATDB and detector database
+    start = time.time()
+
+    if args.postgres:
+        ratdb_address = args.postgres
+        ratdbshim.load_postgres(ratdb_address, firstrun, lastrun, args.seed, critical_tables)
+    else:
+        ratdb_address = ratdbshim.address(os.path.join(workdir, "ratdb.sqlite"))
+        ratdbshim.load_sqlite(ratdb_address.split("/", 3)[3], firstrun, lastrun, args.seed, critical_tables)
+
+    report['load_seconds'] = time.time() - start
+
+    log = os.path.join(workdir, args.target + ".log")
+    result = os.path.join(workdir, "result.json")
+
+    if args.target == "ratdb_tables":
+
+        command = [sys.executable, os.path.join(REPO_DIR, "ratdb_tables.py"), "-l", str(firstrun), "-u", str(lastrun),
+                   "-f", os.path.join(workdir, "missing_tables.txt"),
+                   "--ratdb", ratdb_address, "--detector_db", ratdb_address] + extra
+
+        elapsed, maxrss = run_process(command, log)
+
+        latencies = []
+
+    else:
+
+        couchdb = couchdbstub.CouchDBStub(firstrun, lastrun, args.seed, args.latency).start()
+
+        config = {'target': args.target, 'firstrun': firstrun, 'lastrun': lastrun, 'per_run': args.perrun,
+                  'settings': settings_values(ratdb_address, couchdb.url()), 'result': result, 'args': extra}
+
+        if args.target == "rschecks":
+            config['args'] = (["--cache-file", os.path.abspath(args.cache)] if args.cache else ["--no-cache"]) + \
+                             ["--log-level", "quiet", "--detector-db", ratdb_address,
+                              "--metrics", os.path.join(workdir, "metrics.json")] + extra
+
+        configname = os.path.join(workdir, "worker.json")
+        configfile = open(configname, 'w')
+        json.dump(config, configfile)
+        configfile.close()
+
+        elapsed, maxrss = run_process([sys.executable, os.path.abspath(__file__), "--worker", configname], log)
+
+        report['couchdb_requests'] = couchdb.requests
+
+        couchdb.stop()
+
+        latencies = []
+        if os.path.exists(result):
+            latencies = sorted(json.load(open(result))['latencies'])
+
+    report['elapsed'] = elapsed
+    report['runs_per_second'] = args.runs / max(elapsed, 1e-6)
+    report['p50_ms'] = _quantile(latencies, 0.5) * 1000 if latencies else None
+    report['p99_ms'] = _quantile(latencies, 0.99) * 1000 if latencies else None
+    report['peak_rss_mb'] = maxrss
+
+    return report
+
+def main():
+
+    if len(sys.argv) == 3 and sys.argv[1] == "--worker":
+        worker(json.load(open(sys.argv[2])))
+        return 0
+
+    argv = sys.argv[1:]
+    extra = []
+
+    if "--" in argv:
+        argv, extra = argv[:argv.index("--")], argv[argv.index("--") + 1:]
+
+    parser = argparse.ArgumentParser(description = "Benchmark the Run Selection checks on synthetic data")
+
+    parser.add_argument("target", help = "Code to benchmark", choices = TARGETS)
+    parser.add_argument("--runs", dest = "runs", help = "Number of runs", type = int, default = 10000)
+    parser.add_argument("--first-run", dest = "firstrun", help = "First run number", type = int, default = 200000)
+    parser.add_argument("--seed", dest = "seed", help = "Seed of the synthetic tables", type = int, default = 0)
+    parser.add_argument("--latency", dest = "latency", help = "Latency of each CouchDB request in seconds",
+                        type = float, default = 0.0)
+    parser.add_argument("--postgres", dest = "postgres",
+                        help = "Address of a scratch postgresql database to load the RATDB tables in, instead of SQLite")
+    parser.add_argument("--per-run", dest = "perrun", help = "dqhl: fetch the documents run by run",
+                        action = "store_true")
+    parser.add_argument("--cache", dest = "cache", help = "rschecks: local cache file to read through, kept between runs")
+    parser.add_argument("--workdir", dest = "workdir", help = "Directory of the databases, run lists and logs, kept")
+    parser.add_argument("--report", dest = "report", help = "File to write the report to, as JSON")
+
+    args = parser.parse_args(argv)
+
+    if args.target == "ratdb_tables" and not args.postgres:
+        parser.error("ratdb_tables needs a postgresql database (--postgres)")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix = "rsbench")
+
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    workdir = os.path.abspath(workdir)
+
+    try:
+        report = benchmark(args, extra, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    print "%s: %i runs in %.1f s (RATDB loaded in %.1f s)" % (report['target'], report['runs'],
+                                                              report['elapsed'], report['load_seconds'])
+    print "  runs/s    %.1f" % report['runs_per_second']
+    if report['p99_ms'] is not None:
+        print "  per run   p50 %.2f ms - p99 %.2f ms" % (report['p50_ms'], report['p99_ms'])
+    print "  peak RSS  %.1f MB" % report['peak_rss_mb']
+
+    if args.report:
+        reportfile = open(args.report, 'w')
+        json.dump(report, reportfile, indent = 2, sort_keys = True)
+        reportfile.close()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,152 @@
+"""synthdata.py
+Synthetic RUN, DQLL and DQHL documents for the benchmarks.
+
+Every document is generated from the run number and a seed alone, so the
+stand-ins can produce any document on request without holding a season of
+them in memory, and the same seed always gives the same documents.
+
+    RUN   run type bit mask, mostly physics runs, some with detector state bits
+    DQLL  19 crate HV arrays; detector_db_alarms from version 4 on
+    DQHL  the four processors, with missing_gtids and bitflip_gtids lists
+          of variable length; a few runs have a second document
+"""
+import random
+
+NCRATES = 19
+
+# Run type bits: physics and deployed source runs, detector state bits
+PHYSICS_RUN = 0x4
+SOURCE_RUN = 0x8
+DETECTOR_STATE_BITS = [0x200000, 0x400000, 0x800000, 0x4000000, 0x8000000]
+
+ALARMS = ['HV_current_near_zero', 'HV_over_current', 'HV_setpoint_discrepancy']
+
+# Fraction of the runs without a table or document
+MISSING_RUN = 0.03
+MISSING_DQLL = 0.03
+MISSING_DQHL = 0.05
+
+# Fraction of the runs with a second DQHL document
+SECOND_DQHL = 0.02
+
+def _random(seed, run, table):
+
+    # Independent generator for each (run, table)
+    return random.Random("%s:%i:%s" % (seed, run, table))
+
+def _flag(rnd, passing = 0.95):
+
+    return 1 if rnd.random() < passing else 0
+
+def run_length(run, seed = 0):
+    """Return the length of a run in seconds, as the detector DB and DQLL table give it. """
+
+    rnd = _random(seed, run, "length")
+
+    return rnd.choice([300, 1200, 3600, 3600, 3600, 3600, 3600, 3600]) + rnd.randint(0, 59)
+
+def run_type(run, seed = 0):
+    """Return the run type bit mask of a run. """
+
+    rnd = _random(seed, run, "RUN")
+
+    runtype = PHYSICS_RUN if rnd.random() < 0.85 else rnd.choice([0x1, 0x2, PHYSICS_RUN | SOURCE_RUN])
+
+    if rnd.random() < 0.08:
+        runtype |= rnd.choice(DETECTOR_STATE_BITS)
+
+    return runtype
+
+def run_table(run, seed = 0):
+    """Return the RUN table of a run, or None if it is missing. """
+
+    if _random(seed, run, "RUN missing").random() < MISSING_RUN:
+        return None
+
+    return {'type': 'RUN', 'version': 1, 'index': '', 'run_range': [run, run],
+            'runtype': run_type(run, seed)}
+
+def dqll_table(run, seed = 0):
+    """Return the DQLL table of a run, or None if it is missing. """
+
+    rnd = _random(seed, run, "DQLL")
+
+    if rnd.random() < MISSING_DQLL:
+        return None
+
+    version = rnd.choice([3, 4, 4, 5])
+
+    table = {'type': 'DQLL', 'version': version, 'index': '', 'run_range': [run, run],
+             'duration_seconds': run_length(run, seed),
+             'crate_hv_status_a': [rnd.random() > 0.002 for crate in range(NCRATES)],
+             'crate_16_hv_status_b': rnd.random() > 0.01,
+             'crate_hv_dac_a': [0 if rnd.random() < 0.002 else rnd.randint(1800, 2100) for crate in range(NCRATES)],
+             'crate_16_hv_dac_b': 0 if rnd.random() < 0.01 else rnd.randint(1400, 1600)}
+
+    # HV alarms only exist for version 4 and later
+    if version > 3:
+        alarms = {}
+        for alarm in ALARMS:
+            alarms[alarm + '_A'] = [1 if rnd.random() < 0.003 else 0 for crate in range(NCRATES)]
+            alarms[alarm + '_B'] = 1 if rnd.random() < 0.01 else 0
+        table['detector_db_alarms'] = alarms
+
+    return table
+
+def dqhl_document_ids(run, seed = 0):
+    """Return the ids of the DQHL documents of a run, the one rschecks uses first. """
+
+    rnd = _random(seed, run, "DQHL ids")
+
+    if rnd.random() < MISSING_DQHL:
+        return []
+
+    ids = ["dq-%i-0" % run]
+
+    if rnd.random() < SECOND_DQHL:
+        ids.append("dq-%i-1" % run)
+
+    return ids
+
+def document_run(docid):
+    """Return the run number of a DQHL document id, or None for another id. """
+
+    parts = docid.split('-')
+
+    if len(parts) != 3 or parts[0] != "dq" or not parts[1].isdigit():
+        return None
+
+    return int(parts[1])
+
+def dqhl_document(docid, seed = 0):
+    """Return the DQHL document of an id, or None if there is no such document. """
+
+    run = document_run(docid)
+
+    if run is None or docid not in dqhl_document_ids(run, seed):
+        return None
+
+    rnd = _random(seed, run, docid)
+
+    triggerProc = {'n100l_trigger_rate': _flag(rnd), 'esumh_trigger_rate': _flag(rnd),
+                   'triggerProcMissingGTID': _flag(rnd, 0.9), 'triggerProcBitFlipGTID': _flag(rnd, 0.9),
+                   'check_params': {
+                       'missing_gtids': sorted(rnd.sample(xrange(1 << 24), rnd.choice([0, 0, 0, 2, 10, 50, 400]))),
+                       'bitflip_gtids': sorted(rnd.sample(xrange(1 << 24), rnd.choice([0, 0, 0, 1, 5, 30])))}}
+
+    timeProc = {'event_rate': _flag(rnd), 'event_separation': _flag(rnd), 'retriggers': _flag(rnd, 0.8),
+                'run_header': _flag(rnd), '10Mhz_UT_comparrison': _flag(rnd), 'clock_forward': _flag(rnd),
+                'criteria': {'min_event_rate': 5.0, 'max_event_rate': 7000.0},
+                'check_params': {'mean_event_rate': rnd.choice([4.0, 40.0, 90.0, 6500.0, 7000.0, 7500.0]),
+                                 'retriggers_value': rnd.choice([0.5, 1.0, 2.0, 15.0, 30.0])}}
+
+    runProc = {'run_type': _flag(rnd), 'mc_flag': _flag(rnd), 'trigger': _flag(rnd)}
+
+    pmtProc = {'general_coverage': _flag(rnd), 'crate_coverage': _flag(rnd), 'panel_coverage': _flag(rnd),
+               'check_params': {'general_coverage_value': rnd.uniform(0.6, 1.0),
+                                'crate_coverage_value': [rnd.uniform(0.6, 1.0) for crate in range(NCRATES)]}}
+
+    return {'_id': docid, '_rev': "1-%08x" % rnd.getrandbits(32), 'type': 'DATAQUALITY_RECORDS',
+            'run_range': [run, run],
+            'checks': {'dqtriggerproc': triggerProc, 'dqtimeproc': timeProc,
+                       'dqrunproc': runProc, 'dqpmtproc': pmtProc}}
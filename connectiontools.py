@@ -0,0 +1,259 @@
+"""connectiontools.py
+Process-wide connections to the CouchDB and RATDB backends for the Run
+Selection checks. Each backend is opened once and reused by every run.
+The CouchDB server is shared by all threads, the RATDB connections are
+opened once per thread so concurrent runs do not wait on each other.
+
+The client library of a backend (couchdb, psycopg2, rat) is only imported
+when a connection to it is first opened.
+"""
+import os
+import sys
+import datetime
+import threading
+
+import rsfixtures
+
+# Delays (in seconds) between retries of a CouchDB request that failed
+# because the connection dropped
+COUCHDB_RETRY_DELAYS = [0, 1, 5]
+
+_couchdb_servers = {}
+
+# Connect functions of other DB-API backends answering the postgresql
+# queries, by address scheme (e.g. the SQLite stand-in of the benchmarks)
+_postgres_backends = {}
+
+# Per thread {address: connection} dictionaries, and all of them with their
+# threads for close_all(); the connections of a thread that has ended are
+# closed when the next thread opens one
+_local = threading.local()
+_lock = threading.Lock()
+_thread_connections = []
+
+def get_couchdb_server(url):
+    """Function to get the shared couchdb server for an url.
+    The server keeps its HTTP session (and keep-alive connections) open
+    and retries requests on dropped connections.
+    :param: The url of the couchdb server (string)
+    :returns: The couchdb server, None when the responses are replayed from fixtures
+    """
+
+    # Every request is answered by rsfixtures
+    if rsfixtures.mode() == rsfixtures.REPLAY:
+        return None
+
+    import couchdb
+
+    with _lock:
+
+        if url not in _couchdb_servers:
+
+            session = couchdb.http.Session(retry_delays = COUCHDB_RETRY_DELAYS)
+
+            _couchdb_servers[url] = couchdb.Server(url, session = session)
+
+        return _couchdb_servers[url]
+
+def get_ratdb_connector(db_connector_address):
+    """Function to get the shared ratdb connector for an address.
+    :param: The connector address of the postgresql database (string)
+    :returns: The ratdb connector
+    """
+
+    connectors = _connections("ratdb")
+
+    if db_connector_address not in connectors:
+
+        # Check if the rat environment is set
+        if "RATROOT" not in os.environ:
+
+            sys.stderr.write("%s - get_ratdb_connector():ERROR: please set the RATROOT environment variable\n"
+                             % (datetime.datetime.now().replace(microsecond = 0)))
+            sys.exit(1)
+
+        from rat import ratdb
+
+        connectors[db_connector_address] = ratdb.RATDBConnector(db_connector_address)
+
+    return connectors[db_connector_address]
+
+def ratdb_fetch(db_connector_address, **kwargs):
+    """Function to fetch tables through the shared ratdb connector.
+    If the connection has dropped the connector is re-opened and the
+    fetch is tried once more.
+    :param: The connector address of the postgresql database (string)
+    :param: The arguments passed to RATDBConnector.fetch
+    :returns: The result of RATDBConnector.fetch
+    """
+
+    try:
+
+        return get_ratdb_connector(db_connector_address).fetch(**kwargs)
+
+    except Exception as e:
+
+        sys.stderr.write("%s - ratdb_fetch():WARNING: %s - reconnecting\n"
+                         % (datetime.datetime.now().replace(microsecond = 0),e))
+
+        close_ratdb_connector(db_connector_address)
+
+        return get_ratdb_connector(db_connector_address).fetch(**kwargs)
+
+def close_ratdb_connector(db_connector_address):
+    """Function to drop the shared ratdb connector for an address.
+    :param: The connector address of the postgresql database (string)
+    """
+
+    connector = _connections("ratdb").pop(db_connector_address, None)
+
+    if connector is not None:
+        _close_quietly(connector)
+
+def register_postgres_backend(scheme, connect):
+    """Function to open the addresses of a scheme with another DB-API backend.
+    :param: The scheme of the addresses (string, e.g. sqlite)
+    :param: The function returning a connection for an address
+    """
+
+    _postgres_backends[scheme] = connect
+
+def get_postgres_connection(db_connector_address):
+    """Function to get the shared postgresql connection for an address.
+    :param: The connector address of the postgresql database (string)
+    :returns: The psycopg2 connection
+    """
+
+    connections = _connections("postgres")
+
+    conn = connections.get(db_connector_address)
+
+    if conn is None or conn.closed:
+
+        connect = _postgres_backends.get(db_connector_address.split("://")[0])
+
+        if connect is None:
+            import psycopg2
+            connect = psycopg2.connect
+
+        conn = connect(db_connector_address)
+
+        # Read-only queries: no transaction is left open between runs
+        conn.autocommit = True
+
+        connections[db_connector_address] = conn
+
+    return conn
+
+@rsfixtures.query
+def postgres_query(db_connector_address, query, params):
+    """Function to run a query on the shared postgresql connection.
+    If the connection has dropped it is re-opened and the query is
+    tried once more.
+    :param: The connector address of the postgresql database (string)
+    :param: The SQL query (string)
+    :param: The query parameters (tuple)
+    :returns: All the rows returned by the query
+    """
+
+    try:
+
+        return _fetchall(get_postgres_connection(db_connector_address), query, params)
+
+    except _dropped_connection_errors() as e:
+
+        sys.stderr.write("%s - postgres_query():WARNING: %s - reconnecting\n"
+                         % (datetime.datetime.now().replace(microsecond = 0),e))
+
+        close_postgres_connection(db_connector_address)
+
+        return _fetchall(get_postgres_connection(db_connector_address), query, params)
+
+def close_postgres_connection(db_connector_address):
+    """Function to drop the shared postgresql connection for an address.
+    :param: The connector address of the postgresql database (string)
+    """
+
+    conn = _connections("postgres").pop(db_connector_address, None)
+
+    if conn is not None:
+        _close_quietly(conn)
+
+def close_all():
+    """Function to close every shared connection, of every thread. """
+
+    with _lock:
+
+        for thread, connections in _thread_connections:
+
+            for conn in connections.values():
+                _close_quietly(conn)
+
+            connections.clear()
+
+        _couchdb_servers.clear()
+
+def _connections(kind):
+    """Return the {address: connection} dictionary of this thread for a kind of backend. """
+
+    if not hasattr(_local, kind):
+
+        connections = {}
+
+        setattr(_local, kind, connections)
+
+        with _lock:
+            _close_ended_threads()
+            _thread_connections.append((threading.current_thread(), connections))
+
+    return getattr(_local, kind)
+
+def _close_ended_threads():
+    """Close and forget the connections of the threads that have ended (with _lock held). """
+
+    for thread, connections in _thread_connections:
+
+        if not thread.is_alive():
+
+            for conn in connections.values():
+                _close_quietly(conn)
+
+            connections.clear()
+
+    _thread_connections[:] = [(thread, connections) for thread, connections in _thread_connections
+                              if thread.is_alive()]
+
+def _dropped_connection_errors():
+    """Return the exceptions of a dropped postgresql connection. """
+
+    try:
+        import psycopg2
+    except ImportError:
+        return ()
+
+    return (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+def _fetchall(conn, query, params):
+    """Run a query on a connection and return all its rows. """
+
+    curr = conn.cursor()
+
+    try:
+        curr.execute(query, params)
+        return curr.fetchall()
+    finally:
+        curr.close()
+
+def _close_quietly(connector):
+    """Close a connection, ignoring errors from a dead connection. """
+
+    for name in ("close", "disconnect"):
+
+        if hasattr(connector, name):
+
+            try:
+                getattr(connector, name)()
+            except Exception:
+                pass
+
+            return
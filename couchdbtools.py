@@ -9,10 +9,13 @@ Author: Mark Stringer
 Last update: 2017-05-23
 """
 
-import couchdb
 import json
 import os
+import rsmetrics
+import rsfixtures
 
+@rsmetrics.timed("couchdb.get_dict")
+@rsfixtures.couchdb_run
 def getCouchDBDict(server,runNumber):
     dqDB = server["data-quality"]
     data = None
@@ -22,3 +25,60 @@ def getCouchDBDict(server,runNumber):
             data = dqDB.get(runDocId)
             return data
 
+@rsmetrics.timed("couchdb.view")
+@rsfixtures.couchdb_range
+def getCouchDBDicts(server, firstRun, lastRun, pageSize=200, cache=None):
+    """Fetch the DQHL documents for a whole run range in one keyed query.
+    If a cache is given only the documents whose _rev changed since they
+    were cached are downloaded.
+    :param: The couchdb server
+    :param: The first run number of the range (int)
+    :param: The last run number of the range (int)
+    :param: The number of view rows requested per page
+    :param: The rscache.RunCache to read through (optional)
+    :returns: A dictionary run number -> DQHL document for the runs
+              that have one
+    """
+    dqDB = server["data-quality"]
+    if cache is not None:
+        return _getCachedCouchDBDicts(dqDB, firstRun, lastRun, pageSize, cache)
+    docs = {}
+    for row in dqDB.iterview('_design/data-quality/_view/runs', pageSize,
+                             startkey=firstRun, endkey=lastRun,
+                             include_docs=True):
+        # Keep the first document per run as getCouchDBDict does
+        docs.setdefault(int(row.key), row.doc)
+    return docs
+
+
+def _getCachedCouchDBDicts(dqDB, firstRun, lastRun, pageSize, cache):
+    # Document ids of the runs, without the documents themselves
+    docIds = {}
+    for row in dqDB.iterview('_design/data-quality/_view/runs', pageSize,
+                             startkey=firstRun, endkey=lastRun):
+        docIds.setdefault(int(row.key), row['id'])
+    if not docIds:
+        return {}
+    # Current revisions of those documents
+    revs = {}
+    for row in dqDB.view('_all_docs', keys=list(docIds.values())):
+        if 'value' in row and row.value:
+            revs[row.id] = row.value['rev']
+    docs = {}
+    stale = {}
+    for runNumber, docId in docIds.items():
+        data = cache.get("couchdb", runNumber, "DQHL", revs.get(docId))
+        if data is not None:
+            docs[runNumber] = data
+        else:
+            stale[docId] = runNumber
+    if stale:
+        for row in dqDB.view('_all_docs', keys=list(stale.keys()),
+                             include_docs=True):
+            if row.doc is None:
+                continue
+            runNumber = stale[row.id]
+            docs[runNumber] = row.doc
+            cache.put("couchdb", runNumber, "DQHL", row.doc['_rev'], dict(row.doc))
+    cache.commit()
+    return docs
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+#==================================================================
+#
+# dqhlBatchChecks.py
+#
+# Columnar evaluation of the DQHL Pass/Fail criteria: the flags and
+# check_params of the four DQHL processors of many runs are
+# flattened into one numpy column per field, and every criterion of
+# the dqhl_criteria.json rule table is evaluated for all the runs at
+# once. A single run (dqhlProcChecks.py, dqhltools.processRunRow())
+# is read and evaluated by the same rules compiled into one plain
+# Python function (runChecks())
+#
+#==================================================================
+
+import numpy as np
+
+import dqhlCriteria
+
+# Rule table compiled once, at startup
+defaultCriteria = dqhlCriteria.loadCriteria()
+
+# Processor -> flags copied as they are into columns
+PROC_FLAGS = {
+'dqtriggerproc': ['n100l_trigger_rate', 'esumh_trigger_rate',
+                  'triggerProcMissingGTID', 'triggerProcBitFlipGTID'],
+'dqtimeproc': ['event_rate', 'event_separation', 'retriggers', 'run_header',
+               '10Mhz_UT_comparrison', 'clock_forward'],
+'dqrunproc': ['run_type', 'mc_flag', 'trigger'],
+'dqpmtproc': ['general_coverage', 'crate_coverage', 'panel_coverage']
+}
+
+# Processor -> values read from its check_params and criteria, as
+# Python expressions of the processor results p
+PROC_PARAMS = {
+'dqtriggerproc': [('missing_gtids_count', "len(p['check_params']['missing_gtids']) "
+                                          "if 'missing_gtids' in p['check_params'] else None"),
+                  ('bitflip_gtids_count', "len(p['check_params']['bitflip_gtids']) "
+                                          "if 'bitflip_gtids' in p['check_params'] else None")],
+'dqtimeproc': [('retriggers_value', "p['check_params'].get('retriggers_value')"),
+               ('mean_event_rate', "p['check_params'].get('mean_event_rate')"),
+               ('min_event_rate', "p.get('criteria', {}).get('min_event_rate')")]
+}
+
+def _readers(proc):
+    # Expressions of every value read from a processor:
+    return [(flag, "p.get(%r)" % flag) for flag in PROC_FLAGS[proc]] + PROC_PARAMS.get(proc, [])
+
+# Processor -> (column, function reading its value) of PROC_PARAMS, compiled once
+PARAM_READERS = dict((proc, [(name, eval("lambda p: " + expression)) for name, expression in params])
+                     for proc, params in PROC_PARAMS.items())
+
+def _column(values):
+    # Missing values are NaN, so they fail every comparison:
+    return np.array([np.nan if value is None else value for value in values], dtype = float)
+
+def flattenDocs(docs):
+
+    # One column per processor flag and check_params value:
+    columns = {}
+    checks = [doc['checks'] for doc in docs]
+
+    for proc, flags in PROC_FLAGS.items():
+        procs = [check[proc] for check in checks]
+        for flag in flags:
+            columns[flag] = _column([p.get(flag) for p in procs])
+        for name, read in PARAM_READERS.get(proc, []):
+            columns[name] = _column([read(p) for p in procs])
+
+    return columns
+
+def evaluateColumns(runNumbers, columns, criteria = None):
+
+    # Every criterion of the rule table for all the runs at once:
+    if criteria is None:
+        criteria = defaultCriteria
+    return criteria.evaluate(runNumbers, columns)
+
+def dqhlBatchChecks(runNumbers, docs, criteria = None):
+
+    # Columns and criteria results of the DQHL documents of a batch of runs:
+    columns = flattenDocs(docs)
+    return columns, evaluateColumns(runNumbers, columns, criteria)
+
+# (criteria, names, processors) -> function compiled by runChecks()
+_runChecks = {}
+
+def runChecks(names, procs = None, criteria = None):
+
+    # Function (runNumber, checks) -> values of the named columns and criteria
+    # of one run, given the checks of its DQHL document (or of the processors
+    # procs only). It is compiled once, with the rules as plain Python
+    # comparisons, and runNumber may be None if none of them depend on it:
+    if criteria is None:
+        criteria = defaultCriteria
+    if procs is None:
+        procs = sorted(PROC_FLAGS)
+    key = (criteria, tuple(names), tuple(procs))
+
+    if key not in _runChecks:
+
+        variables = {}
+
+        def variable(name):
+            if name not in variables:
+                if name not in criteria.byName:
+                    raise ValueError("dqhlBatchChecks: %s is not read from %s" % (name, ", ".join(procs)))
+                variables[name] = "v%i" % len(variables)
+            return variables[name]
+
+        # Missing values are NaN, as in the columns:
+        source = ["def check(run, checks):"]
+        for proc in procs:
+            source.append("    p = checks[%r]" % proc)
+            for name, expression in _readers(proc):
+                variables[name] = "v%i" % len(variables)
+                source.append("    %s = %s" % (variables[name], expression))
+                source.append("    if %s is None: %s = NAN" % (variables[name], variables[name]))
+
+        rules, byRun = criteria.runSource(names, variable)
+        if byRun:
+            source.append("    if run is None: raise ValueError(%r)" %
+                          ("dqhlBatchChecks: %s need a run number" % ", ".join(names)))
+        source.extend("    " + line for line in rules)
+        source.append("    return (%s,)" % ", ".join(variable(name) for name in names))
+
+        namespace = {'NAN': float('nan')}
+        exec(compile("\n".join(source) + "\n", "<dqhl checks %s>" % criteria.version, "exec"), namespace)
+        _runChecks[key] = namespace['check']
+
+    return _runChecks[key]
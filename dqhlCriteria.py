@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+#==================================================================
+#
+# dqhlCriteria.py
+#
+# Compiles the DQHL Pass/Fail rule table (dqhl_criteria.json) into
+# numpy evaluators. A criterion has one rule per run range; the rule
+# of each run is found by a range lookup on the sorted rule ranges.
+# New amendments only need a new rule in the table.
+#
+# For a single run the rules are also written out as plain Python
+# comparisons (runSource()), which dqhlBatchChecks.py compiles into
+# one function per set of criteria, so one run costs no more than
+# the hand-written checks did.
+#
+#==================================================================
+
+import os
+import json
+import operator
+
+import numpy as np
+
+DEFAULT_CRITERIA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                     'dqhl_criteria.json')
+
+COMPARISONS = {'==': operator.eq, '!=': operator.ne,
+               '<': operator.lt, '<=': operator.le,
+               '>': operator.gt, '>=': operator.ge}
+
+def _operand(value):
+    # A string names a column or an earlier criterion, anything else is a constant:
+    if isinstance(value, (str, type(u''))):
+        return lambda values: values[value]
+    return lambda values: value
+
+def _compileCondition(condition):
+    if isinstance(condition, dict):
+        if len(condition) != 1 or list(condition)[0] not in ('all', 'any'):
+            raise ValueError("dqhlCriteria: bad condition %s" % condition)
+        combine = np.logical_and if 'all' in condition else np.logical_or
+        parts = [_compileCondition(part) for part in list(condition.values())[0]]
+        def evaluate(values):
+            passed = parts[0](values)
+            for part in parts[1:]:
+                passed = combine(passed, part(values))
+            return passed
+        return evaluate
+    field, comparison, threshold = condition
+    if comparison not in COMPARISONS:
+        raise ValueError("dqhlCriteria: unknown comparison %s" % comparison)
+    compare = COMPARISONS[comparison]
+    left, right = _operand(field), _operand(threshold)
+    return lambda values: compare(left(values), right(values))
+
+def _scalarOperand(value, variable):
+    # Python source of an operand for a single run; variable(name) is the
+    # variable holding a column or criterion:
+    if isinstance(value, (str, type(u''))):
+        return variable(str(value))
+    return repr(value)
+
+def _scalarCondition(condition, variable):
+    # Python source of a condition for a single run:
+    if isinstance(condition, dict):
+        if len(condition) != 1 or list(condition)[0] not in ('all', 'any'):
+            raise ValueError("dqhlCriteria: bad condition %s" % condition)
+        combine = " and " if 'all' in condition else " or "
+        return "(%s)" % combine.join(_scalarCondition(part, variable) for part in list(condition.values())[0])
+    field, comparison, threshold = condition
+    if comparison not in COMPARISONS:
+        raise ValueError("dqhlCriteria: unknown comparison %s" % comparison)
+    return "(%s %s %s)" % (_scalarOperand(field, variable), comparison, _scalarOperand(threshold, variable))
+
+def _names(condition):
+    # Columns and criteria a condition reads:
+    if isinstance(condition, dict):
+        return set().union(*[_names(part) for part in list(condition.values())[0]])
+    return set(str(operand) for operand in (condition[0], condition[2])
+               if isinstance(operand, (str, type(u''))))
+
+def _find(condition, field, comparison):
+    # Threshold of the first [field, comparison, threshold] of a condition:
+    if isinstance(condition, dict):
+        for part in list(condition.values())[0]:
+            threshold = _find(part, field, comparison)
+            if threshold is not None:
+                return threshold
+        return None
+    if condition[0] == field and condition[1] == comparison:
+        return condition[2]
+    return None
+
+class _Criterion(object):
+
+    def __init__(self, name, rules):
+        self.name = name
+        rules = sorted(rules, key = lambda rule: -np.inf if rule['runs'][0] is None else rule['runs'][0])
+        self.first = np.array([-np.inf if rule['runs'][0] is None else rule['runs'][0] for rule in rules])
+        self.last = np.array([np.inf if rule['runs'][1] is None else rule['runs'][1] for rule in rules])
+        if np.any(self.first[1:] <= self.last[:-1]):
+            raise ValueError("dqhlCriteria: overlapping run ranges for %s" % name)
+        self.table = rules
+        self.rules = [_compileCondition({'all': rule['all']}) for rule in rules]
+        self.reads = _names({'all': [{'all': rule['all']} for rule in rules]})
+        self.byRun = len(rules) != 1 or rules[0]['runs'] != [None, None]
+
+    def scalarSource(self, variable):
+        # Statements setting the result of a single run, from its run number run:
+        result = variable(self.name)
+        if not self.byRun:
+            return ["%s = 1 if %s else 0" % (result, _scalarCondition({'all': self.table[0]['all']}, variable))]
+        source = []
+        for rule in self.table:
+            first, last = rule['runs']
+            ranges = ([] if first is None else ["%i <= run" % first]) + \
+                     ([] if last is None else ["run <= %i" % last])
+            source.append("%s %s:" % ("elif" if source else "if", " and ".join(ranges)))
+            source.append("    %s = 1 if %s else 0" % (result, _scalarCondition({'all': rule['all']}, variable)))
+        source.append("else:")
+        source.append("    %s = 0" % result)
+        return source
+
+    def evaluate(self, runNumbers, values):
+        # Range lookup of the rule of each run:
+        index = np.searchsorted(self.first, runNumbers, side = 'right') - 1
+        covered = (index >= 0) & (runNumbers <= self.last[np.maximum(index, 0)])
+        passed = np.zeros(len(runNumbers), dtype = bool)
+        for i, rule in enumerate(self.rules):
+            selected = covered & (index == i)
+            if selected.any():
+                passed |= selected & rule(values)
+        return passed.astype(int)
+
+class DqhlCriteria(object):
+
+    def __init__(self, table):
+        self.version = table.get('version')
+        self.criteria = [_Criterion(criterion['name'], criterion['rules'])
+                         for criterion in table['criteria']]
+        self.names = [criterion.name for criterion in self.criteria]
+        self.byName = dict((criterion.name, criterion) for criterion in self.criteria)
+
+    def evaluate(self, runNumbers, columns):
+        # Every criterion for all the runs at once; the later criteria see the earlier results:
+        runNumbers = np.asarray(runNumbers)
+        values = dict(columns)
+        results = {}
+        with np.errstate(invalid = 'ignore'):
+            for criterion in self.criteria:
+                results[criterion.name] = values[criterion.name] = criterion.evaluate(runNumbers, values)
+        return results
+
+    def threshold(self, name, field, comparison):
+        # Threshold compared with a field by the latest rule of a criterion,
+        # e.g. ('rsMissingGTIDCheckOK', 'missing_gtids_count', '<='):
+        return _find({'all': self.byName[name].table[-1]['all']}, field, comparison)
+
+    def required(self, names):
+        # Criteria needed for the named ones, in evaluation order:
+        needed = set(name for name in names if name in self.byName)
+        for criterion in reversed(self.criteria):
+            if criterion.name in needed:
+                needed.update(name for name in criterion.reads if name in self.byName)
+        return [criterion for criterion in self.criteria if criterion.name in needed]
+
+    def runSource(self, names, variable):
+        # Python statements evaluating the named criteria of one run and the
+        # ones they need, each into variable(name), and whether they depend
+        # on the run number:
+        required = self.required(names)
+        source = []
+        for criterion in required:
+            source.extend(criterion.scalarSource(variable))
+        return source, any(criterion.byRun for criterion in required)
+
+def loadCriteria(path = DEFAULT_CRITERIA_FILE):
+    criteriaFile = open(path)
+    table = json.load(criteriaFile)
+    criteriaFile.close()
+    return DqhlCriteria(table)
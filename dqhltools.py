@@ -12,59 +12,113 @@ Last modified: 2017-05-23
 
 import argparse
 import sys
-import couchdb
 import datetime
 
-import settings
-
 import couchdbtools
+import connectiontools
+import dqhlBatchChecks
+import rsmetrics
 
-from dqhlProcChecks import *
-
+@rsmetrics.timed("dqhl.process_run")
 def processRun(runNumber, data, runlistFile):
 
-    # Unpack validity range and results:
-    run_range = data['run_range']
-    checks = data['checks']
-
-    # Unpack results from the four DQ procs:
-    triggerProc = checks['dqtriggerproc']
-    timeProc = checks['dqtimeproc']
-    runProc = checks['dqrunproc']
-    pmtProc = checks['dqpmtproc']
-
     # Print run results list:
-    runlistFile.write(" %i%i%i%i    | %i%i%i%i   |" % \
-           (rsTriggerProcChecksOK(triggerProc), \
-           modifTimeProcChecksOK(runNumber, timeProc), \
-           modifRunProcChecksOK(runNumber, runProc), \
-           pmtProcChecksOK(pmtProc), \
-           rsTriggerProcChecksOK(triggerProc), timeProcChecksOK(timeProc), \
-           runProcChecksOK(runProc), pmtProcChecksOK(pmtProc)) + \
-                      " %i     %i     %i     |" % \
-           (triggerProc['n100l_trigger_rate'], \
-           triggerProc['esumh_trigger_rate'], \
-           rsMissingGTIDCheckOK(triggerProc)) + \
-                      " %i     %i      %i     %i     " % \
-           (timeProc['event_rate'], timeProc['event_separation'], \
-           rsRetriggerCheckOK(timeProc), timeProc['run_header']) + \
-                      " %i       %i     |" % \
-           (timeProc['10Mhz_UT_comparrison'], 
-           timeProc['clock_forward']) + \
-                      " %i       %i     %i    | %i      %i     %i\n" % \
-           (runProc['run_type'], runProc['mc_flag'], \
-           runProc['trigger'], \
-           pmtProc['general_coverage'], pmtProc['crate_coverage'], \
-           pmtProc['panel_coverage']))
+    runlistFile.write(processRunRow(runNumber, data))
 
     return
 
-def dqhlPassFailList(currentrun,runlistFile):
+def processRunRow(runNumber, data):
+
+    # Format run results list, with the rules of the table compiled for one run:
+    return ROW_FORMAT % tuple(map(int, rowChecks()(runNumber, data['checks'])))
+
+# Format of the DQHL part of a run list row, the values (ints) in the
+# order of rstools.DQHL_FIELDS. %s prints an int as %i does, in a
+# fraction of the time:
+ROW_FORMAT = " %s%s%s%s    | %s%s%s%s   |" + \
+             " %s     %s     %s     |" + \
+             " %s     %s      %s     %s     " + \
+             " %s       %s     |" + \
+             " %s       %s     %s    | %s      %s     %s\n"
+
+# Criteria and flags of the row, in the same order:
+ROW_FIELDS = ['rsTriggerProcChecksOK', 'modifTimeProcChecksOK',
+              'modifRunProcChecksOK', 'pmtProcChecksOK',
+              'rsTriggerProcChecksOK', 'timeProcChecksOK',
+              'runProcChecksOK', 'pmtProcChecksOK',
+              'n100l_trigger_rate', 'esumh_trigger_rate',
+              'rsMissingGTIDCheckOK',
+              'event_rate', 'event_separation',
+              'rsRetriggerCheckOK', 'run_header',
+              '10Mhz_UT_comparrison', 'clock_forward',
+              'run_type', 'mc_flag', 'trigger',
+              'general_coverage', 'crate_coverage',
+              'panel_coverage']
+
+def rowChecks():
+
+    # Values of ROW_FIELDS of one run, the function compiled once:
+    return dqhlBatchChecks.runChecks(ROW_FIELDS)
+
+# Values of a run without DQHL results:
+MISSING_RUN_VALUES = (9,) * 23
+
+@rsmetrics.timed("dqhl.process_runs")
+def processRunValues(runNumbers, docs):
+
+    # Evaluate the DQHL criteria of a batch of runs at once:
+    columns, results = dqhlBatchChecks.dqhlBatchChecks(runNumbers, docs)
+
+    # Values of the run results list of each run:
+    named = dict(columns)
+    named.update(results)
+    fields = [named[name] for name in ROW_FIELDS]
+
+    return [tuple(int(value) for value in values) for values in zip(*[field.tolist() for field in fields])]
+
+def processRunRows(runNumbers, docs):
+
+    # Format run results list of each run of a batch:
+    return [ROW_FORMAT % values for values in processRunValues(runNumbers, docs)]
+
+def missingRunRow():
+
+    # Format run results list with 9 flag:
+    return (" %i%i%i%i    | %i%i%i%i   |" % \
+            (9, 9, 9, 9, 9, 9, 9, 9) + \
+            " %i     %i     %i     |" % \
+            (9, 9, 9) + \
+            " %i     %i      %i     %i     " % \
+            (9, 9, 9, 9) + \
+            " %i       %i     |" % \
+            (9, 9) + \
+            " %i       %i     %i    | %i      %i     %i\n" % \
+            (9, 9, 9, 9, 9, 9))
+
+def dqhlDocuments(firstrun, lastrun, cache = None):
+
+    import settings
+
+    # Download the DQ documents for the whole run range at once:
+    db = connectiontools.get_couchdb_server(settings.COUCHDB_SERVER_HL)
+
+    return couchdbtools.getCouchDBDicts(db, firstrun, lastrun, cache = cache)
+
+def dqhlPassFailList(currentrun, runlistFile, dqhlDocs = None):
+
+    if dqhlDocs is not None:
+
+       # Use the documents fetched by dqhlDocuments():
+       data = dqhlDocs.get(currentrun)
+
+    else:
+
+       import settings
 
-    # Download DQ ratdb table:
-    db = couchdb.Server(settings.COUCHDB_SERVER_HL)
+       # Download DQ ratdb table:
+       db = connectiontools.get_couchdb_server(settings.COUCHDB_SERVER_HL)
 
-    data = couchdbtools.getCouchDBDict(db, currentrun)
+       data = couchdbtools.getCouchDBDict(db, currentrun)
     
     if (data != None):
 
@@ -73,16 +127,7 @@ def dqhlPassFailList(currentrun,runlistFile):
     else:
 
        # Print run results list with 9 flag:
-       runlistFile.write(" %i%i%i%i    | %i%i%i%i   |" % \
-                        (9, 9, 9, 9, 9, 9, 9, 9) + \
-                        " %i     %i     %i     |" % \
-                        (9, 9, 9) + \
-                        " %i     %i      %i     %i     " % \
-                        (9, 9, 9, 9) + \
-                        " %i       %i     |" % \
-                        (9, 9) + \
-                        " %i       %i     %i    | %i      %i     %i\n" % \
-                        (9, 9, 9, 9, 9, 9))
+       runlistFile.write(missingRunRow())
 		
        sys.stderr.write("%s - dqhltools():ERROR: DQHL results not present\n"
                              % (datetime.datetime.now().replace(microsecond = 0))) 
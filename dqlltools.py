@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+""" dqlltools.py
+Compute the DQLL crate checks for a batch of runs at once
+
+The per-crate arrays of the DQLL tables (crate_hv_status_a, crate_hv_dac_a
+and the detector_db_alarms) are stacked into runs x crates matrices and
+the run duration, crate HV status, DAC and HV alarm flags of every run are
+computed with array operations.
+"""
+
+import numpy as np
+
+import rsmetrics
+
+# Runs shorter than this fail the run duration check
+MIN_RUN_DURATION = 1800 # seconds
+
+# detector_db_alarms for power supply A (per crate) and B (crate 16, OWLs)
+ALARMS = ['HV_current_near_zero', 'HV_over_current', 'HV_setpoint_discrepancy']
+
+def _stack(rows, fill):
+    # runs x crates matrix of per-crate arrays, short arrays padded with fill:
+    width = max([len(row) for row in rows] + [0])
+    padded = [list(row) + [fill] * (width - len(row)) for row in rows]
+    return np.array(padded).reshape(len(rows), width)
+
+def _crates(mask):
+    # Failing crate numbers of each run, from a runs x crates mask:
+    runIndex, crates = np.nonzero(mask)
+    return np.split(crates, np.searchsorted(runIndex, np.arange(1, mask.shape[0])))
+
+@rsmetrics.timed("dqll.checks")
+def dqllBatchChecks(dqllTables):
+
+    # Unpack the DQLL tables:
+    nRuns = len(dqllTables)
+    duration = np.array([table['duration_seconds'] for table in dqllTables])
+    version = np.array([table['version'] for table in dqllTables])
+    hasAlarms = version > 3
+
+    statusA = _stack([table['crate_hv_status_a'] for table in dqllTables], True)
+    statusB = np.array([table['crate_16_hv_status_b'] for table in dqllTables])
+    dacA = _stack([table['crate_hv_dac_a'] for table in dqllTables], 1)
+    dacB = np.array([table['crate_16_hv_dac_b'] for table in dqllTables])
+
+    # Duration < 30 minutes:
+    shortRun = duration < MIN_RUN_DURATION
+
+    # Crate HV is OFF (A supply), OWLs are OFF (16B supply):
+    hvOffA = statusA == False
+    hvOffB = statusB == False
+
+    # DAC value is 0 (power supplies A and B):
+    dacZeroA = dacA == 0
+    dacZeroB = dacB == 0
+
+    batch = {'nRuns': nRuns,
+             'hasAlarms': hasAlarms,
+             'shortRun': shortRun,
+             'hvOffA': _crates(hvOffA), 'hvOffB': hvOffB,
+             'dacZeroA': _crates(dacZeroA), 'dacZeroB': dacZeroB}
+
+    # HV alarms only exist for version 4 and later:
+    anyAlarm = np.zeros(nRuns, dtype = bool)
+    for alarm in ALARMS:
+        alarmA = _stack([table['detector_db_alarms'][alarm + '_A'] if withAlarms else []
+                         for table, withAlarms in zip(dqllTables, hasAlarms)], 0) == 1
+        alarmB = np.array([table['detector_db_alarms'][alarm + '_B'] if withAlarms else 0
+                           for table, withAlarms in zip(dqllTables, hasAlarms)]) == 1
+        batch[alarm + '_A'] = _crates(alarmA)
+        batch[alarm + '_B'] = alarmB
+        anyAlarm |= alarmA.any(axis = 1) | alarmB
+
+    # Pass/Fail flags:
+    batch['runduration'] = np.where(shortRun, 0, 1)
+    batch['cratestatus'] = np.where(hvOffA.any(axis = 1) | hvOffB, 0, 1)
+    batch['cratedac'] = np.where(dacZeroA.any(axis = 1) | dacZeroB, 0, 1)
+    batch['cratealarmok'] = np.where(hasAlarms, np.where(anyAlarm, 0, 1), 9)
+
+    return batch
+
+def dqllMessages(batch, i, run):
+
+    # Details of the failed checks of run i of a batch, in the order of the checks:
+    messages = []
+
+    if batch['shortRun'][i]:
+        messages.append("run %i duration is less than 30 minutes" % run)
+
+    for crate in batch['hvOffA'][i]:
+        messages.append("run %i crate %i HV is off" % (run, crate))
+
+    if batch['hvOffB'][i]:
+        messages.append("run %i OWLs HV is off" % run)
+
+    for crate in batch['dacZeroA'][i]:
+        messages.append("run %i crate %i power supply A DAC value is 0" % (run, crate))
+
+    if batch['dacZeroB'][i]:
+        messages.append("run %i crate 16 power supply B DAC value is 0" % run)
+
+    if not batch['hasAlarms'][i]:
+        messages.append("run %i HV alarms not saved in the DQLL table - please check the detector state page on snopl.us" % run)
+        return messages
+
+    for alarm, text in zip(ALARMS, ["a current near zero alarm", "an over current alarm",
+                                    "a setpoint discrepancy alarm"]):
+
+        for crate in batch[alarm + '_A'][i]:
+            messages.append("run %i crate %i has %s" % (run, crate, text))
+
+        if batch[alarm + '_B'][i]:
+            messages.append("run %i crate 16 power supply B has %s" % (run, text))
+
+    return messages
@@ -0,0 +1,96 @@
+"""intervaltools.py
+Sets of run numbers stored as sorted, disjoint [first, last] intervals.
+
+Membership is a bisect on the interval starts, so a set holding wide run
+ranges costs as little as one holding a few runs.
+"""
+import bisect
+
+class RunIntervals(object):
+    """Set of run numbers stored as sorted, disjoint, non-adjacent intervals.
+    :param: Iterable of (first, last) run intervals, both ends included
+    """
+
+    def __init__(self, intervals = ()):
+
+        merged = []
+
+        for first, last in sorted((int(first), int(last)) for first, last in intervals):
+
+            if first > last:
+                continue
+
+            # Merge overlapping and adjacent intervals
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], last)
+            else:
+                merged.append([first, last])
+
+        self.starts = [first for first, last in merged]
+        self.ends = [last for first, last in merged]
+
+    @classmethod
+    def from_runs(cls, runs):
+        """Build the set of a list of run numbers. """
+
+        return cls((run, run) for run in runs)
+
+    def intervals(self):
+        """Return the list of (first, last) intervals. """
+
+        return list(zip(self.starts, self.ends))
+
+    def __contains__(self, run):
+
+        i = bisect.bisect_right(self.starts, run) - 1
+
+        return i >= 0 and run <= self.ends[i]
+
+    def __len__(self):
+
+        return sum(last - first + 1 for first, last in zip(self.starts, self.ends))
+
+    def __iter__(self):
+
+        for first, last in zip(self.starts, self.ends):
+            for run in range(first, last + 1):
+                yield run
+
+    def union(self, other):
+        """Return the union of two sets. """
+
+        return RunIntervals(self.intervals() + other.intervals())
+
+    def exclude(self, runs):
+        """Return the runs of a list that are not in the set, in the same order. """
+
+        return [run for run in runs if run not in self]
+
+def load_run_intervals(path):
+    """Function to read a set of runs from a text file.
+    Each line holds a run number or a 'first-last' range of runs;
+    everything after a '#' is a comment.
+    :param: The path of the file (string)
+    :returns: The RunIntervals of the file
+    """
+
+    intervals = []
+
+    runsfile = open(path)
+
+    for line in runsfile:
+
+        line = line.split('#')[0].strip()
+
+        if not line:
+            continue
+
+        if '-' in line:
+            first, last = line.split('-')
+            intervals.append((int(first), int(last)))
+        else:
+            intervals.append((int(line), int(line)))
+
+    runsfile.close()
+
+    return RunIntervals(intervals)
@@ -1,8 +1,11 @@
 import psycopg2
-import time
+import psycopg2.pool
 import sys
 import argparse
-from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from intervaltools import RunIntervals
+from ratdbcoverage import CoverageIndex
+import rsfixtures
 
 '''
    Author: T. Kaptanoglu
@@ -21,6 +24,18 @@ from datetime import datetime
    gold runs. Use the -g flag to do so:
 
    'python ratdb_tables.py -l 112311 113353 -g'
+
+   With the -s flag the rat database finds all the missing tables in a
+   single query, and only the missing (table, run) pairs come back.
+
+   With '--coverage FILE' the tables are read from a local coverage index
+   (see ratdbcoverage.py), updated with the headers added since its last
+   sync; add --no_sync to not query rat database at all. As with the
+   queries, only the tables starting inside the run range are counted.
+
+   With '--record FILE' the results of all the queries are kept in a
+   fixture archive (see rsfixtures.py) that '--replay FILE' answers them
+   from later, without any database.
 '''
 
 DETECTOR_DB_USER = 'snoplus'
@@ -88,7 +103,7 @@ def list_of_runs(curr, lower, upper):
     return runs
 
 def is_table_in_ratdb(curr, lower, upper, table_name):
-    ''' Returns a run list for runs for a given table '''
+    ''' Returns the runs covered by the validity ranges of a given table '''
 
     curr.execute("SELECT DISTINCT ON (run_begin) run_begin, run_end "
                  "FROM ratdb_header_v2 WHERE run_begin >= %s " 
@@ -97,17 +112,10 @@ def is_table_in_ratdb(curr, lower, upper, table_name):
 
     rows = curr.fetchall()    
 
-    runs = []
-    for brun, erun in rows:
-        for run in range(brun, erun+1):
-            if run in runs:
-                continue
-            runs.append(int(run))
-
-    return runs
+    return RunIntervals(rows)
 
 def is_indexed_table_in_ratdb(curr, lower, upper, table_name, index):
-    ''' Returns a run list of runs for a given indexed table '''
+    ''' Returns the runs of a given indexed table '''
 
     curr.execute("SELECT DISTINCT ON (run_begin) run_begin "
                  "FROM ratdb_header_v2 WHERE run_begin >= %s "
@@ -117,27 +125,90 @@ def is_indexed_table_in_ratdb(curr, lower, upper, table_name, index):
 
     rows = curr.fetchall()    
 
-    runs = []
-    for run in rows:
-        if run[0] in runs:
-            continue
-        runs.append(int(run[0]))
+    return RunIntervals.from_runs(run for run, in rows)
+
+def table_in_ratdb(pool, lower, upper, table_name, index):
+    ''' Returns the runs of a given table, indexed or not, queried on a
+        connection of the pool '''
+
+    conn = pool.getconn()
+    try:
+        curr = conn.cursor()
+        if index is None:
+            tables = is_table_in_ratdb(curr, lower, upper, table_name)
+        else:
+            tables = is_indexed_table_in_ratdb(curr, lower, upper, table_name, index)
+        curr.close()
+    finally:
+        pool.putconn(conn)
+
+    return tables
+
+def missing_runs(runs, tables):
+    ''' Returns the (run, run_type) of the runs not covered by a table '''
+
+    missing = set(tables.exclude(run for run, run_type in runs))
+
+    return [(run, run_type) for run, run_type in runs if run in missing]
+
+def missing_tables_in_ratdb(curr, lower, upper, runs):
+    ''' Returns the (table, run) of the missing critical tables, found by
+        the rat database in a single anti-join of the runs against the headers '''
+
+    # Only the first index of a table is noted as missing; the table
+    # specifying source location is only needed by deployed source runs
+    types = []
+    indices = []
+    source_only = []
+    for table in critical_tables.keys():
+        types.append(table)
+        indices.append(critical_tables[table][0] if critical_tables[table] else None)
+        source_only.append(table == 'CALIB_COMMON_RUN_LEVEL')
+
+    curr.execute("SELECT t.type, r.run "
+                 "FROM unnest(%(runs)s::integer[], %(run_types)s::integer[]) AS r(run, run_type) "
+                 "CROSS JOIN unnest(%(types)s::text[], %(indices)s::text[], "
+                 "%(source_only)s::boolean[]) AS t(type, index, source_only) "
+                 "WHERE (NOT t.source_only OR r.run_type & 8 <> 0) "
+                 "AND NOT EXISTS (SELECT 1 FROM ratdb_header_v2 AS h "
+                 "WHERE h.type = t.type AND h.run_begin >= %(lower)s "
+                 "AND h.run_begin <= %(upper)s AND "
+                 "((t.index IS NULL AND h.run_begin <= r.run AND h.run_end >= r.run) "
+                 "OR (h.index = t.index AND h.run_begin = r.run)))",
+                 {'runs': [int(run) for run, run_type in runs],
+                  'run_types': [int(run_type) for run, run_type in runs],
+                  'types': types, 'indices': indices, 'source_only': source_only,
+                  'lower': lower, 'upper': upper})
 
-    return runs
+    rows = curr.fetchall()
+
+    return set((table, int(run)) for table, run in rows)
 
-def run_length(curr, run):
-    ''' Return the length of a run according to the detector DB '''
+def run_lengths(curr, lower, upper):
+    ''' Return the length of the runs of a run range according to the detector DB '''
 
-    curr.execute("SELECT timestamp, end_timestamp FROM run_state "
-                 "WHERE run = %s", (run,))
+    curr.execute("SELECT run, EXTRACT(EPOCH FROM end_timestamp - timestamp) "
+                 "FROM run_state WHERE run >= %s AND run <= %s", (lower, upper))
     rows = curr.fetchall()
 
-    for timestamp, end_timestamp in rows:
-        d1 = datetime.strptime(str(timestamp), "%Y-%m-%d %H:%M:%S.%f")
-        t1 = time.mktime(d1.timetuple())
-        d2 = datetime.strptime(str(end_timestamp), "%Y-%m-%d %H:%M:%S.%f")
-        t2 = time.mktime(d2.timetuple())
-        return float(t2 - t1)
+    lengths = {}
+
+    for run, length in rows:
+        # Runs still going on have no end timestamp
+        if length is None:
+            continue
+        lengths[int(run)] = float(length)
+
+    return lengths
+
+def short_run(lengths, run):
+    ''' True for a run under 30 minutes. A run with no known length, still
+    going on or missing from the detector DB, is not counted as short so its
+    missing tables are still listed '''
+
+    length = lengths.get(int(run))
+
+    return length is not None and length/60.0 < 30.0 # in minutes
 
 if __name__=="__main__":
 
@@ -147,20 +218,46 @@ if __name__=="__main__":
     parser.add_argument('--run_length', '-r', action='store_false', help='Look at runs > 30 mins')
     parser.add_argument('--filename', '-f', type=str, default='missing_tables.txt')
     parser.add_argument('--gold', '-g', action='store_true', help='Only look at gold runs')
+    parser.add_argument('--connections', '-c', type=int, default=4,
+                        help='Maximum number of concurrent rat database queries')
+    parser.add_argument('--server_side', '-s', action='store_true',
+                        help='Find all the missing tables in a single rat database query')
+    parser.add_argument('--coverage', type=str,
+                        help='Answer from the local table coverage index of this file, synced first; '
+                             'as with the queries, only tables starting inside the run range count')
+    parser.add_argument('--no_sync', dest='sync', action='store_false',
+                        help='Do not sync the coverage index with rat database')
+    parser.add_argument('--ratdb', type=str,
+                        help='Address of rat database, instead of the collaboration one')
+    parser.add_argument('--detector_db', type=str,
+                        help='Address of the detector database, instead of the collaboration one')
+    parser.add_argument('--record', type=str,
+                        help='Fixture archive to record the database query results in')
+    parser.add_argument('--replay', type=str,
+                        help='Fixture archive to answer the database queries from, offline')
+    parser.add_argument('--replay_latency', type=float, default=0.0,
+                        help='Latency added to every replayed query in seconds')
     args = parser.parse_args()
 
     if not args.upper or not args.lower:
         print "Provide both an upper and lower run range."
         sys.exit()
 
+    if args.record:
+        rsfixtures.record(args.record)
+    elif args.replay:
+        rsfixtures.replay(args.replay, args.replay_latency)
+
     # Connect to detector database
-    dconn = psycopg2.connect('postgresql://%s:%s@%s:%i/%s' %
-                             (DETECTOR_DB_USER, DETECTOR_DB_PASS,
-                              DETECTOR_DB_HOST, DETECTOR_DB_PORT,
-                              DETECTOR_DB_NAME))
+    dconn = rsfixtures.connect(psycopg2.connect, args.detector_db or
+                               'postgresql://%s:%s@%s:%i/%s' %
+                               (DETECTOR_DB_USER, DETECTOR_DB_PASS,
+                                DETECTOR_DB_HOST, DETECTOR_DB_PORT,
+                                DETECTOR_DB_NAME))
     dcurr = dconn.cursor()
 
     all_runs = list_of_runs(dcurr, args.lower, args.upper)
+    lengths = run_lengths(dcurr, args.lower, args.upper)
     gold_runs = list_of_gold_runs(dcurr, args.lower, args.upper)
 
     # Either check just gold runs or all physics/deployed source runs
@@ -170,46 +267,81 @@ if __name__=="__main__":
     else:
         runs = all_runs
 
-    # Connect to rat database
-    conn = psycopg2.connect('postgresql://%s:%s@%s:%i/%s' %
-                             (RATDB_USER, RATDB_PASS,
-                              RATDB_HOST, RATDB_PORT,
-                              RATDB_NAME))
-    curr = conn.cursor()
+    # Pool of connections to rat database
+    pool = rsfixtures.connection_pool(psycopg2.pool.ThreadedConnectionPool, 0, args.connections,
+                                      args.ratdb or
+                                      'postgresql://%s:%s@%s:%i/%s' %
+                                      (RATDB_USER, RATDB_PASS,
+                                       RATDB_HOST, RATDB_PORT,
+                                       RATDB_NAME))
 
     f = open(args.filename,"w")
 
     print "Finding missing tables between runs", args.lower, args.upper
 
-    # Loop over critical tables
-    for i, table in enumerate(critical_tables.keys()):
-        print "Identifying missing", table, "tables"
-        # Tables with no index
-        if not critical_tables[table]:
-            tables = is_table_in_ratdb(curr, args.lower, args.upper, table)
+    # Let the rat database find all the missing tables at once
+    if args.server_side:
+        conn = pool.getconn()
+        curr = conn.cursor()
+        missing = missing_tables_in_ratdb(curr, args.lower, args.upper, runs)
+        pool.putconn(conn)
+        for table in critical_tables.keys():
+            print "Identifying missing", table, "tables"
             for run, run_type in runs:
-                if run not in tables:
+                if (table, int(run)) not in missing:
+                    continue
+                # Skip runs under 30 minutes, but not for the table specifying source location
+                if table != 'CALIB_COMMON_RUN_LEVEL':
+                    if(args.run_length and short_run(lengths, run)):
+                        continue
+                f.write(str(table) + ' ' + str(run) +'\n')
+    else:
+        queries = []
+        for table in critical_tables.keys():
+            for index in critical_tables[table] or [None]:
+                queries.append((table, index))
+        # Read the tables from the local coverage index, updated with the new headers
+        if args.coverage:
+            coverage_index = CoverageIndex(args.coverage, critical_tables.keys())
+            if args.sync:
+                conn = pool.getconn()
+                curr = conn.cursor()
+                print "Synced", coverage_index.sync(curr), "new headers"
+                pool.putconn(conn)
+                coverage_index.save()
+            coverage = dict((query, coverage_index.coverage(query[0], query[1], args.lower, args.upper))
+                            for query in queries)
+        # Query all the critical tables concurrently, at most one query per connection
+        else:
+            threads = ThreadPool(args.connections)
+            coverage = dict(zip(queries, threads.map(
+                lambda query: table_in_ratdb(pool, args.lower, args.upper, *query), queries)))
+            threads.close()
+
+        # Loop over critical tables
+        for i, table in enumerate(critical_tables.keys()):
+            print "Identifying missing", table, "tables"
+            # Tables with no index
+            if not critical_tables[table]:
+                tables = coverage[(table, None)]
+                for run, run_type in missing_runs(runs, tables):
                     # Skip runs under 30 minutes
-                    runlength = run_length(dcurr, run)/60.0 # in minutes
-                    if(args.run_length and runlength < 30.0):
+                    if(args.run_length and short_run(lengths, run)):
                         continue
                     f.write(table + ' ' + str(run) +'\n')
-            continue
-        # Tables with an index
-        for j, index in enumerate(critical_tables[table]):
-            tables = is_indexed_table_in_ratdb(curr, args.lower, args.upper, table, index)  
-            for run, run_type in runs:
-                # Treat the table specifying source location specially
-                if table == 'CALIB_COMMON_RUN_LEVEL' and run_type & 0x8:
-                    # Note not skipping runs under 30 minutes
-                    if run not in tables:
+                continue
+            # Tables with an index
+            for j, index in enumerate(critical_tables[table]):
+                tables = coverage[(table, index)]
+                for run, run_type in missing_runs(runs, tables):
+                    # Treat the table specifying source location specially
+                    if table == 'CALIB_COMMON_RUN_LEVEL' and run_type & 0x8:
+                        # Note not skipping runs under 30 minutes
                         if j == 0: # Just note the missing table once
                             f.write(str(table) + ' ' + str(run) +'\n')
-                elif table != 'CALIB_COMMON_RUN_LEVEL':
-                    if run not in tables:
+                    elif table != 'CALIB_COMMON_RUN_LEVEL':
                         # Skip runs under 30 minutes
-                        runlength = run_length(dcurr, run)/60.0 # in minutes
-                        if(args.run_length and runlength < 30.0):
+                        if(args.run_length and short_run(lengths, run)):
                             continue
                         if j == 0:
                             f.write(str(table) + ' ' + str(run) +'\n')
@@ -217,5 +349,5 @@ if __name__=="__main__":
     print "Missing tables written to", args.filename
     f.close()
     dconn.close()
-    conn.close()
+    pool.closeall()
 
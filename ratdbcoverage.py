@@ -0,0 +1,223 @@
+"""ratdbcoverage.py
+Local index of the runs covered by the RATDB tables.
+
+Every table type keeps the validity ranges of its headers, and every index of
+a table type a bit array with one bit per run, persisted to disk (the bits
+packed). The index keeps the key of the last ratdb_header_v2 row it has seen,
+so a sync only reads the headers added since then. Coverage questions about a
+[lower, upper] run range are then answered without touching the rat database,
+with the headers whose run_begin is inside that range only, as
+ratdb_tables.is_table_in_ratdb and ratdb_tables.is_indexed_table_in_ratdb
+query them:
+
+- (type, None) covers every run of the [run_begin, run_end] ranges of the
+  headers of that type, whatever their index
+- (type, index) covers the run_begin of the headers of that type and index
+
+A run covered only by a header starting before lower is therefore not
+covered. Of the headers of a type starting at the same run, the longest
+range counts, as in the single query of ratdb_tables.missing_tables_in_ratdb.
+"""
+import os
+
+import numpy as np
+
+DEFAULT_COVERAGE_PATH = os.path.join(os.path.expanduser("~"), ".ratdbcoverage.npz")
+
+# Validity ranges are clipped to this run: open-ended ranges would
+# otherwise cost one bit per possible run number
+MAX_RUN = 1 << 20
+
+# Version of the index file, an index written by another version is rebuilt
+INDEX_VERSION = 2
+
+# Number of headers read per query during a sync
+SYNC_PAGE_SIZE = 100000
+
+SYNC_QUERY = ("SELECT key, type, index, run_begin, run_end FROM ratdb_header_v2 "
+              "WHERE key > %s AND type = ANY(%s) ORDER BY key LIMIT %s")
+
+class RunBitmap(object):
+    """Set of run numbers stored as one boolean per run.
+    :param: numpy boolean array, True for the runs in the set
+    """
+
+    def __init__(self, bits):
+
+        self.bits = bits
+
+    def __contains__(self, run):
+
+        return 0 <= run < len(self.bits) and bool(self.bits[run])
+
+    def __len__(self):
+
+        return int(np.count_nonzero(self.bits))
+
+    def exclude(self, runs):
+        """Return the runs of a list that are not in the set, in the same order. """
+
+        runs = np.asarray(list(runs), dtype = np.int64)
+
+        inside = (runs >= 0) & (runs < len(self.bits))
+
+        covered = np.zeros(len(runs), dtype = bool)
+        covered[inside] = self.bits[runs[inside]]
+
+        return [int(run) for run in runs[~covered]]
+
+class CoverageIndex(object):
+    """Per table validity ranges and per index coverage bit arrays of the rat database.
+    :param: The path of the index file (string)
+    :param: The table types to index (list of strings)
+    """
+
+    def __init__(self, path = DEFAULT_COVERAGE_PATH, types = ()):
+
+        self.path = path
+        self.types = sorted(types)
+        self.last_key = 0
+        self.ranges = {}
+        self.bitmaps = {}
+
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+
+        stored = np.load(self.path)
+
+        # Another version or set of table types needs a full sync
+        if 'version' not in stored.files or int(stored['version']) != INDEX_VERSION:
+            return
+
+        if sorted(stored['types'].tolist()) != self.types:
+            return
+
+        self.last_key = int(stored['last_key'])
+
+        for i, table in enumerate(stored['tables'].tolist()):
+            self.ranges[table] = stored['ranges_%i' % i]
+
+        for i, name in enumerate(stored['names'].tolist()):
+            table, index = name.split('/', 1)
+            length = int(stored['lengths'][i])
+            self.bitmaps[(table, index)] = np.unpackbits(stored['bits_%i' % i])[:length].astype(bool)
+
+    def save(self):
+        """Write the index to its file, atomically. """
+
+        tables = sorted(self.ranges)
+        keys = sorted(self.bitmaps)
+
+        arrays = {'version': np.array(INDEX_VERSION, dtype = np.int64),
+                  'types': np.array(self.types, dtype = str),
+                  'last_key': np.array(self.last_key, dtype = np.int64),
+                  'tables': np.array(tables, dtype = str),
+                  'names': np.array(["%s/%s" % key for key in keys], dtype = str),
+                  'lengths': np.array([len(self.bitmaps[key]) for key in keys], dtype = np.int64)}
+
+        for i, table in enumerate(tables):
+            arrays['ranges_%i' % i] = self.ranges[table]
+
+        for i, key in enumerate(keys):
+            arrays['bits_%i' % i] = np.packbits(self.bitmaps[key])
+
+        indexfile = open(self.path + ".tmp", 'wb')
+        np.savez_compressed(indexfile, **arrays)
+        indexfile.close()
+
+        os.rename(self.path + ".tmp", self.path)
+
+    def _bitmap(self, key, length):
+
+        bits = self.bitmaps.get(key)
+
+        if bits is None:
+            bits = self.bitmaps[key] = np.zeros(length, dtype = bool)
+        elif len(bits) < length:
+            bits = self.bitmaps[key] = np.concatenate([bits, np.zeros(length - len(bits), dtype = bool)])
+
+        return bits
+
+    def add(self, headers):
+        """Add (type, index, run_begin, run_end) headers to the coverage. """
+
+        ranges = {}
+        begins = {}
+
+        for table, index, run_begin, run_end in headers:
+            run_begin = min(int(run_begin), MAX_RUN - 1)
+            run_end = min(int(run_end), MAX_RUN - 1)
+            ranges.setdefault(table, []).append((run_begin, run_end))
+            if index:
+                begins.setdefault((table, index), []).append(run_begin)
+
+        for table, rows in ranges.items():
+            rows = np.array(rows, dtype = np.int64).reshape(-1, 2)
+            if table in self.ranges:
+                rows = np.concatenate([self.ranges[table], rows])
+            # One (run_begin, longest run_end) row per run_begin, in run_begin order
+            rows = rows[np.lexsort((rows[:, 1], rows[:, 0]))]
+            last = np.append(rows[1:, 0] != rows[:-1, 0], True)
+            self.ranges[table] = rows[last]
+
+        for key, runs in begins.items():
+            runs = np.array(runs, dtype = np.int64)
+            self._bitmap(key, int(runs.max()) + 1)[runs] = True
+
+    def sync(self, curr):
+        """Add the headers written to the rat database since the last sync.
+        :param: A cursor of the rat database
+        :returns: The number of headers read
+        """
+
+        count = 0
+
+        while True:
+            curr.execute(SYNC_QUERY, (self.last_key, self.types, SYNC_PAGE_SIZE))
+            rows = curr.fetchall()
+
+            if not rows:
+                break
+
+            self.add((table, index, run_begin, run_end) for key, table, index, run_begin, run_end in rows)
+            self.last_key = max(self.last_key, max(int(row[0]) for row in rows))
+
+            count += len(rows)
+
+            if len(rows) < SYNC_PAGE_SIZE:
+                break
+
+        return count
+
+    def coverage(self, table, index = None, lower = 0, upper = MAX_RUN - 1):
+        """Return the RunBitmap of the runs covered by a table, or an index of a
+        table, according to the headers starting in a run range.
+        :param: The table type (string)
+        :param: The index of the table (string, None for any index)
+        :param: The lower and upper run of the range (int)
+        """
+
+        lower = max(int(lower), 0)
+        upper = min(int(upper), MAX_RUN - 1)
+
+        if index is not None:
+            bits = self.bitmaps.get((table, index), np.zeros(0, dtype = bool))[:upper + 1].copy()
+            bits[:lower] = False
+            return RunBitmap(bits)
+
+        rows = self.ranges.get(table, np.zeros((0, 2), dtype = np.int64))
+        rows = rows[(rows[:, 0] >= lower) & (rows[:, 0] <= upper) & (rows[:, 1] >= rows[:, 0])]
+
+        if not len(rows):
+            return RunBitmap(np.zeros(0, dtype = bool))
+
+        # The runs of all the ranges at once, from the running sum of +1 at
+        # every run_begin and -1 after every run_end
+        length = int(rows[:, 1].max()) + 1
+        steps = np.zeros(length + 1, dtype = np.int64)
+        np.add.at(steps, rows[:, 0], 1)
+        np.add.at(steps, rows[:, 1] + 1, -1)
+
+        return RunBitmap(np.cumsum(steps[:-1]) > 0)
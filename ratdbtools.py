@@ -7,12 +7,45 @@ Author: Gersende Prior
 Uses the RATDB methods from examples by F. Descamps/N. Barros
 """
 import sys
+import json
 import subprocess
 import datetime
 import time
 
-from rat import ratdb
+import connectiontools
+import rsmetrics
+import rsfixtures
 
+# Number of runs retrieved per bulk query by get_tables()
+RUN_CHUNK_SIZE = 500
+
+# Latest pass of every table valid for each run of a list of runs
+BULK_TABLES_QUERY = ("SELECT DISTINCT ON (r.run, h.type) r.run, h.type, d.data "
+                     "FROM unnest(%s) AS r(run) "
+                     "INNER JOIN ratdb_header_v2 AS h ON h.type = ANY(%s) "
+                     "AND h.run_begin <= r.run AND h.run_end >= r.run "
+                     "INNER JOIN ratdb_data_v2 AS d ON d.key = h.key "
+                     "ORDER BY r.run, h.type, h.pass DESC")
+
+# Version (header key and pass) of the latest table valid for each run
+BULK_HEADERS_QUERY = ("SELECT DISTINCT ON (r.run, h.type) r.run, h.type, h.key, h.pass "
+                      "FROM unnest(%s) AS r(run) "
+                      "INNER JOIN ratdb_header_v2 AS h ON h.type = ANY(%s) "
+                      "AND h.run_begin <= r.run AND h.run_end >= r.run "
+                      "ORDER BY r.run, h.type, h.pass DESC")
+
+# Table data for a list of header keys
+BULK_DATA_QUERY = "SELECT key, data FROM ratdb_data_v2 WHERE key = ANY(%s)"
+
+def connector_address(db_address, db_host, db_username, db_password, db_name, db_port):
+    """Function to build the address of the postgresql ratdb database.
+    :returns: The connector address (string)
+    """
+
+    return db_address+"://"+db_username+":"+db_password+"@"+db_host+":"+str(db_port)+"/"+db_name
+
+@rsmetrics.timed("ratdb.get_table")
+@rsfixtures.ratdb_table
 def get_table(runnumber, tablename, db_address, db_host, db_username, db_password,db_name,db_port): 
     """Function to retrieve a table from the postgresql ratdb database. 
     :param: The run number (string)
@@ -24,12 +57,10 @@ def get_table(runnumber, tablename, db_address, db_host, db_username, db_passwor
     :returns: True and the table for the specified run number if it exists
     """
 
-    db_connector_address = db_address+"://"+db_username+":"+db_password+"@"+db_host+":"+str(db_port)+"/"+db_name
+    db_connector_address = connector_address(db_address, db_host, db_username, db_password, db_name, db_port)
 
     try:
-        db = ratdb.RATDBConnector(db_connector_address)
-
-        result = db.fetch(obj_type = tablename, run = runnumber)
+        result = connectiontools.ratdb_fetch(db_connector_address, obj_type = tablename, run = runnumber)
 
         if not len(result):
 
@@ -49,3 +80,125 @@ def get_table(runnumber, tablename, db_address, db_host, db_username, db_passwor
         sys.stderr.write("%s - get_table():ERROR: %s\n"
                          % (datetime.datetime.now().replace(microsecond = 0),e))
         sys.exit(1)
+
+def _decode(data):
+    """Decode the data column: json columns are decoded by psycopg2, text ones are not. """
+
+    if not isinstance(data, dict):
+        data = json.loads(data)
+
+    return data
+
+@rsmetrics.timed("ratdb.postgres")
+@rsfixtures.ratdb_chunk
+def _fetch_chunk(db_connector_address, chunk, tablenames):
+    """Return {(run, table name): table} for the tables found for a chunk of runs. """
+
+    rows = connectiontools.postgres_query(db_connector_address, BULK_TABLES_QUERY,
+                                          (chunk, list(tablenames)))
+
+    found = {}
+    for run, tablename, data in rows:
+        found[(run, tablename)] = _decode(data)
+
+    return found
+
+@rsmetrics.timed("ratdb.postgres_cached")
+@rsfixtures.ratdb_chunk
+def _fetch_chunk_cached(db_connector_address, chunk, tablenames, cache):
+    """Same as _fetch_chunk() but only downloads the tables whose version is not in the cache. """
+
+    headers = connectiontools.postgres_query(db_connector_address, BULK_HEADERS_QUERY,
+                                             (chunk, list(tablenames)))
+
+    found = {}
+    stale = {}
+    for run, tablename, key, passnumber in headers:
+
+        version = "%s:%s" % (key, passnumber)
+
+        table = cache.get("ratdb", run, tablename, version)
+
+        if table is not None:
+            found[(run, tablename)] = table
+        else:
+            stale.setdefault(key, []).append((run, tablename, version))
+
+    if stale:
+
+        rows = connectiontools.postgres_query(db_connector_address, BULK_DATA_QUERY,
+                                              (list(stale.keys()),))
+
+        for key, data in rows:
+
+            data = _decode(data)
+
+            for run, tablename, version in stale[key]:
+
+                found[(run, tablename)] = data
+
+                cache.put("ratdb", run, tablename, version, data)
+
+    cache.commit()
+
+    return found
+
+@rsmetrics.timed("ratdb.get_tables")
+def get_tables(runnumbers, tablenames, db_address, db_host, db_username, db_password, db_name, db_port,
+               chunk_size = RUN_CHUNK_SIZE, cache = None):
+    """Function to retrieve several tables for a list of runs from the postgresql ratdb database.
+    The runs are retrieved in bulk queries of chunk_size runs.
+    If a cache is given only the tables that changed since they were cached are downloaded.
+    :param: The run numbers (list of int)
+    :param: The table names (e.g. ["RUN", "DQLL"])
+    :param: The address of the postgresql database (string)
+    :param: The hostname for the postgresql database (string).
+    :param: The read-mode username for the postgresql database (string).
+    :param: The read-mode password for the postgresql database (string).
+    :param: The number of runs per bulk query
+    :param: The rscache.RunCache to read through (optional)
+    :returns: A dictionary run number -> {table name: (found, table)} where
+              (found, table) is what get_table() returns for that run and table
+    """
+
+    db_connector_address = connector_address(db_address, db_host, db_username, db_password, db_name, db_port)
+
+    runnumbers = [int(run) for run in runnumbers]
+
+    tables = {}
+
+    try:
+
+        for i in range(0, len(runnumbers), chunk_size):
+
+            chunk = runnumbers[i:i + chunk_size]
+
+            if cache is not None:
+                found = _fetch_chunk_cached(db_connector_address, chunk, tablenames, cache)
+            else:
+                found = _fetch_chunk(db_connector_address, chunk, tablenames)
+
+            for run in chunk:
+
+                tables[run] = {}
+
+                for tablename in tablenames:
+
+                    if (run, tablename) in found:
+
+                        tables[run][tablename] = (True, found[(run, tablename)])
+
+                    else:
+
+                        sys.stderr.write("%s - get_tables():ERROR:cannot find %s.ratb table for run %i\n"
+                                         % (datetime.datetime.now().replace(microsecond = 0),tablename,run))
+
+                        tables[run][tablename] = (False, "none")
+
+        return tables
+
+    except Exception as e:
+
+        sys.stderr.write("%s - get_tables():ERROR: %s\n"
+                         % (datetime.datetime.now().replace(microsecond = 0),e))
+        sys.exit(1)
@@ -0,0 +1,131 @@
+"""rscache.py
+Local on-disk cache of the RUN, DQLL and DQHL documents read by the Run
+Selection checks.
+
+Documents are stored zlib-compressed in a SQLite file, keyed by backend,
+run number and table type, together with the version they were read at
+(RATDB header key and pass, CouchDB _rev). A cached document is only
+returned while that version is still the current one. The least recently
+used documents are evicted once the cache grows past its size limit.
+"""
+import os
+import json
+import zlib
+import time
+import sqlite3
+import threading
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".rscache.sqlite")
+DEFAULT_CACHE_SIZE = 2 * 1024 * 1024 * 1024 # bytes
+
+class RunCache(object):
+    """Read-through cache of run documents.
+    :param: The path of the SQLite cache file (string)
+    :param: The maximum size of the cached documents (bytes)
+    :param: If True cached documents are ignored (but refreshed)
+    """
+
+    def __init__(self, path = DEFAULT_CACHE_PATH, max_bytes = DEFAULT_CACHE_SIZE, refresh = False):
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS documents ("
+                         "source TEXT NOT NULL, run INTEGER NOT NULL, "
+                         "kind TEXT NOT NULL, version TEXT NOT NULL, "
+                         "data BLOB NOT NULL, size INTEGER NOT NULL, "
+                         "atime REAL NOT NULL, "
+                         "PRIMARY KEY (source, run, kind))")
+        self._db.execute("CREATE INDEX IF NOT EXISTS documents_atime "
+                         "ON documents (atime)")
+        self._db.commit()
+
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) "
+                                      "FROM documents").fetchone()[0]
+
+    def get(self, source, run, kind, version):
+        """Return the cached document, or None if it is not cached at this version.
+        :param: The backend the document comes from (e.g. "ratdb", "couchdb")
+        :param: The run number (int)
+        :param: The table type (e.g. RUN, DQLL, DQHL)
+        :param: The current version of the document (string)
+        """
+
+        if self.refresh:
+            return None
+
+        with self._lock:
+
+            row = self._db.execute("SELECT version, data FROM documents WHERE "
+                                   "source = ? AND run = ? AND kind = ?",
+                                   (source, run, kind)).fetchone()
+
+            if row is None or row[0] != str(version):
+                return None
+
+            self._db.execute("UPDATE documents SET atime = ? WHERE "
+                             "source = ? AND run = ? AND kind = ?",
+                             (time.time(), source, run, kind))
+
+        return json.loads(zlib.decompress(row[1]).decode("utf-8"))
+
+    def put(self, source, run, kind, version, document):
+        """Store a document at a version, replacing any older version.
+        :param: The backend the document comes from (e.g. "ratdb", "couchdb")
+        :param: The run number (int)
+        :param: The table type (e.g. RUN, DQLL, DQHL)
+        :param: The version of the document (string)
+        :param: The document (dict)
+        """
+
+        data = zlib.compress(json.dumps(document).encode("utf-8"))
+
+        with self._lock:
+
+            row = self._db.execute("SELECT size FROM documents WHERE "
+                                   "source = ? AND run = ? AND kind = ?",
+                                   (source, run, kind)).fetchone()
+
+            if row is not None:
+                self._size -= row[0]
+
+            self._db.execute("INSERT OR REPLACE INTO documents VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?)",
+                             (source, run, kind, str(version),
+                              sqlite3.Binary(data), len(data), time.time()))
+
+            self._size += len(data)
+
+    def commit(self):
+        """Evict the least recently used documents past the size limit and save. """
+
+        with self._lock:
+
+            if self._size > self.max_bytes:
+
+                rows = self._db.execute("SELECT source, run, kind, size FROM documents "
+                                        "ORDER BY atime ASC").fetchall()
+
+                for source, run, kind, size in rows:
+
+                    if self._size <= self.max_bytes:
+                        break
+
+                    self._db.execute("DELETE FROM documents WHERE "
+                                     "source = ? AND run = ? AND kind = ?",
+                                     (source, run, kind))
+
+                    self._size -= size
+
+            self._db.commit()
+
+    def close(self):
+        """Save and close the cache file. """
+
+        self.commit()
+
+        self._db.close()
@@ -10,366 +10,674 @@ Author: Gersende Prior
 
 import argparse
 import sys
-import subprocess
-import tempfile
 import os
+import shutil
 import rstools
 import ratdbtools
 import dqhltools
-import math
-import array
-import dateutil
+import dqlltools
+import connectiontools
+import rscache
+import rspipeline
+import rslog
+import rsmetrics
+import rstrace
+import rsoutput
+import rsfixtures
+import time
+import intervaltools
 import datetime
+import threading
 
-import settings
+# Run type bit masks
+PHYSICS_RUN_MASK = 0x4 # bit 2
 
-from pprint import pprint
-from dateutil import parser
+# Detector State bit masks
+DCR_ACTIVITY_MASK = 0x200000 # bit 21
+COMP_COIL_OFF_MASK = 0x400000 # bit 22
+PMT_OFF_MASK = 0x800000 # bit 23
+SLASSAY_MASK = 0x4000000 # bit 26
+UNUSUAL_ACTIVITY_MASK = 0x8000000 # bit 2
 
-# Check if the rat environment is set
-if "RATROOT" not in os.environ:
-    print "--- dqll(): please set the RATROOT environment variable"
-    sys.exit()
+# Runs that do not exist in ORCA
+SKIPPED_RUNS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "skipped_runs.txt")
 
-def main():
-    # Parse the arguments
-    parser = argparse.ArgumentParser()
+# Fetch pool of evaluate_runs(), kept open with its connections between calls
+_fetchpool = None
+_fetchpool_lock = threading.Lock()
 
-    parser.add_argument("-n", dest = "firstrun", help = "First run number to process", type = int, required = True)
-    parser.add_argument("-i", dest = "lastrun", help = "Last run number to process", type = int, required = True)
+# Buffer of the run list file, written a chunk of runs at a time
+RUNLIST_BUFFER_SIZE = 1024 * 1024 # bytes
 
-    args = parser.parse_args()
+# Separator written every 10 runs in the run list (some cosmetics taken from E. Falk)
+SEPARATOR = "-------||-------|------|" + \
+            "------|-------|" + \
+            "-------|--------||----" + \
+            "-----|--------|" + \
+            "-------------------|-----------------------------------------|--------------------|" + \
+            "--------------------\n"
 
-    # Exit if no run numbers supplied
-    if args.firstrun == "0" or args.lastrun == "0":
-    	
-	sys.stderr.write("%s - rscheck():ERROR: please supply a start run number using \'-n\'"
-                             % (datetime.datetime.now().replace(microsecond = 0)))
- 	sys.exit(1)
-   
-    # Run type bit masks	
-    PHYSICS_RUN_MASK = 0x4 # bit 2
-
-    # Detector State bit masks
-    DCR_ACTIVITY_MASK = 0x200000 # bit 21
-    COMP_COIL_OFF_MASK = 0x400000 # bit 22 
-    PMT_OFF_MASK = 0x800000 # bit 23
-    SLASSAY_MASK = 0x4000000 # bit 26
-    UNUSUAL_ACTIVITY_MASK = 0x8000000 # bit 2
+def skipped_run(run):
+    """Return the result of a run that does not exist in ORCA. """
 
-    # Variables for statistics calculation
-    nruns = 0
-    nnotphys = 0
-    ntypeok = 0
-    ndurationok = 0
-    ncratehvok = 0
-    nnohvalarm = 0
+    result = {'run': run, 'skipped': True, 'physics': False, 'row': None, 'record': None, 'messages': []}
 
-    nphysruns = 0
+    rslog.info(result['messages'], "preparing the Run Selection checks for run %s", run)
 
-    # Create run list
-    runlistname = "runlist_{0}-{1}.txt".format(args.firstrun,args.lastrun)
+    rslog.info(result['messages'], "run %s does not exist in ORCA/detector state database - skipping", run)
 
-    runlist = open(runlistname,'w')
+    return result
 
-    # Write run list header
-    rstools.write_header(runlist)
+def detector_db_skipped_runs(db_connector_address, firstrun, lastrun):
+    """Return the runs of a range missing from the detector DB run_state table.
+    :param: The connector address of the detector database (string)
+    :param: The first run number of the range (int)
+    :param: The last run number of the range (int)
+    :returns: The intervaltools.RunIntervals of the missing runs
+    """
 
-    # Counter for some cosmetics below
-    p = 0
+    rows = connectiontools.postgres_query(db_connector_address,
+                                          "SELECT run FROM run_state WHERE run >= %s AND run <= %s",
+                                          (firstrun, lastrun))
+
+    existing = intervaltools.RunIntervals.from_runs(run for run, in rows)
+
+    return intervaltools.RunIntervals.from_runs(existing.exclude(range(firstrun, lastrun + 1)))
+
+def evaluate_run_type(run, rundatatuple):
+    """Perform the RUN table checks of a run.
+    :param: The run number (int)
+    :param: The (found, table) tuple of the RUN table
+    :returns: A dictionary with the run type flag and the messages to print,
+              'physics' telling whether the run goes in the run list
+    """
+
+    result = {'run': run, 'skipped': False, 'physics': True, 'row': None, 'record': None, 'messages': []}
+
+    messages = result['messages']
+
+    rslog.info(messages, "preparing the Run Selection checks for run %s", run)
+
+    runtype = 1
+
+    # Read RUN.ratdb
+    rundata = rundatatuple[1]
+
+    if rundatatuple[0]:
+
+        runtypemask = rundata['runtype']
+
+        # NOT a physics run
+        if runtypemask & PHYSICS_RUN_MASK != PHYSICS_RUN_MASK:
+
+            rslog.info(messages, "run %i is not a PHYSICS run", run)
+
+            result['physics'] = False
+
+            return result
+
+        # DCR Activity bit set
+        if runtypemask & DCR_ACTIVITY_MASK == DCR_ACTIVITY_MASK:
+
+            rslog.info(messages, "run %i has DCR Activity bit set", run)
+
+            runtype = 0
+
+        # Compensation Coils OFF
+        if runtypemask & COMP_COIL_OFF_MASK == COMP_COIL_OFF_MASK:
+
+            rslog.info(messages, "run %i has Comp Coils OFF", run)
+
+            runtype = 0
+
+        # PMTs OFF
+        if runtypemask & PMT_OFF_MASK == PMT_OFF_MASK:
+
+            rslog.info(messages, "run %i has PMTs OFF", run)
+
+            runtype = 0
+
+        # SLAssay
+        if runtypemask & SLASSAY_MASK == SLASSAY_MASK:
+
+            rslog.info(messages, "run %i has SLAssay", run)
+
+            runtype = 0
+
+        # Unusual Activity
+        if runtypemask & UNUSUAL_ACTIVITY_MASK == UNUSUAL_ACTIVITY_MASK:
+
+            rslog.info(messages, "run %i has Unusual Activity bit set", run)
+
+            runtype = 0
+
+    else:
+
+        runtype = 9
+
+    result['runtype'] = runtype
+
+    return result
+
+def evaluate_dqll_runs(results, dqlltables):
+    """Perform the DQLL checks of a batch of runs at once.
+    :param: The evaluate_run_type() results of the runs
+    :param: The DQLL tables of the runs (same order)
+    """
+
+    batch = dqlltools.dqllBatchChecks(dqlltables)
+
+    for i, result in enumerate(results):
+
+        rslog.details(result['messages'], dqlltools.dqllMessages, batch, i, result['run'])
+
+        for flag in ['runduration', 'cratestatus', 'cratedac', 'cratealarmok']:
+            result[flag] = int(batch[flag][i])
+
+def format_row(result, dqhlvalues):
+    """Format the run list row and the record of a run.
+    :param: The result of the run, with all its DQLL flags
+    :param: The DQHL values of the run, or None if the run has no DQHL document
+    """
+
+    run = result['run']
+
+    runtype = result['runtype']
+    runduration = result['runduration']
+    cratestatus = result['cratestatus']
+    cratedac = result['cratedac']
+    cratealarmok = result['cratealarmok']
+
+    # Run info for the run list
+    row = str(run) + ' || ' + \
+          str(runtype) + str(runduration) + str(cratestatus) + str(cratedac) + str(cratealarmok) + ' | ' + \
+          str(runtype) + '    | ' + \
+          str(runduration) + '    | ' + \
+          str(cratestatus) + '     | ' + \
+          str(cratedac) + '     | ' + \
+          str(cratealarmok) + '      ||'
+
+    # Results of the HL checks
+    if dqhlvalues is not None:
+
+        row += dqhltools.ROW_FORMAT % dqhlvalues
+
+    else:
+
+        row += dqhltools.missingRunRow()
+
+        dqhlvalues = dqhltools.MISSING_RUN_VALUES
+
+        rslog.error(result['messages'], "dqhltools", "DQHL results not present")
+
+    result['row'] = row
+
+    result['record'] = (run, runtype, runduration, cratestatus, cratedac, cratealarmok) + dqhlvalues
+
+def dqhl_costs(document):
+    """Return the sizes of the variable parts of a DQHL document, which drive
+    the size of the download and of the checks of the run.
+    :param: The DQHL document of the run, or None
+    :returns: A dictionary of span attributes
+    """
+
+    if document is None:
+        return {}
 
-    # Loop over runs from <firstrun> to <lastrun>  
-    for run in range(args.firstrun,args.lastrun + 1):	
+    params = document['checks']['dqtriggerproc']['check_params']
 
-    	sys.stdout.write("%s - rscheck():INFO: preparing the Run Selection checks for run %s\n" 
-     		             % (datetime.datetime.now().replace(microsecond = 0),run))
+    return {'missing_gtids': len(params.get('missing_gtids', [])),
+            'bitflip_gtids': len(params.get('bitflip_gtids', []))}
+
+def chunk_fetchers(cache = None):
+    """Return the functions downloading the tables of a (firstrun, lastrun, runs) chunk of runs.
+    Only the tables of the runs that are not skipped are downloaded from RATDB,
+    the RUN and DQLL tables together in one bulk query.
+    :param: The rscache.RunCache to read through (optional)
+    :returns: A dictionary RATDB/DQHL -> function(chunk)
+    """
+
+    import settings
+
+    def ratdb_fetcher(chunk):
+        with rstrace.span("fetch.ratdb", table = "RUN,DQLL", first = chunk[0], last = chunk[1], runs = len(chunk[2])):
+            return ratdbtools.get_tables(chunk[2], ["RUN", "DQLL"],
+                                         settings.RATDB_ADDRESS, settings.RATDB_HOST,
+                                         settings.RATDB_READ_USER, settings.RATDB_READ_PASSWORD,
+                                         settings.RATDB_NAME, settings.RATDB_PORT, cache = cache)
+
+    def dqhl_fetcher(chunk):
+        with rstrace.span("fetch.couchdb", table = "DQHL", first = chunk[0], last = chunk[1]):
+            return dqhltools.dqhlDocuments(chunk[0], chunk[1], cache)
+
+    return {'RATDB': ratdb_fetcher, 'DQHL': dqhl_fetcher}
+
+@rsmetrics.timed("checks.chunk")
+def evaluate_chunk(chunk, tables):
+    """Perform the checks of each run of a chunk of runs.
+    The DQLL checks of the chunk are done in one batch.
+    :param: The (firstrun, lastrun, runs) chunk, runs being the runs that are not skipped
+    :param: The tables downloaded by the chunk_fetchers() functions
+    :returns: The list of results, in run order, with the check flags, the run
+              list row and record (None if the run is skipped or not a physics
+              run) and the messages to print
+    """
+
+    results = []
+
+    # Runs with a DQLL table and their tables
+    dqllresults = []
+    dqlltables = []
+
+    for run in range(chunk[0], chunk[1] + 1):
 
         # Skipping non-existing runs in ORCA
-        if run == 100259 or run == 101112 or run == 101347 or run == 101650 \
-	or (run > 101857 and run < 101887) or run == 102924 or run == 103166 \
-      	or run == 103351 or run == 103376 or run == 103644 or run == 103822 \
-        or run == 103850 or run == 103924 or run == 104392 or run == 104427 \
-        or run == 104502 or run == 106359:
-	    sys.stdout.write("%s - rscheck():INFO: run %s does not exist in ORCA/detector state database - skipping\n"
-                            	% (datetime.datetime.now().replace(microsecond = 0),run)) 
+        if run not in tables['RATDB']:
+
+            results.append(skipped_run(run))
+
             continue
-	
-        nruns += 1
 
-	# Some cosmetics taken from E. Falk
-        if ((run % 10 == 0) and (p != 0)):
+        result = evaluate_run_type(run, tables['RATDB'][run]["RUN"])
 
-            runlist.write("-------||-------|------|" + \
-                          "------|-------|" + \
-                          "-------|--------||----"
-                          "-----|--------|" + \
-                          "-------------------|-----------------------------------------|--------------------|" + \
-                          "--------------------\n")
-						
-	runtype = 1
-	
-	# Read RUN.ratdb
-	rundatatuple = ratdbtools.get_table(run, "RUN", settings.RATDB_ADDRESS, settings.RATDB_HOST, 
-                                            settings.RATDB_READ_USER, settings.RATDB_READ_PASSWORD,
-                                            settings.RATDB_NAME, settings.RATDB_PORT)
+        results.append(result)
 
-        rundata = rundatatuple[1]
+        if not result['physics']:
+            continue
 
-        if rundatatuple[0]:
+        # Read DQLL.ratdb
+        dqlldatatuple = tables['RATDB'][run]["DQLL"]
 
-	   runtypemask = rundata['runtype']
+        if dqlldatatuple[0]:
 
-	   # NOT a physics run		
-	   if runtypemask & PHYSICS_RUN_MASK != PHYSICS_RUN_MASK:
-		
-	      sys.stdout.write("%s - rscheck():INFO: run %i is not a PHYSICS run\n"
-              		           % (datetime.datetime.now().replace(microsecond = 0),run))
-     
-              nnotphys += 1
+            dqllresults.append(result)
+            dqlltables.append(dqlldatatuple[1])
 
-              continue
+        else:
 
-           # DCR Activity bit set
-	   if runtypemask & DCR_ACTIVITY_MASK == DCR_ACTIVITY_MASK:
+            result['runduration'] = 9
+            result['cratestatus'] = 9
+            result['cratedac'] = 9
+            result['cratealarmok'] = 9
 
-	      sys.stdout.write("%s - rscheck():INFO: run %i has DCR Activity bit set\n"
-                                   % (datetime.datetime.now().replace(microsecond = 0),run))
+    with rstrace.span("evaluate.dqll", first = chunk[0], last = chunk[1], runs = len(dqllresults)):
 
-              runtype = 0
+        evaluate_dqll_runs(dqllresults, dqlltables)
 
-           # Compensation Coils OFF
-           if runtypemask & COMP_COIL_OFF_MASK == COMP_COIL_OFF_MASK:
+    # Perform the HL checks of the runs with a DQHL document in one batch
+    rowresults = [result for result in results if not result['skipped'] and result['physics']]
 
-              sys.stdout.write("%s - rscheck():INFO: run %i has Comp Coils OFF\n"
-                                   % (datetime.datetime.now().replace(microsecond = 0),run))
+    dqhlruns = [result['run'] for result in rowresults if result['run'] in tables['DQHL']]
 
-              runtype = 0
+    with rstrace.span("evaluate.dqhl", first = chunk[0], last = chunk[1], runs = len(dqhlruns)):
 
-           # PMTs OFF
-           if runtypemask & PMT_OFF_MASK == PMT_OFF_MASK:
+        dqhlvalues = dict(zip(dqhlruns, dqhltools.processRunValues(dqhlruns, [tables['DQHL'][run] for run in dqhlruns])))
 
-              sys.stdout.write("%s - rscheck():INFO: run %i has PMTs OFF\n"
-                                   % (datetime.datetime.now().replace(microsecond = 0),run))
+    for result in rowresults:
 
-              runtype = 0
+        # Cost inputs of the run, read before its span starts
+        costs = dqhl_costs(tables['DQHL'].get(result['run'])) if rstrace.enabled() else {}
 
-           # SLAssay 
-           if runtypemask & SLASSAY_MASK == SLASSAY_MASK:
+        with rstrace.span("run.row", run = result['run'], **costs):
 
-              sys.stdout.write("%s - rscheck():INFO: run %i has SLAssay\n"
-                                   % (datetime.datetime.now().replace(microsecond = 0),run))
+            format_row(result, dqhlvalues.get(result['run']))
 
-              runtype = 0
+    return results
 
-	   # Unusual Activity
-           if runtypemask & UNUSUAL_ACTIVITY_MASK == UNUSUAL_ACTIVITY_MASK:
+def evaluate_chunks(runs, sources = None, skippedruns = None, chunksize = ratdbtools.RUN_CHUNK_SIZE,
+                    prefetch = 2, jobs = 1, fetchpool = None):
+    """Perform the checks of a list of runs, a chunk of runs at a time.
+    :param: The run numbers (iterable of int)
+    :param: Dictionary RATDB/DQHL -> function(chunk) downloading the tables
+            of a (firstrun, lastrun, runs) chunk, by default chunk_fetchers()
+    :param: The intervaltools.RunIntervals of the runs that do not exist in
+            ORCA, by default the ones of SKIPPED_RUNS_FILE
+    :param: The number of runs downloaded and evaluated together
+    :param: The number of chunks of runs downloaded ahead of the checks
+    :param: The number of chunks of runs evaluated concurrently
+    :param: rspipeline.fetch_pool() to download on (optional, by default one per call)
+    :returns: A generator of the evaluate_chunk() results of each chunk, in
+              run order, with the results of the given runs only
+    """
 
-              sys.stdout.write("%s - rscheck():INFO: run %i has Unusual Activity bit set\n"
-                                   % (datetime.datetime.now().replace(microsecond = 0),run))
+    runs = sorted(set(int(run) for run in runs))
 
-              runtype = 0
+    if sources is None:
+        sources = chunk_fetchers()
 
-        else:
+    if skippedruns is None:
+        skippedruns = intervaltools.load_run_intervals(SKIPPED_RUNS_FILE)
 
-           runtype = 9
+    # Chunks of runs downloaded and evaluated together, with the runs that are
+    # not skipped; a chunk also ends at a gap of more than chunksize runs, so
+    # the DQHL documents of the runs in between are not downloaded
+    chunks = []
+    chunkruns = []
 
-        if runtype == 1: ntypeok += 1
+    for run in runs:
 
-	runduration = 1
+        if chunkruns and (len(chunkruns) == chunksize or run - chunkruns[-1] > chunksize):
 
-	cratestatus = 1
+            chunks.append((chunkruns[0], chunkruns[-1], skippedruns.exclude(chunkruns)))
+            chunkruns = []
 
-	cratedac = 1
+        chunkruns.append(run)
 
-        crateovercurrent = 1
+    if chunkruns:
+        chunks.append((chunkruns[0], chunkruns[-1], skippedruns.exclude(chunkruns)))
 
-        cratecurrentnearzero = 1
+    wanted = set(runs)
 
-        cratesetpointdiscrepancy = 1
+    # Download and check the chunks in a pipeline, the results come back in run order
+    for results in rspipeline.pipeline(chunks, sources, evaluate_chunk, prefetch, jobs, fetchpool):
 
-        cratealarmok = 1
-	
-        # Read DQLL.ratdb
-	dqlldatatuple = ratdbtools.get_table(run, "DQLL", settings.RATDB_ADDRESS, settings.RATDB_HOST,
-                                             settings.RATDB_READ_USER, settings.RATDB_READ_PASSWORD,
-                                             settings.RATDB_NAME,settings.RATDB_PORT)
+        # Leave out the runs between the runs asked for
+        yield [result for result in results if result['run'] in wanted]
 
-        dqlldata = dqlldatatuple[1]
+def evaluate_runs(runs, sources = None, skippedruns = None, chunksize = ratdbtools.RUN_CHUNK_SIZE, fetchpool = None):
+    """Perform the checks of a list of runs, e.g. from a notebook or another script.
+    The downloads run on a fetch pool kept open, so the connections to the
+    backends stay open for the next calls.
+    :param: The run numbers (iterable of int)
+    :param: The sources of the tables, as for evaluate_chunks()
+    :param: The runs that do not exist in ORCA, as for evaluate_chunks()
+    :param: The number of runs downloaded and evaluated together
+    :param: rspipeline.fetch_pool() to download on (optional, by default the shared one)
+    :returns: The list of the results of the runs, in run order: dictionaries
+              with the run number, 'skipped' and 'physics', the check flags,
+              the run list 'row' and 'record' (rstools.RECORD_FIELDS values)
+              and the 'messages' of the run
+    """
 
-        if dqlldatatuple[0]:
+    if sources is None:
+        sources = chunk_fetchers()
 
-           duration = dqlldata['duration_seconds']
+    if fetchpool is None:
+        fetchpool = _shared_fetch_pool(sources)
 
-           version = dqlldata['version']
+    return [result for results in evaluate_chunks(runs, sources, skippedruns, chunksize, fetchpool = fetchpool)
+            for result in results]
 
-           # Duration < 30 minutes
-           if duration < 1800:
-           
-	      sys.stdout.write("%s - rscheck():INFO: run %i duration is less than 30 minutes\n"
-                                   % (datetime.datetime.now().replace(microsecond = 0),run))
+def _shared_fetch_pool(sources):
+    """Return the fetch pool shared by the evaluate_runs() calls, opened on first use. """
 
-              runduration = 0
+    global _fetchpool
 
-           if runtype == 1 and runduration == 1: ndurationok += 1
+    with _fetchpool_lock:
 
-	   crates_status_a = dqlldata['crate_hv_status_a']
+        if _fetchpool is None:
+            _fetchpool = rspipeline.fetch_pool(sources)
 
-	   # At least one crate HV is OFF (A supply)
-	   for i in range(len(crates_status_a)):
-   
-	       if crates_status_a[i] == False:
+        return _fetchpool
 
-	          sys.stdout.write("%s - rscheck():INFO: run %i crate %i HV is off\n"
-                  	               % (datetime.datetime.now().replace(microsecond = 0),run,i))
+def main():
+    # Parse the arguments
+    parser = argparse.ArgumentParser()
 
-		  cratestatus = 0
+    parser.add_argument("-n", dest = "firstrun", help = "First run number to process", type = int, required = True)
+    parser.add_argument("-i", dest = "lastrun", help = "Last run number to process", type = int, required = True)
+    parser.add_argument("--resume", dest = "resume", help = "Resume the run list from its last checkpoint", action = "store_true")
+    parser.add_argument("--extend", dest = "extend", help = "Existing run list with the same first run to extend with the runs taken since")
+    parser.add_argument("--cache-file", dest = "cachefile", help = "Local cache of the RUN, DQLL and DQHL tables",
+                        default = rscache.DEFAULT_CACHE_PATH)
+    parser.add_argument("--cache-size", dest = "cachesize", help = "Maximum size of the local cache in MB",
+                        type = int, default = rscache.DEFAULT_CACHE_SIZE / (1024 * 1024))
+    parser.add_argument("--no-cache", dest = "nocache", help = "Do not use the local cache", action = "store_true")
+    parser.add_argument("--refresh-cache", dest = "refreshcache", help = "Download every table again and refresh the local cache",
+                        action = "store_true")
+    parser.add_argument("--jobs", "-j", dest = "jobs", help = "Number of chunks of runs evaluated concurrently",
+                        type = int, default = 1)
+    parser.add_argument("--prefetch", dest = "prefetch", help = "Number of chunks of runs downloaded ahead of the checks",
+                        type = int, default = 2)
+    parser.add_argument("--skipped-runs", dest = "skippedruns", help = "File of the runs that do not exist in ORCA",
+                        default = SKIPPED_RUNS_FILE)
+    parser.add_argument("--detector-db", dest = "detectordb",
+                        help = "Address of the detector database: also skip the runs missing from its run_state table")
+    parser.add_argument("--log-level", dest = "loglevel", help = "Messages to print: errors only, the run list summary too, or every check",
+                        choices = ["quiet", "summary", "verbose"], default = "verbose")
+    parser.add_argument("--metrics", dest = "metrics", help = "File to write the timing report of the stages of the checks to")
+    parser.add_argument("--metrics-format", dest = "metricsformat", help = "Format of the timing report",
+                        choices = ["json", "prometheus"], default = "json")
+    parser.add_argument("--trace", dest = "trace", help = "File to write a Chrome trace of the checks to")
+    parser.add_argument("--trace-top", dest = "tracetop", help = "Number of slowest runs listed at the end when tracing",
+                        type = int, default = 10)
+    parser.add_argument("--output-formats", dest = "outputformats",
+                        help = "Comma separated machine-readable copies of the run list to write too: %s" % ",".join(rsoutput.FORMATS),
+                        default = "")
+    parser.add_argument("--chunk-size", dest = "chunksize", help = "Number of runs downloaded and evaluated together",
+                        type = int, default = ratdbtools.RUN_CHUNK_SIZE)
+    parser.add_argument("--record", dest = "record", help = "Fixture archive to record the RATDB and CouchDB responses in")
+    parser.add_argument("--replay", dest = "replay", help = "Fixture archive to answer the RATDB and CouchDB requests from, offline")
+    parser.add_argument("--replay-latency", dest = "replaylatency", help = "Latency added to every replayed request in seconds",
+                        type = float, default = 0.0)
 
-           # OWLs are OFF (16B supply)
-           crate_16B_status = dqlldata['crate_16_hv_status_b']
+    args = parser.parse_args()
 
-           if crate_16B_status == False:
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be used together")
 
-	      sys.stdout.write("%s - rscheck():INFO: run %i OWLs HV is off\n"
-                                       % (datetime.datetime.now().replace(microsecond = 0),run))
+    outputformats = [name for name in args.outputformats.split(',') if name]
 
-              cratestatus = 0
+    for name in outputformats:
+        if name not in rsoutput.FORMATS:
+            parser.error("unknown output format %s" % name)
 
-	   # At least one DAC value is 0 (power supply A)
-           crates_dac_a = dqlldata['crate_hv_dac_a']
+    rslog.set_level(args.loglevel)
 
-	   for i in range(len(crates_dac_a)):
+    starttime = time.time()
 
-	       if crates_dac_a[i] == 0:
+    if args.trace:
+        rstrace.enable()
 
-	          sys.stdout.write("%s - rscheck():INFO: run %i crate %i power supply A DAC value is 0\n"
-                                       % (datetime.datetime.now().replace(microsecond = 0),run,i))
+    if args.record:
+        rsfixtures.record(args.record)
+    elif args.replay:
+        rsfixtures.replay(args.replay, args.replaylatency)
 
-                  cratedac = 0
+    # Exit if no run numbers supplied
+    if args.firstrun == "0" or args.lastrun == "0":
 
-	   # OWLs DAC value is 0 (power supply B)
-           crate_16B_dac = dqlldata['crate_16_hv_dac_b']
+        sys.stderr.write("%s - rscheck():ERROR: please supply a start run number using \'-n\'"
+                         % (datetime.datetime.now().replace(microsecond = 0)))
+        sys.exit(1)
 
-	   if crate_16B_dac == 0:
+    # Variables for statistics calculation
+    nruns = 0
+    nnotphys = 0
+    ntypeok = 0
+    ndurationok = 0
+    ncratehvok = 0
+    nnohvalarm = 0
 
-              sys.stdout.write("%s - rscheck():INFO: run %i crate 16 power supply B DAC value is 0\n"
-	                           % (datetime.datetime.now().replace(microsecond = 0),run))
-           
-              cratedac = 0
-        
-           # HV alarms only exist for version 4 and later
-           if version > 3:
+    nphysruns = 0
 
-               # Crate HV alarms
-               detectordbalarms = dqlldata['detector_db_alarms']
+    # Counter for some cosmetics below
+    p = 0
 
-               # At least one crate has a current near zero alarm (power supply A)
-               hvcurrentnearzero_a = detectordbalarms['HV_current_near_zero_A']
+    # First run to process
+    startrun = args.firstrun
 
-               for i in range(len(hvcurrentnearzero_a)):
+    # Create run list
+    runlistname = "runlist_{0}-{1}.txt".format(args.firstrun,args.lastrun)
 
-                   if hvcurrentnearzero_a[i] == 1:
+    # Checkpoint of the run list to resume or to extend
+    checkpoint = None
 
-                       sys.stdout.write("%s - rscheck():INFO: run %i crate %i has a current near zero alarm\n"
-                                        % (datetime.datetime.now().replace(microsecond = 0),run,i))
+    if args.resume:
 
-                       cratecurrentnearzero = 0
+        checkpoint = rstools.read_checkpoint(runlistname)
 
-               # OWLs crate with current near zero (power supply B)
-               hvcurrentnearzero_16b = detectordbalarms['HV_current_near_zero_B']
+    elif args.extend:
 
-               if hvcurrentnearzero_16b == 1: 
-               
-                   sys.stdout.write("%s - rscheck():INFO: run %i crate 16 power supply B has a current near zero alarm\n"
-                                    % (datetime.datetime.now().replace(microsecond = 0),run))
-                   
-                   cratecurrentnearzero = 0
+        checkpoint = rstools.read_checkpoint(args.extend)
 
-               # At least one crate has an over-current alarm (power supply A)
-               hvovercurrent_a = detectordbalarms['HV_over_current_A']
+        if checkpoint is None or checkpoint['firstrun'] != args.firstrun:
 
-               for i in range(len(hvovercurrent_a)):
+            sys.stderr.write("%s - rscheck():ERROR: no checkpoint with first run %i for run list %s\n"
+                             % (datetime.datetime.now().replace(microsecond = 0),args.firstrun,args.extend))
+            sys.exit(1)
 
-                   if hvovercurrent_a[i] == 1:
+        if os.path.abspath(args.extend) != os.path.abspath(runlistname):
+            shutil.copyfile(args.extend, runlistname)
 
-                       sys.stdout.write("%s - rscheck():INFO: run %i crate %i has an over current alarm\n"
-                                        % (datetime.datetime.now().replace(microsecond = 0),run,i))
-                       
-                        
-                       crateovercurrent = 0
+    if checkpoint is not None:
 
-               # OWLs crate with an over current alarm (power supply B)
-               hvovercurrent_16b = detectordbalarms['HV_over_current_B']
+        nruns = checkpoint['nruns']
+        nnotphys = checkpoint['nnotphys']
+        ntypeok = checkpoint['ntypeok']
+        ndurationok = checkpoint['ndurationok']
+        ncratehvok = checkpoint['ncratehvok']
+        nnohvalarm = checkpoint['nnohvalarm']
+        p = checkpoint['p']
 
-               if hvovercurrent_16b == 1:
+        startrun = checkpoint['nextrun']
 
-                   sys.stdout.write("%s - rscheck():INFO: run %i crate 16 power supply B has an over current alarm\n"
-                                    % (datetime.datetime.now().replace(microsecond = 0),run))
+        rslog.summary("resuming run list %s from run %i", runlistname, startrun)
 
-                   crateovercurrent = 0
+        # Drop anything written after the checkpoint
+        runlist = open(runlistname,'r+',RUNLIST_BUFFER_SIZE)
+        runlist.truncate(checkpoint['offset'])
+        runlist.seek(checkpoint['offset'])
 
-               # At least one crate with has a HV setpoint discrepancy alarm (power supply A)
-               hvsetpointdiscrepancy_a = detectordbalarms['HV_setpoint_discrepancy_A']
+    else:
 
-               for i in range(len(hvsetpointdiscrepancy_a)):
+        runlist = open(runlistname,'w',RUNLIST_BUFFER_SIZE)
 
-                   if hvsetpointdiscrepancy_a[i] == 1:
-                        
-                       sys.stdout.write("%s - rscheck():INFO: run %i crate %i has a setpoint discrepancy alarm\n"
-                                        % (datetime.datetime.now().replace(microsecond = 0),run,i))
-                        
-                       cratesetpointdiscrepancy = 0
-                        
-               # OWls crate with a setpoint discrepancy alarm (power supply B)
-               hvsetpointdiscrepancy_16b = detectordbalarms['HV_setpoint_discrepancy_B']
+        # Write run list header
+        rstools.write_header(runlist)
 
-               if hvsetpointdiscrepancy_16b == 1:
+    # Machine-readable copies of the run list
+    outputs = rsoutput.open_writers(runlistname, outputformats,
+                                    checkpoint.get('outputs') if checkpoint is not None else None,
+                                    args.extend if not args.resume else None)
 
-                   sys.stdout.write("%s - rscheck():INFO: run %i crate 16 power supply B has a setpoint discrepancy alarm\n"
-                                     % (datetime.datetime.now().replace(microsecond = 0),run))
-                   
-                   cratesetpointdiscrepancy = 0
+    # Local cache the tables are read through
+    cache = None
 
-               if cratecurrentnearzero == 0 or crateovercurrent == 0 or cratesetpointdiscrepancy == 0: cratealarmok = 0
+    if not args.nocache:
+        cache = rscache.RunCache(args.cachefile, args.cachesize * 1024 * 1024, args.refreshcache)
 
-           else:
+    # Runs that do not exist in ORCA
+    skippedruns = intervaltools.load_run_intervals(args.skippedruns)
 
-               cratealarmok = 9
+    if args.detectordb:
+        skippedruns = skippedruns.union(detector_db_skipped_runs(args.detectordb, startrun, args.lastrun))
 
-               sys.stdout.write("%s - rscheck():INFO: run %i HV alarms not saved in the DQLL table - please check the detector state page on snopl.us\n"
-                                % (datetime.datetime.now().replace(microsecond = 0),run))
+    # Check the runs from <startrun> to <lastrun>, the results of a chunk of runs come back at a time
+    chunkresults = evaluate_chunks(range(startrun, args.lastrun + 1), chunk_fetchers(cache), skippedruns,
+                                   args.chunksize, args.prefetch, args.jobs)
 
-        else:
+    # State of the run list recorded in its checkpoint
+    def checkpoint_state(nextrun):
+        return {'firstrun': args.firstrun, 'nextrun': nextrun,
+                'nruns': nruns, 'nnotphys': nnotphys, 'ntypeok': ntypeok,
+                'ndurationok': ndurationok, 'ncratehvok': ncratehvok,
+                'nnohvalarm': nnohvalarm, 'p': p,
+                'outputs': dict((name, output.checkpoint()) for name, output in outputs.items())}
+
+    # Record the state before the first run, the checkpoints of the next runs are appended to it
+    rstools.write_checkpoint(runlist, checkpoint_state(startrun))
+
+    checkpointfile = rstools.open_checkpoint(runlist)
+
+    # Write the run list in run order, recording a checkpoint after each run
+    for results in chunkresults:
+
+        with rsmetrics.timer("output.write"), rstrace.span("write", first = results[0]['run'], last = results[-1]['run']):
+
+            for result in results:
+
+                run = result['run']
+
+                rslog.write(result['messages'])
+
+                if result['skipped']:
+                    continue
+
+                nruns += 1
+
+                rows = []
+                records = []
+
+                # Some cosmetics taken from E. Falk
+                if ((run % 10 == 0) and (p != 0)):
+
+                    rows.append(SEPARATOR)
+
+                if not result['physics']:
+
+                    nnotphys += 1
+
+                else:
 
-           runduration = 9
-	   cratestatus = 9
-           cratedac = 9
-           cratealarmok = 9
+                    runtype = result['runtype']
+                    runduration = result['runduration']
+                    cratestatus = result['cratestatus']
+                    cratedac = result['cratedac']
+                    cratealarmok = result['cratealarmok']
 
-        if runtype == 1 and runduration == 1 and cratestatus == 1 and cratedac == 1: ncratehvok += 1
+                    if runtype == 1: ntypeok += 1
 
-        if runtype == 1 and runduration == 1 and cratestatus == 1 and cratedac == 1 and cratealarmok == 1: nnohvalarm += 1
+                    if runtype == 1 and runduration == 1: ndurationok += 1
 
-	# Write run info in run list
-        runlist.write(str(run) + ' || ')
-        runlist.write(str(runtype) + str(runduration) + str(cratestatus) + str(cratedac) + str(cratealarmok) + ' | ')
-	runlist.write(str(runtype) + '    | ')
-	runlist.write(str(runduration) + '    | ')
-	runlist.write(str(cratestatus) + '     | ')
-	runlist.write(str(cratedac) + '     | ')
-        runlist.write(str(cratealarmok) + '      ||')
+                    if runtype == 1 and runduration == 1 and cratestatus == 1 and cratedac == 1: ncratehvok += 1
 
-        # Perform the HL checks
-        dqhltools.dqhlPassFailList(run,runlist)
+                    if runtype == 1 and runduration == 1 and cratestatus == 1 and cratedac == 1 and cratealarmok == 1: nnohvalarm += 1
 
-	# Increment p
-	p += 1
+                    # Run info for the run list
+                    rows.append(result['row'])
+                    records.append(result['record'])
+
+                    # Increment p
+                    p += 1
+
+                runlist.write(''.join(rows))
+
+                if records:
+                    for output in outputs.values():
+                        output.write(records)
+
+                # Record the runs completed so far
+                rstools.append_checkpoint(checkpointfile, runlist, checkpoint_state(run + 1))
+
+    checkpointfile.close()
+
+    # Record the completed run list so it can be extended later
+    rstools.write_checkpoint(runlist, checkpoint_state(max(startrun, args.lastrun + 1)))
 
     runlist.close()
 
+    for output in outputs.values():
+        output.close()
+
+    connectiontools.close_all()
+
+    if cache is not None: cache.close()
+
     nphysruns = nruns - nnotphys
 
-    sys.stdout.write("%s - rscheck():INFO: number of runs %i - physics runs %i - with typeok %i - with durationok %i - with cratehvok %i with nohvalarm %i\n"
-                         % (datetime.datetime.now().replace(microsecond = 0),nruns,nphysruns,ntypeok,ndurationok,ncratehvok,nnohvalarm))	
+    if args.metrics:
+
+        elapsed = time.time() - starttime
+
+        # Runs processed by this invocation
+        nprocessed = max(0, args.lastrun - startrun + 1)
+
+        rsmetrics.write_report(args.metrics, args.metricsformat,
+                               {'firstrun': args.firstrun, 'lastrun': args.lastrun, 'elapsed': elapsed,
+                                'runs': nprocessed, 'runs_per_second': nprocessed / max(elapsed, 1e-6)})
+
+    if args.trace:
+
+        rstrace.write_trace(args.trace)
+
+        for run, seconds, attributes in rstrace.slowest_runs(args.tracetop):
+
+            rslog.summary("slow run %i: %.1f ms - missing GTIDs %s - bit flip GTIDs %s", run, seconds * 1000,
+                          attributes.get('missing_gtids', '-'), attributes.get('bitflip_gtids', '-'))
+
+    rslog.summary("number of runs %i - physics runs %i - with typeok %i - with durationok %i - with cratehvok %i with nohvalarm %i",
+                  nruns,nphysruns,ntypeok,ndurationok,ncratehvok,nnohvalarm)
 
     return 0  # Success!
 
@@ -0,0 +1,601 @@
+#!/usr/bin/env python
+"""rsdaemon.py
+Watch daemon of the Run Selection checks: the runs are evaluated as soon as
+their tables land, and their results are served from memory over a local
+HTTP/JSON endpoint.
+
+Two followers mark the runs to evaluate:
+
+    couchdb  the _changes feed of the data-quality database (longpoll), the
+             runs of every new or updated DQHL document. The feed gives the
+             document ids only; their runs are read from the rows of the
+             runs view, so no document is downloaded to follow it
+    ratdb    the RUN and DQLL headers added to RATDB since the last poll
+
+The runs marked are evaluated together by rschecks.evaluate_runs(), each
+once however many changes it had, with the same DQLL and DQHL checks as the
+run lists. The downloads run on a pool kept open, so the backend connections
+stay warm between evaluations. After each evaluation the results of its runs
+are saved in a SQLite file next to the state file (<state>.sqlite), then the
+sequence points of the followers in the state file, and a restarted daemon
+carries on from there.
+
+With no state file the followers start from the current sequence points;
+'--first-run RUN' reads the RATDB headers from the start instead, to also
+evaluate the runs already there from RUN on.
+
+    GET /status               sequence points, runs pending and evaluated,
+                              threads running and their last errors, and
+                              the runs whose evaluation failed
+
+After a backend error a thread waits RETRY_DELAY seconds before trying again,
+twice as long after each further failure in a row, up to MAX_RETRY_DELAY.
+    GET /runs/<run>           result of a run
+    GET /runs?first=&last=    results of the runs of a range
+
+Example use: 'python rsdaemon.py --state rsdaemon.json --port 8642'
+"""
+import os
+import sys
+import json
+import time
+import signal
+import sqlite3
+import argparse
+import datetime
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from collections import OrderedDict
+
+import rschecks
+import rspipeline
+import rstools
+import ratdbtools
+import ratdbcoverage
+import connectiontools
+import intervaltools
+import rscache
+import rslog
+
+DATABASE = "data-quality"
+
+# View of the data-quality database: run number -> document id
+RUNS_VIEW = "_design/data-quality/_view/runs"
+
+# Rows of the runs view requested per page
+VIEW_PAGE_SIZE = 1000
+
+# RATDB tables whose new headers mark their runs
+TABLES = ["RUN", "DQLL"]
+
+# Seconds a CouchDB longpoll request waits for a change
+CHANGES_TIMEOUT = 60
+
+# Seconds to wait after a backend error before trying again, doubled after
+# each further failure up to MAX_RETRY_DELAY
+RETRY_DELAY = 30
+MAX_RETRY_DELAY = 600
+
+# Runs marked by a table or document valid for a longer run range are only
+# evaluated up to this many runs after its first run
+MAX_RUN_SPAN = 1000
+
+LAST_KEY_QUERY = "SELECT COALESCE(MAX(key), 0) FROM ratdb_header_v2"
+
+def _error(source, error):
+
+    sys.stderr.write("%s - %s():ERROR: %s\n" % (datetime.datetime.now().replace(microsecond = 0), source, error))
+
+def results_name(statename):
+    """Return the name of the SQLite file of the results kept next to a state file. """
+
+    return os.path.splitext(statename)[0] + ".sqlite"
+
+def _runs(run_range):
+    """Return the runs of a [first, last] range, at most MAX_RUN_SPAN + 1 of them. """
+
+    return range(int(run_range[0]), min(int(run_range[1]), int(run_range[0]) + MAX_RUN_SPAN) + 1)
+
+def result_document(result):
+    """Return the JSON document of an rschecks.evaluate_runs() result. """
+
+    record = None
+
+    if result['record'] is not None:
+        record = OrderedDict(zip(rstools.RECORD_FIELDS, result['record']))
+
+    return OrderedDict([('run', result['run']), ('skipped', result['skipped']), ('physics', result['physics']),
+                        ('record', record), ('row', result['row']),
+                        ('evaluated', str(rslog.timestamp()))])
+
+class Watcher(object):
+    """Runs to evaluate, sequence points and results of the daemon.
+    The results are saved per run in the results_name() SQLite file, and the
+    sequence points they cover in the state file.
+    :param: The path of the state file (string)
+    :param: The first run evaluated, runs before it are not marked (int)
+    """
+
+    def __init__(self, path, firstrun = 0):
+
+        self.path = path
+        self.firstrun = firstrun
+
+        self._changed = threading.Condition()
+
+        # Runs marked and not evaluated yet
+        self.pending = set()
+
+        # Sequence points of the followers: up to where they marked runs, and
+        # up to where the runs they marked are evaluated and saved
+        self.points = {'couchdb': None, 'ratdb': None}
+        self.saved = dict(self.points)
+
+        # run -> result_document()
+        self.results = {}
+
+        # Threads of the daemon by name, and the last error of each, cleared
+        # by its next success; the last error of any thread is kept
+        self.threads = {}
+        self.errors = {}
+        self.last_error = None
+
+        # Runs of the evaluations that failed, until they are evaluated
+        self.failed_runs = set()
+
+        self.evaluations = 0
+        self.last_evaluation = None
+        self.started = str(rslog.timestamp())
+
+        self._db = sqlite3.connect(results_name(path), check_same_thread = False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS results (run INTEGER PRIMARY KEY, document TEXT NOT NULL)")
+        self._db.commit()
+
+        for run, document in self._db.execute("SELECT run, document FROM results"):
+            self.results[run] = json.loads(document, object_pairs_hook = OrderedDict)
+
+        if os.path.exists(path):
+
+            state = json.load(open(path))
+
+            self.saved.update(state['points'])
+            self.points.update(state['points'])
+
+    def mark(self, runs, follower = None, point = None):
+        """Mark runs to evaluate, and move the sequence point of a follower past them. """
+
+        with self._changed:
+
+            self.pending.update(run for run in runs if run >= self.firstrun)
+
+            if follower is not None:
+                self.points[follower] = point
+
+            if self.pending:
+                self._changed.notify()
+
+    def take(self, delay):
+        """Wait for runs to evaluate and return them all, with the sequence points
+        they are marked up to.
+        :param: Seconds to wait for more changes after the first one
+        :returns: The sorted runs, and the sequence points of the followers
+        """
+
+        with self._changed:
+            while not self.pending:
+                self._changed.wait(1)
+
+        # Changes come in bursts, e.g. the RUN then the DQLL table of a run
+        time.sleep(delay)
+
+        with self._changed:
+
+            runs = sorted(self.pending)
+            self.pending = set()
+
+            return runs, dict(self.points)
+
+    def store(self, results, points):
+        """Keep the results of an evaluation, and save them then the sequence points they cover. """
+
+        documents = [result_document(result) for result in results]
+
+        with self._changed:
+
+            for document in documents:
+                self.results[document['run']] = document
+
+            # Only the runs of this evaluation are written
+            self._db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?)",
+                                 [(document['run'], json.dumps(document)) for document in documents])
+            self._db.commit()
+
+        # Write to a temporary file first so the state is never half written
+        state = open(self.path + ".tmp", 'w')
+        json.dump({'points': points}, state)
+        state.close()
+
+        os.rename(self.path + ".tmp", self.path)
+
+        with self._changed:
+
+            self.saved = points
+            self.evaluations += 1
+            self.last_evaluation = str(rslog.timestamp())
+
+    def failed(self, name, error, runs = ()):
+        """Report the error of a thread, shown by status() until its next success.
+        :param: The name of the thread
+        :param: The exception
+        :param: The runs it failed to evaluate (optional)
+        :returns: The seconds to wait before trying again
+        """
+
+        _error(name, error)
+
+        with self._changed:
+
+            failure = self.errors.setdefault(name, {'failures': 0})
+
+            failure['failures'] += 1
+            failure['error'] = str(error)
+            failure['time'] = str(rslog.timestamp())
+
+            self.last_error = OrderedDict([('thread', name), ('error', failure['error']), ('time', failure['time'])])
+
+            self.failed_runs.update(runs)
+
+            return min(RETRY_DELAY * 2 ** min(failure['failures'] - 1, 10), MAX_RETRY_DELAY)
+
+    def succeeded(self, name, runs = ()):
+        """Clear the error of a thread, and the failures of the runs it evaluated. """
+
+        with self._changed:
+
+            self.errors.pop(name, None)
+
+            self.failed_runs.difference_update(runs)
+
+    def status(self):
+
+        with self._changed:
+
+            threads = dict((name, thread.is_alive()) for name, thread in self.threads.items())
+
+            return OrderedDict([('started', self.started),
+                                ('healthy', all(threads.values()) and not self.errors),
+                                ('threads', threads),
+                                ('errors', dict((name, dict(failure)) for name, failure in self.errors.items())),
+                                ('last_error', self.last_error),
+                                ('failed_runs', intervaltools.RunIntervals.from_runs(self.failed_runs).intervals()),
+                                ('pending', len(self.pending)),
+                                ('runs', len(self.results)), ('evaluations', self.evaluations),
+                                ('last_evaluation', self.last_evaluation),
+                                ('points', dict(self.points)), ('saved', dict(self.saved))])
+
+    def result(self, run):
+
+        with self._changed:
+
+            return self.results.get(run)
+
+    def runs(self, firstrun, lastrun):
+
+        with self._changed:
+
+            return [self.results[run] for run in sorted(run for run in self.results if firstrun <= run <= lastrun)]
+
+class DocumentRuns(object):
+    """Runs of the DQHL documents by id, from the rows of the runs view: they
+    hold a run number and a document id, not the document.
+    """
+
+    def __init__(self):
+
+        # document id -> set of runs
+        self.runs = {}
+        self.lastrun = None
+
+    def read(self, db, firstrun = None):
+        """Read the rows of the view, from a run on or all of them. """
+
+        options = {} if firstrun is None else {'startkey': firstrun}
+
+        for row in db.iterview(RUNS_VIEW, VIEW_PAGE_SIZE, **options):
+
+            run = int(row.key)
+
+            self.runs.setdefault(row['id'], set()).add(run)
+            self.lastrun = run if self.lastrun is None else max(self.lastrun, run)
+
+    def get(self, db, docids):
+        """Return the runs of documents, reading the rows of the ones not seen yet. """
+
+        if any(docid not in self.runs for docid in docids) and self.lastrun is not None:
+            # New documents are mostly those of the runs after the last one seen
+            self.read(db, self.lastrun)
+
+        if any(docid not in self.runs for docid in docids):
+            # A new document of an earlier run
+            self.read(db)
+
+            # The documents left are not in the view: they have no runs
+            for docid in docids:
+                self.runs.setdefault(docid, set())
+
+        return sorted(set(run for docid in docids for run in self.runs.get(docid, ())))
+
+def follow_couchdb(watcher, url):
+    """Mark the runs of the new or updated DQHL documents, from the CouchDB _changes feed.
+    :param: The Watcher
+    :param: The url of the couchdb server (string)
+    """
+
+    since = watcher.saved['couchdb']
+
+    documentruns = DocumentRuns()
+
+    while True:
+
+        try:
+
+            db = connectiontools.get_couchdb_server(url)[DATABASE]
+
+            # With no saved state, follow the changes from now on
+            if since is None:
+                since = db.info()['update_seq']
+                watcher.mark([], 'couchdb', since)
+
+            changes = db.changes(feed = "longpoll", since = since, timeout = CHANGES_TIMEOUT * 1000)
+
+            runs = documentruns.get(db, [change['id'] for change in changes['results']
+                                         if not change.get('deleted') and not change['id'].startswith("_design/")])
+
+        except Exception as e:
+
+            time.sleep(watcher.failed("follow_couchdb", e))
+
+            continue
+
+        watcher.succeeded("follow_couchdb")
+
+        since = changes['last_seq']
+
+        watcher.mark(runs, 'couchdb', since)
+
+def poll_ratdb(watcher, db_connector_address, interval):
+    """Mark the runs of the RUN and DQLL tables added to RATDB, polling every interval seconds.
+    :param: The Watcher
+    :param: The connector address of the postgresql ratdb database (string)
+    :param: Seconds between polls
+    """
+
+    lastkey = watcher.saved['ratdb']
+
+    # Read all the headers to evaluate the runs already in RATDB from the first run on
+    if lastkey is None and watcher.firstrun > 0:
+        lastkey = 0
+
+    while True:
+
+        try:
+
+            # With no saved state, follow the headers added from now on
+            if lastkey is None:
+                lastkey = connectiontools.postgres_query(db_connector_address, LAST_KEY_QUERY, ())[0][0]
+
+            while True:
+
+                rows = connectiontools.postgres_query(db_connector_address, ratdbcoverage.SYNC_QUERY,
+                                                      (lastkey, TABLES, ratdbcoverage.SYNC_PAGE_SIZE))
+
+                if not rows:
+                    break
+
+                lastkey = max(int(row[0]) for row in rows)
+
+                watcher.mark([run for key, table, index, run_begin, run_end in rows
+                              for run in _runs((run_begin, run_end))], 'ratdb', lastkey)
+
+        except Exception as e:
+
+            time.sleep(watcher.failed("poll_ratdb", e))
+
+            continue
+
+        watcher.succeeded("poll_ratdb")
+
+        time.sleep(interval)
+
+def evaluate(watcher, sources, skippedruns, detectordb, chunksize, delay):
+    """Evaluate the runs marked, as they are marked.
+    :param: The Watcher
+    :param: The sources of the tables, as for rschecks.evaluate_chunks()
+    :param: The intervaltools.RunIntervals of the runs that do not exist in ORCA
+    :param: The address of the detector database, to also skip the runs
+            missing from its run_state table (optional)
+    :param: The number of runs downloaded and evaluated together
+    :param: Seconds to wait for more changes after the first one
+    """
+
+    # Downloads on threads kept open, with their connections
+    fetchpool = rspipeline.fetch_pool(sources)
+
+    while True:
+
+        runs, points = watcher.take(delay)
+
+        start = time.time()
+
+        try:
+
+            skipped = skippedruns
+
+            if detectordb:
+                skipped = skipped.union(rschecks.detector_db_skipped_runs(detectordb, runs[0], runs[-1]))
+
+            results = rschecks.evaluate_runs(runs, sources, skipped, chunksize, fetchpool)
+
+            rslog.write([message for result in results for message in result['messages']])
+
+            watcher.store(results, points)
+
+        # The tools exit on database errors: the daemon goes on
+        except (Exception, SystemExit) as e:
+
+            retry = watcher.failed("evaluate", e, runs)
+
+            # Evaluate the runs again with the next ones
+            watcher.mark(runs)
+
+            time.sleep(retry)
+
+            continue
+
+        watcher.succeeded("evaluate", runs)
+
+        rslog.summary("evaluated %i runs (%i to %i) in %.1f s", len(runs), runs[0], runs[-1], time.time() - start)
+
+class ResultsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP server of the results of a Watcher.
+    :param: The (host, port) to listen on
+    :param: The Watcher
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, watcher):
+
+        BaseHTTPServer.HTTPServer.__init__(self, address, ResultsHandler)
+
+        self.watcher = watcher
+
+class ResultsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+
+        if rslog.enabled(rslog.VERBOSE):
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, status, document):
+
+        text = json.dumps(document)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(text)))
+        self.end_headers()
+
+        self.wfile.write(text)
+
+    def do_GET(self):
+
+        watcher = self.server.watcher
+
+        url = urlparse.urlparse(self.path)
+        path = url.path.strip("/").split("/")
+        options = dict(urlparse.parse_qsl(url.query))
+
+        try:
+
+            if path == ["status"]:
+                self.reply(200, watcher.status())
+
+            elif path == ["runs"]:
+                self.reply(200, watcher.runs(int(options.get('first', 0)), int(options.get('last', sys.maxint))))
+
+            elif len(path) == 2 and path[0] == "runs":
+
+                result = watcher.result(int(path[1]))
+
+                if result is not None:
+                    self.reply(200, result)
+                else:
+                    self.reply(404, {'error': "run %s is not evaluated" % path[1]})
+
+            else:
+                self.reply(404, {'error': "unknown path %s" % url.path})
+
+        except ValueError:
+
+            self.reply(400, {'error': "run numbers are integers"})
+
+def main():
+    # Parse the arguments
+    parser = argparse.ArgumentParser(description = "Evaluate the runs as their tables land and serve their results")
+
+    parser.add_argument("--state", dest = "state", help = "File of the sequence points, kept between restarts with the results in <state>.sqlite",
+                        default = "rsdaemon.json")
+    parser.add_argument("--host", dest = "host", help = "Address to serve the results on", default = "127.0.0.1")
+    parser.add_argument("--port", dest = "port", help = "Port to serve the results on", type = int, default = 8642)
+    parser.add_argument("--first-run", dest = "firstrun",
+                        help = "First run to evaluate; with no state file the runs already in RATDB from it on are evaluated too",
+                        type = int, default = 0)
+    parser.add_argument("--poll", dest = "poll", help = "Seconds between the polls of RATDB for new tables",
+                        type = float, default = 10.0)
+    parser.add_argument("--delay", dest = "delay", help = "Seconds to wait for more changes before evaluating",
+                        type = float, default = 1.0)
+    parser.add_argument("--cache-file", dest = "cachefile", help = "Local cache of the RUN, DQLL and DQHL tables to read through")
+    parser.add_argument("--cache-size", dest = "cachesize", help = "Maximum size of the local cache in MB",
+                        type = int, default = rscache.DEFAULT_CACHE_SIZE / (1024 * 1024))
+    parser.add_argument("--skipped-runs", dest = "skippedruns", help = "File of the runs that do not exist in ORCA",
+                        default = rschecks.SKIPPED_RUNS_FILE)
+    parser.add_argument("--detector-db", dest = "detectordb",
+                        help = "Address of the detector database: also skip the runs missing from its run_state table")
+    parser.add_argument("--chunk-size", dest = "chunksize", help = "Number of runs downloaded and evaluated together",
+                        type = int, default = ratdbtools.RUN_CHUNK_SIZE)
+    parser.add_argument("--log-level", dest = "loglevel", help = "Messages to print: errors only, the evaluations too, or every check",
+                        choices = ["quiet", "summary", "verbose"], default = "summary")
+
+    args = parser.parse_args()
+
+    rslog.set_level(args.loglevel)
+
+    import settings
+
+    watcher = Watcher(args.state, args.firstrun)
+
+    cache = None
+
+    if args.cachefile:
+        cache = rscache.RunCache(args.cachefile, args.cachesize * 1024 * 1024)
+
+    skippedruns = intervaltools.load_run_intervals(args.skippedruns)
+
+    ratdb = ratdbtools.connector_address(settings.RATDB_ADDRESS, settings.RATDB_HOST, settings.RATDB_READ_USER,
+                                         settings.RATDB_READ_PASSWORD, settings.RATDB_NAME, settings.RATDB_PORT)
+
+    watcher.threads = {'follow_couchdb': threading.Thread(target = follow_couchdb,
+                                                          args = (watcher, settings.COUCHDB_SERVER_HL)),
+                       'poll_ratdb': threading.Thread(target = poll_ratdb, args = (watcher, ratdb, args.poll)),
+                       'evaluate': threading.Thread(target = evaluate,
+                                                    args = (watcher, rschecks.chunk_fetchers(cache), skippedruns,
+                                                            args.detectordb, args.chunksize, args.delay))}
+
+    server = ResultsServer((args.host, args.port), watcher)
+
+    # The state is saved after every evaluation: stop at once
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    for thread in watcher.threads.values():
+        thread.daemon = True
+        thread.start()
+
+    rslog.summary("serving the results on http://%s:%i/", args.host, server.server_address[1])
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        connectiontools.close_all()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+"""rsfixtures.py
+Record and replay of the RATDB and CouchDB responses of the Run Selection
+checks, to run them offline and deterministically on production data.
+
+In record mode the tables and documents returned by the backend functions
+of ratdbtools, couchdbtools and connectiontools, and the rows of the
+queries of ratdb_tables.py, are kept in a fixture archive: gzip-compressed
+JSON, each distinct document stored once. In replay mode the same functions
+answer from the archive without any backend, after an optional latency per
+call. A call the archive has no answer for raises MissingFixture.
+
+Tables and documents are kept per (source, table, run), so a replay does not
+depend on how the runs were chunked when recording; queries are kept per
+(database, query, parameters), without the credentials of the address.
+"""
+import os
+import json
+import gzip
+import time
+import atexit
+import threading
+import functools
+
+RECORD = "record"
+REPLAY = "replay"
+
+_mode = None
+_archive = None
+_latency = 0.0
+
+# Nesting of the fixture calls of each thread: only the outermost call is
+# recorded or replayed
+_local = threading.local()
+
+class MissingFixture(LookupError):
+    pass
+
+class FixtureArchive(object):
+    """Responses of the backends, by (source, table, run) and by query.
+    :param: The path of the archive file (string)
+    :param: If True the archive file is read
+    """
+
+    def __init__(self, path, load = True):
+
+        self.path = path
+
+        self._lock = threading.Lock()
+
+        # source -> table -> run -> document index or None (no document)
+        self.tables = {}
+        # query key -> rows
+        self.queries = {}
+        self.documents = []
+        self._index = {}
+
+        if load:
+            archive = gzip.open(path, 'rb')
+            stored = json.loads(archive.read())
+            archive.close()
+
+            self.documents = stored['documents']
+            self.queries = stored['queries']
+            self.tables = dict((source, dict((table, dict((int(run), index) for run, index in runs.items()))
+                                             for table, runs in tables.items()))
+                               for source, tables in stored['tables'].items())
+
+    def put(self, source, table, run, document):
+
+        text = json.dumps(document, sort_keys = True)
+
+        with self._lock:
+
+            index = None
+
+            if document is not None:
+                index = self._index.get(text)
+                if index is None:
+                    index = self._index[text] = len(self.documents)
+                    # A copy, so later changes to the document are not recorded
+                    self.documents.append(json.loads(text))
+
+            self.tables.setdefault(source, {}).setdefault(table, {})[int(run)] = index
+
+    def get(self, source, table, run):
+        """Return the document of a run, None if it had none.
+        :raises: MissingFixture if the run was not recorded
+        """
+
+        runs = self.tables.get(source, {}).get(table, {})
+
+        if int(run) not in runs:
+            raise MissingFixture("no %s %s fixture for run %s" % (source, table, run))
+
+        index = runs[int(run)]
+
+        return None if index is None else self.documents[index]
+
+    def put_rows(self, key, rows):
+
+        with self._lock:
+            self.queries[key] = [list(row) for row in rows]
+
+    def get_rows(self, key):
+
+        if key not in self.queries:
+            raise MissingFixture("no fixture for query %s" % key)
+
+        return self.queries[key]
+
+    def save(self):
+        """Write the archive to its file, atomically. """
+
+        with self._lock:
+            stored = {'documents': self.documents, 'queries': self.queries, 'tables': self.tables}
+            text = json.dumps(stored, default = float)
+
+        archive = gzip.open(self.path + ".tmp", 'wb')
+        archive.write(text)
+        archive.close()
+
+        os.rename(self.path + ".tmp", self.path)
+
+def record(path):
+    """Record the backend responses in a new archive, saved at exit. """
+
+    global _mode, _archive
+
+    _mode = RECORD
+    _archive = FixtureArchive(path, load = False)
+
+    atexit.register(_archive.save)
+
+def replay(path, latency = 0.0):
+    """Answer the backend calls from an archive.
+    :param: The path of the archive (string)
+    :param: Latency added to every replayed call (seconds)
+    """
+
+    global _mode, _archive, _latency
+
+    _mode = REPLAY
+    _archive = FixtureArchive(path)
+    _latency = latency
+
+def mode():
+
+    return _mode
+
+def _fixture(lookup, store):
+
+    # Decorator answering the outermost calls from lookup(args) in replay
+    # mode, and storing their results with store(args, result) in record mode
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+
+            if _mode is None or getattr(_local, 'depth', 0):
+                return function(*args, **kwargs)
+
+            if _mode == REPLAY:
+                time.sleep(_latency)
+                return lookup(*args)
+
+            _local.depth = 1
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                _local.depth = 0
+
+            store(args, result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+def ratdb_table(function):
+    """Fixture of ratdbtools.get_table(run, table, ...) -> (found, table). """
+
+    def lookup(run, tablename, *args):
+        table = _archive.get("ratdb", tablename, run)
+        return table is not None, table if table is not None else "none"
+
+    def store(args, result):
+        _archive.put("ratdb", args[1], args[0], result[1] if result[0] else None)
+
+    return _fixture(lookup, store)(function)
+
+def ratdb_chunk(function):
+    """Fixture of the bulk fetches of ratdbtools, (address, runs, tables, ...)
+    -> {(run, table): table} for the tables found. """
+
+    def lookup(address, chunk, tablenames, *args):
+        found = {}
+        for run in chunk:
+            for tablename in tablenames:
+                table = _archive.get("ratdb", tablename, run)
+                if table is not None:
+                    found[(run, tablename)] = table
+        return found
+
+    def store(args, result):
+        for run in args[1]:
+            for tablename in args[2]:
+                _archive.put("ratdb", tablename, run, result.get((run, tablename)))
+
+    return _fixture(lookup, store)(function)
+
+def couchdb_run(function):
+    """Fixture of couchdbtools.getCouchDBDict(server, run) -> document or None. """
+
+    def lookup(server, run):
+        return _archive.get("couchdb", "DQHL", run)
+
+    def store(args, result):
+        _archive.put("couchdb", "DQHL", args[1], result)
+
+    return _fixture(lookup, store)(function)
+
+def couchdb_range(function):
+    """Fixture of couchdbtools.getCouchDBDicts(server, first, last, ...) -> {run: document}. """
+
+    def lookup(server, firstrun, lastrun, *args):
+        docs = {}
+        for run in range(firstrun, lastrun + 1):
+            doc = _archive.get("couchdb", "DQHL", run)
+            if doc is not None:
+                docs[run] = doc
+        return docs
+
+    def store(args, result):
+        for run in range(args[1], args[2] + 1):
+            _archive.put("couchdb", "DQHL", run, result.get(run))
+
+    return _fixture(lookup, store)(function)
+
+def _query_key(address, query, params):
+
+    # Database of the address, without the credentials
+    return json.dumps([address.split("@")[-1], query, params], sort_keys = True, default = float)
+
+def query(function):
+    """Fixture of connectiontools.postgres_query(address, query, params) -> rows. """
+
+    def lookup(address, query, params):
+        return _archive.get_rows(_query_key(address, query, params))
+
+    def store(args, result):
+        _archive.put_rows(_query_key(*args), result)
+
+    return _fixture(lookup, store)(function)
+
+class FixtureCursor(object):
+
+    def __init__(self, connection):
+
+        self.connection = connection
+        self.cursor = connection.conn.cursor() if connection.conn is not None else None
+        self.rows = []
+
+    def execute(self, query, params = ()):
+
+        key = _query_key(self.connection.address, query, params)
+
+        if _mode == REPLAY:
+            time.sleep(_latency)
+            self.rows = _archive.get_rows(key)
+        else:
+            self.cursor.execute(query, params)
+            self.rows = self.cursor.fetchall()
+            _archive.put_rows(key, self.rows)
+
+    def fetchall(self):
+
+        rows, self.rows = self.rows, []
+
+        return rows
+
+    def close(self):
+
+        if self.cursor is not None:
+            self.cursor.close()
+
+class FixtureConnection(object):
+    """DB-API connection whose queries are recorded or replayed.
+    :param: The connection recorded, None when replaying
+    :param: The address of the database (string)
+    """
+
+    def __init__(self, conn, address):
+
+        self.conn = conn
+        self.address = address
+
+    def cursor(self):
+
+        return FixtureCursor(self)
+
+    def close(self):
+
+        if self.conn is not None:
+            self.conn.close()
+
+def connect(connect, address):
+    """Open a connection with connect(address), through the fixtures when recording or replaying. """
+
+    if _mode == REPLAY:
+        return FixtureConnection(None, address)
+
+    if _mode == RECORD:
+        return FixtureConnection(connect(address), address)
+
+    return connect(address)
+
+class FixtureConnectionPool(object):
+    """Connection pool handing out FixtureConnection's.
+    :param: The pool of the recorded connections, None when replaying
+    :param: The address of the database (string)
+    """
+
+    def __init__(self, pool, address):
+
+        self.pool = pool
+        self.address = address
+
+    def getconn(self):
+
+        return FixtureConnection(self.pool.getconn() if self.pool is not None else None, self.address)
+
+    def putconn(self, conn):
+
+        if self.pool is not None:
+            self.pool.putconn(conn.conn)
+
+    def closeall(self):
+
+        if self.pool is not None:
+            self.pool.closeall()
+
+def connection_pool(pool_class, minconn, maxconn, address):
+    """Open a pool_class(minconn, maxconn, address) pool, through the fixtures when recording or replaying. """
+
+    if _mode == REPLAY:
+        return FixtureConnectionPool(None, address)
+
+    if _mode == RECORD:
+        return FixtureConnectionPool(pool_class(minconn, maxconn, address), address)
+
+    return pool_class(minconn, maxconn, address)
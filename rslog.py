@@ -0,0 +1,90 @@
+"""rslog.py
+Leveled console messages of the Run Selection checks.
+
+    quiet    errors only
+    summary  errors and the summary of the run list
+    verbose  errors, summary and the checks of every run (default)
+
+The messages of a run are recorded unformatted, and only formatted,
+timestamped and written when their level is enabled, a batch of runs at a
+time. Detail messages can be recorded as a function returning their texts,
+which is then only called when the verbose level is enabled.
+"""
+import sys
+import datetime
+
+QUIET = 0
+SUMMARY = 1
+VERBOSE = 2
+
+LEVELS = {'quiet': QUIET, 'summary': SUMMARY, 'verbose': VERBOSE}
+
+_level = VERBOSE
+
+def set_level(name):
+    """Set the level of the messages written (quiet, summary or verbose). """
+
+    global _level
+
+    _level = LEVELS[name]
+
+def enabled(level):
+
+    return level <= _level
+
+def timestamp():
+
+    return datetime.datetime.now().replace(microsecond = 0)
+
+def info(messages, text, *args):
+    """Record a verbose INFO message of a run: text % args. """
+
+    messages.append((VERBOSE, sys.stdout, "rscheck():INFO", text, args))
+
+def details(messages, function, *args):
+    """Record verbose INFO messages of a run, given by the list of texts of function(*args). """
+
+    messages.append((VERBOSE, sys.stdout, "rscheck():INFO", function, args))
+
+def error(messages, source, text, *args):
+    """Record an ERROR message of a run, written at every level. """
+
+    messages.append((QUIET, sys.stderr, "%s():ERROR" % source, text, args))
+
+def write(messages):
+    """Format and write the enabled recorded messages.
+    Consecutive messages to the same stream are written at once.
+    """
+
+    now = timestamp()
+
+    stream = None
+    lines = []
+
+    for level, target, source, text, args in messages:
+
+        if not enabled(level):
+            continue
+
+        if target is not stream:
+            if lines:
+                stream.write(''.join(lines))
+            stream = target
+            lines = []
+
+        if callable(text):
+            texts = text(*args)
+        else:
+            texts = [text % args if args else text]
+
+        for line in texts:
+            lines.append("%s - %s: %s\n" % (now, source, line))
+
+    if lines:
+        stream.write(''.join(lines))
+
+def summary(text, *args):
+    """Write a summary INFO message now. """
+
+    if enabled(SUMMARY):
+        sys.stdout.write("%s - rscheck():INFO: %s\n" % (timestamp(), text % args))
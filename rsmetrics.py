@@ -0,0 +1,132 @@
+"""rsmetrics.py
+Timing metrics of the stages of the Run Selection checks.
+
+Every timed call of a stage (a backend fetch, a batch of checks, a write)
+records its duration. The report gives, per stage, the number of calls,
+the total time and latency percentiles, as JSON or as a Prometheus
+textfile (node_exporter textfile collector format).
+"""
+import os
+import json
+import time
+import threading
+import functools
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+_lock = threading.Lock()
+
+# Stage name -> list of durations (seconds)
+_samples = {}
+
+def record(stage, seconds):
+    """Record the duration of a call of a stage. """
+
+    with _lock:
+        _samples.setdefault(stage, []).append(seconds)
+
+class timer(object):
+    """Context manager recording the duration of its block as a call of a stage. """
+
+    def __init__(self, stage):
+
+        self.stage = stage
+
+    def __enter__(self):
+
+        self.start = time.time()
+
+        return self
+
+    def __exit__(self, *exc):
+
+        record(self.stage, time.time() - self.start)
+
+def timed(stage):
+    """Decorator recording the duration of every call of a function as a call of a stage. """
+
+    def decorator(function):
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(stage, time.time() - start)
+
+        return wrapper
+
+    return decorator
+
+def reset():
+
+    with _lock:
+        _samples.clear()
+
+def _quantile(samples, q):
+    # Nearest rank of sorted samples
+    return samples[min(len(samples) - 1, max(0, int(q * len(samples) + 0.5) - 1))]
+
+def summary():
+    """Return a dictionary stage -> {count, total, mean, max, p50, p90, p99} (seconds). """
+
+    with _lock:
+        stages = dict((stage, sorted(samples)) for stage, samples in _samples.items())
+
+    report = {}
+
+    for stage, samples in stages.items():
+
+        report[stage] = {'count': len(samples), 'total': sum(samples),
+                         'mean': sum(samples) / len(samples), 'max': samples[-1]}
+
+        for q in QUANTILES:
+            report[stage]['p%g' % (q * 100)] = _quantile(samples, q)
+
+    return report
+
+def prometheus(report, prefix = "rscheck"):
+    """Format a summary() report as Prometheus text exposition. """
+
+    lines = ["# HELP %s_stage_seconds Duration of the calls of a stage of the checks" % prefix,
+             "# TYPE %s_stage_seconds summary" % prefix]
+
+    for stage in sorted(report):
+
+        values = report[stage]
+
+        for q in QUANTILES:
+            lines.append('%s_stage_seconds{stage="%s",quantile="%g"} %.6f'
+                         % (prefix, stage, q, values['p%g' % (q * 100)]))
+
+        lines.append('%s_stage_seconds_sum{stage="%s"} %.6f' % (prefix, stage, values['total']))
+        lines.append('%s_stage_seconds_count{stage="%s"} %i' % (prefix, stage, values['count']))
+
+    lines.append("# HELP %s_report_timestamp_seconds Time of the report" % prefix)
+    lines.append("# TYPE %s_report_timestamp_seconds gauge" % prefix)
+    lines.append("%s_report_timestamp_seconds %i" % (prefix, time.time()))
+
+    return "\n".join(lines) + "\n"
+
+def write_report(path, report_format = "json", extra = None):
+    """Write the report of the stages to a file, atomically.
+    :param: The path of the report (string)
+    :param: json or prometheus
+    :param: Other values added to the JSON report (dictionary, optional)
+    """
+
+    report = summary()
+
+    if report_format == "prometheus":
+        text = prometheus(report)
+    else:
+        document = {'stages': report}
+        document.update(extra or {})
+        text = json.dumps(document, indent = 2, sort_keys = True) + "\n"
+
+    reportfile = open(path + ".tmp", 'w')
+    reportfile.write(text)
+    reportfile.close()
+
+    os.rename(path + ".tmp", path)
@@ -0,0 +1,217 @@
+"""rsoutput.py
+Machine-readable copies of the run list, written in the same pass as the
+ASCII run list: one record per run with the fields of rstools.RECORD_FIELDS.
+
+    jsonl    one JSON object per line
+    csv      comma separated values with a header line
+    npz      numpy arrays, one per field
+    parquet  Apache Parquet table (needs pyarrow)
+
+The text formats are streamed. The records of the columnar formats are
+appended to a spool file of fixed-size binary records next to the output
+(<output>.part), and the columnar file is written from it once, at close().
+All of them can be resumed from the state returned by checkpoint().
+"""
+import os
+import csv
+import json
+import shutil
+from collections import OrderedDict
+
+import numpy as np
+
+import rstools
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = ['jsonl', 'csv', 'npz', 'parquet']
+
+# Field types: run numbers, and flags 0, 1 or 9
+RUN_DTYPE = np.int32
+FLAG_DTYPE = np.int8
+
+# Record of the spool files of the columnar formats
+RECORD_DTYPE = np.dtype([(field, RUN_DTYPE if field == 'run' else FLAG_DTYPE) for field in rstools.RECORD_FIELDS])
+
+def output_name(runlistname, output_format):
+    """Return the name of the output of a format of a run list. """
+
+    return os.path.splitext(runlistname)[0] + "." + output_format
+
+class _TextWriter(object):
+
+    def __init__(self, path, state = None):
+
+        self.path = path
+
+        if state is not None and os.path.exists(path):
+            # Drop anything written after the checkpoint
+            self.file = open(path, 'r+')
+            self.file.truncate(state)
+            self.file.seek(state)
+        else:
+            self.file = open(path, 'w')
+            self.write_header()
+
+    def write_header(self):
+
+        pass
+
+    def checkpoint(self):
+
+        self.file.flush()
+
+        return self.file.tell()
+
+    def close(self):
+
+        self.file.close()
+
+class JsonlWriter(_TextWriter):
+
+    def write(self, records):
+
+        self.file.write(''.join(json.dumps(OrderedDict(zip(rstools.RECORD_FIELDS, record))) + "\n"
+                                for record in records))
+
+class CsvWriter(_TextWriter):
+
+    def __init__(self, path, state = None):
+
+        _TextWriter.__init__(self, path, state)
+
+        self.csv = csv.writer(self.file, lineterminator = "\n")
+
+    def write_header(self):
+
+        self.file.write(','.join(rstools.RECORD_FIELDS) + "\n")
+
+    def write(self, records):
+
+        self.csv.writerows(records)
+
+class _ColumnarWriter(object):
+
+    def __init__(self, path, state = None):
+
+        self.path = path
+        self.spoolpath = path + ".part"
+
+        self.count = 0
+
+        if state is not None and os.path.exists(self.spoolpath):
+            # Drop the records written after the checkpoint
+            self.spool = open(self.spoolpath, 'r+b')
+            self.spool.truncate(state * RECORD_DTYPE.itemsize)
+            self.spool.seek(state * RECORD_DTYPE.itemsize)
+            self.count = state
+        else:
+            self.spool = open(self.spoolpath, 'wb')
+            if state is not None and os.path.exists(path):
+                # A closed output being extended: spool its records up to the checkpoint
+                self.write(self.read()[:state])
+
+    def write(self, records):
+
+        np.array([tuple(record) for record in records], dtype = RECORD_DTYPE).tofile(self.spool)
+
+        self.count += len(records)
+
+    def columns(self):
+
+        records = np.fromfile(self.spoolpath, dtype = RECORD_DTYPE)
+
+        return OrderedDict((field, records[field].copy()) for field in rstools.RECORD_FIELDS)
+
+    def checkpoint(self):
+
+        self.spool.flush()
+
+        return self.count
+
+    def close(self):
+
+        self.spool.close()
+
+        # Written to a temporary file first so the output is never half written
+        self.save(self.path + ".tmp")
+        os.rename(self.path + ".tmp", self.path)
+
+        os.remove(self.spoolpath)
+
+class NpzWriter(_ColumnarWriter):
+
+    def read(self):
+
+        stored = np.load(self.path)
+
+        return [tuple(int(value) for value in record)
+                for record in zip(*[stored[field] for field in rstools.RECORD_FIELDS])]
+
+    def save(self, path):
+
+        outputfile = open(path, 'wb')
+        np.savez(outputfile, **self.columns())
+        outputfile.close()
+
+class ParquetWriter(_ColumnarWriter):
+
+    def read(self):
+
+        table = pyarrow.parquet.read_table(self.path).to_pydict()
+
+        return list(zip(*[table[field] for field in rstools.RECORD_FIELDS]))
+
+    def save(self, path):
+
+        columns = self.columns()
+
+        table = pyarrow.Table.from_arrays([pyarrow.array(values) for values in columns.values()],
+                                          names = list(columns.keys()))
+
+        pyarrow.parquet.write_table(table, path)
+
+WRITERS = {'jsonl': JsonlWriter, 'csv': CsvWriter, 'npz': NpzWriter, 'parquet': ParquetWriter}
+
+def open_writers(runlistname, formats, states = None, source = None):
+    """Open the machine-readable outputs of a run list.
+    :param: The name of the run list (string)
+    :param: The formats to write (list of strings)
+    :param: The checkpoint() states of the outputs to resume, by format (optional)
+    :param: The name of another run list whose outputs are extended (optional)
+    :returns: A dictionary format -> writer
+    """
+
+    if 'parquet' in formats and pyarrow is None:
+        raise ImportError("the parquet output needs pyarrow")
+
+    writers = OrderedDict()
+
+    for output_format in formats:
+
+        path = output_name(runlistname, output_format)
+        state = (states or {}).get(output_format)
+
+        if source is not None and state is not None:
+            sourcepath = output_name(source, output_format)
+            if os.path.exists(sourcepath) and os.path.abspath(sourcepath) != os.path.abspath(path):
+                shutil.copyfile(sourcepath, path)
+
+        writers[output_format] = WRITERS[output_format](path, state)
+
+    return writers
+
+def load(path):
+    """Return the columns of an npz or parquet output: field -> numpy array. """
+
+    if path.endswith(".parquet"):
+        table = pyarrow.parquet.read_table(path)
+        return OrderedDict((field, table.column(field).to_numpy()) for field in table.column_names)
+
+    stored = np.load(path)
+
+    return OrderedDict((field, stored[field]) for field in rstools.RECORD_FIELDS)
@@ -0,0 +1,158 @@
+"""rspipeline.py
+Streaming pipeline for the Run Selection checks.
+
+The chunks of runs go through three stages connected by bounded queues:
+    fetch    - all the downloads of a chunk (RUN, DQLL, DQHL) run concurrently,
+               and up to <depth> chunks are prefetched ahead of the evaluation
+    evaluate - <jobs> threads perform the checks of the fetched chunks
+    write    - the caller gets the results back in chunk order
+At most depth + jobs chunks are in flight at any time, so the memory used
+does not grow with the number of runs. The downloads share a fixed number
+of threads per source, each holding its own connections, however deep the
+prefetch and however many jobs.
+
+When a download or an evaluation fails, or the caller stops reading the
+results, the stages are stopped and their threads joined before the error
+is raised again with the traceback of the worker that failed.
+"""
+import sys
+import threading
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Download threads per source (e.g. RATDB, CouchDB) of a fetch pool
+FETCH_THREADS = 2
+
+def _call(func, *args):
+    """Call func and return (True, result), or (False, sys.exc_info()) if it raised.
+    SystemExit is caught too: the tools exit on database errors, and it has
+    to reach the writer rather than silently end a worker thread.
+    """
+
+    try:
+        return True, func(*args)
+    except BaseException:
+        return False, sys.exc_info()
+
+# Raise an exception again with the traceback it was caught with
+if sys.version_info[0] < 3:
+    exec("def _reraise(type, value, traceback):\n"
+         "    raise type, value, traceback\n")
+else:
+    def _reraise(type, value, traceback):
+        raise value.with_traceback(traceback)
+
+def fetch_pool(fetchers):
+    """Return a ThreadPool for the downloads of fetchers, FETCH_THREADS per source.
+    It can be kept and passed to the next pipeline() calls, so its threads keep
+    their connections open.
+    :param: Dictionary name -> function(item), as for pipeline()
+    """
+
+    return ThreadPool(len(fetchers) * FETCH_THREADS)
+
+def pipeline(items, fetchers, evaluate, depth = 2, jobs = 1, fetchpool = None):
+    """Fetch and evaluate items concurrently, yielding the results in order.
+    :param: The work items, e.g. (firstrun, lastrun) chunks (list)
+    :param: Dictionary name -> function(item) downloading some data of an item
+    :param: Function(item, {name: data}) evaluating an item
+    :param: The number of items prefetched ahead of the evaluation
+    :param: The number of items evaluated concurrently
+    :param: fetch_pool() to download on, kept open after the call so its
+            threads keep their connections (optional, by default one per call)
+    :returns: A generator of the evaluate() results, in the order of items
+    """
+
+    depth = max(depth, 0)
+    jobs = max(jobs, 1)
+
+    # The slots bound the items in flight, so the queues need no bound
+    slots = threading.Semaphore(depth + jobs)
+    stop = threading.Event()
+
+    fetched = queue.Queue()
+    evaluated = queue.Queue()
+
+    ownpool = fetchpool is None
+
+    if ownpool:
+        fetchpool = fetch_pool(fetchers)
+
+    def fetch_stage():
+        for index, item in enumerate(items):
+            slots.acquire()
+            if stop.is_set():
+                break
+            pending = {}
+            for name, fetcher in fetchers.items():
+                pending[name] = fetchpool.apply_async(_call, (fetcher, item))
+            fetched.put((index, item, pending))
+        for job in range(jobs):
+            fetched.put(None)
+
+    def evaluate_stage():
+        while True:
+            work = fetched.get()
+            if work is None:
+                return
+            if stop.is_set():
+                # Stopped: drop the work left, the fetches finish on their own
+                continue
+            index, item, pending = work
+            data = {}
+            for name in pending:
+                ok, value = pending[name].get()
+                if not ok:
+                    evaluated.put((index, False, value))
+                    break
+                data[name] = value
+            else:
+                ok, value = _call(evaluate, item, data)
+                evaluated.put((index, ok, value))
+
+    threads = [threading.Thread(target = fetch_stage)]
+    threads += [threading.Thread(target = evaluate_stage) for job in range(jobs)]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Write stage: hand the results back in order
+    done = {}
+
+    try:
+
+        for index in range(len(items)):
+
+            while index not in done:
+                position, ok, value = evaluated.get()
+                done[position] = (ok, value)
+
+            ok, value = done.pop(index)
+
+            slots.release()
+
+            if not ok:
+                _reraise(*value)
+
+            yield value
+
+    finally:
+
+        # Stop the stages: wake the fetch stage if it waits for a slot, and
+        # end the evaluate stage threads once they have dropped the work left
+        stop.set()
+        slots.release()
+        for job in range(jobs):
+            fetched.put(None)
+
+        for thread in threads:
+            thread.join()
+
+        if ownpool:
+            fetchpool.close()
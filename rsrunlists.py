@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""rsrunlists.py
+Index of the rows of the run lists written by rschecks.py.
+
+The run list files are memory-mapped and their rows parsed by the column
+layout of rstools (ROW_OFFSETS). The index keeps, for every row of every
+run list, the run number, the file and the offset of the row, sorted by run
+number and saved to disk. Only new or modified run lists are scanned again
+when the index is updated, and a lookup only reads the rows of the run.
+
+Example use: 'python rsrunlists.py -r 100250 runlist_*.txt'
+"""
+import os
+import sys
+import mmap
+import glob
+import argparse
+
+import numpy as np
+
+import rstools
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".rsrunlists.npz")
+
+def _map(path):
+
+    runlist = open(path, 'rb')
+
+    try:
+        if os.fstat(runlist.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(runlist.fileno(), 0, access = mmap.ACCESS_READ)
+    finally:
+        runlist.close()
+
+def scan_runlist(path):
+    """Return the run numbers and offsets of the rows of a run list.
+    :returns: Two numpy arrays, run numbers and row offsets, in file order
+    """
+
+    mapped = _map(path)
+
+    if mapped is None:
+        return np.zeros(0, dtype = np.int32), np.zeros(0, dtype = np.int64)
+
+    data = np.frombuffer(mapped, dtype = np.uint8)
+
+    # Lines starting with a digit are run rows
+    starts = np.concatenate([[0], np.flatnonzero(data[:-1] == ord('\n')) + 1])
+    starts = starts[(data[starts] >= ord('0')) & (data[starts] <= ord('9'))]
+
+    runs = np.array([int(mapped[start:mapped.find(b' ', start)]) for start in starts], dtype = np.int32)
+
+    del data
+    mapped.close()
+
+    return runs, starts.astype(np.int64)
+
+def read_runlist(path):
+    """Return the records of all the rows of a run list at once.
+    :returns: A numpy array of records, one row per run, rstools.RECORD_FIELDS columns
+    """
+
+    mapped = _map(path)
+
+    if mapped is None:
+        return np.zeros((0, len(rstools.RECORD_FIELDS)), dtype = np.int32)
+
+    data = np.frombuffer(mapped, dtype = np.uint8)
+
+    runs, starts = scan_runlist(path)
+
+    # Position of each flag of each row: end of the run number + column offset
+    ends = starts + np.array([len(str(run)) for run in runs], dtype = np.int64)
+    flags = data[ends[:, None] + np.array(rstools.ROW_OFFSETS)].astype(np.int32) - ord('0')
+
+    records = np.concatenate([runs[:, None].astype(np.int32), flags], axis = 1)
+
+    del data
+    mapped.close()
+
+    return records
+
+class RunlistIndex(object):
+    """Persistent run number -> (run list, row offset) index.
+    :param: The path of the index file (string)
+    """
+
+    def __init__(self, path = DEFAULT_INDEX_PATH):
+
+        self.path = path
+
+        self.files = []
+        self.stats = np.zeros((0, 2), dtype = np.int64)
+        self.runs = np.zeros(0, dtype = np.int32)
+        self.fileids = np.zeros(0, dtype = np.int32)
+        self.offsets = np.zeros(0, dtype = np.int64)
+
+        if os.path.exists(path):
+            stored = np.load(path)
+            self.files = stored['files'].tolist()
+            self.stats = stored['stats']
+            self.runs = stored['runs']
+            self.fileids = stored['fileids']
+            self.offsets = stored['offsets']
+
+    def save(self):
+        """Write the index to its file, atomically. """
+
+        indexfile = open(self.path + ".tmp", 'wb')
+        np.savez(indexfile, files = np.array(self.files, dtype = str), stats = self.stats,
+                 runs = self.runs, fileids = self.fileids, offsets = self.offsets)
+        indexfile.close()
+
+        os.rename(self.path + ".tmp", self.path)
+
+    def update(self, paths):
+        """Index the rows of new and modified run lists, and drop the run lists that are gone.
+        :param: The paths of the run lists to add to the index (list of strings)
+        :returns: The number of run lists scanned
+        """
+
+        paths = set(os.path.abspath(path) for path in paths)
+        paths.update(path for path in self.files if os.path.exists(path))
+        paths = sorted(paths)
+
+        known = dict((name, i) for i, name in enumerate(self.files))
+
+        files = []
+        stats = []
+        runs = []
+        fileids = []
+        offsets = []
+
+        scanned = 0
+
+        for path in paths:
+
+            stat = os.stat(path)
+            fileid = len(files)
+
+            i = known.get(path)
+
+            if i is not None and tuple(self.stats[i]) == (stat.st_size, int(stat.st_mtime)):
+                # Unchanged run list: keep its rows
+                rows = self.fileids == i
+                fileruns, fileoffsets = self.runs[rows], self.offsets[rows]
+            else:
+                fileruns, fileoffsets = scan_runlist(path)
+                scanned += 1
+
+            files.append(path)
+            stats.append((stat.st_size, int(stat.st_mtime)))
+            runs.append(fileruns)
+            fileids.append(np.full(len(fileruns), fileid, dtype = np.int32))
+            offsets.append(fileoffsets)
+
+        runs = np.concatenate(runs) if runs else np.zeros(0, dtype = np.int32)
+        fileids = np.concatenate(fileids) if fileids else np.zeros(0, dtype = np.int32)
+        offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype = np.int64)
+
+        # Sorted by run number, then by run list modification time
+        mtimes = np.array([stat[1] for stat in stats], dtype = np.int64)
+        order = np.lexsort((offsets, mtimes[fileids] if len(fileids) else fileids, runs))
+
+        self.files = files
+        self.stats = np.array(stats, dtype = np.int64).reshape(len(stats), 2)
+        self.runs = runs[order]
+        self.fileids = fileids[order]
+        self.offsets = offsets[order]
+
+        return scanned
+
+    def _read(self, entries):
+
+        mapped = {}
+        rows = []
+
+        try:
+            for entry in entries:
+                fileid = int(self.fileids[entry])
+                if fileid not in mapped:
+                    mapped[fileid] = _map(self.files[fileid])
+                offset = int(self.offsets[entry])
+                end = mapped[fileid].find(b'\n', offset)
+                line = mapped[fileid][offset:end if end >= 0 else len(mapped[fileid])]
+                rows.append((self.files[fileid], rstools.parse_row(line)))
+        finally:
+            for runlist in mapped.values():
+                runlist.close()
+
+        return rows
+
+    def lookup(self, run):
+        """Return the (run list, record) of every row of a run, oldest run list first. """
+
+        first, last = np.searchsorted(self.runs, [run, run + 1])
+
+        return self._read(range(first, last))
+
+    def scan(self, firstrun, lastrun):
+        """Return the (run list, record) of every row of a range of runs, in run order. """
+
+        first, last = np.searchsorted(self.runs, [firstrun, lastrun + 1])
+
+        return self._read(range(first, last))
+
+def main():
+
+    parser = argparse.ArgumentParser(description = "Look up runs in the run lists")
+
+    parser.add_argument("runlists", nargs = "*", help = "Run lists to index (default: runlist_*.txt)")
+    parser.add_argument("-r", dest = "run", help = "Run number to look up", type = int, required = True)
+    parser.add_argument("-l", dest = "lastrun", help = "Last run number of a range to look up", type = int)
+    parser.add_argument("--index", dest = "index", help = "Index file", default = DEFAULT_INDEX_PATH)
+
+    args = parser.parse_args()
+
+    index = RunlistIndex(args.index)
+
+    index.update(args.runlists or glob.glob("runlist_*.txt"))
+    index.save()
+
+    for path, record in index.scan(args.run, args.lastrun if args.lastrun is not None else args.run):
+        sys.stdout.write("%s %s\n" % (os.path.basename(path),
+                                      " ".join("%s=%i" % field for field in zip(rstools.RECORD_FIELDS, record))))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,6 +5,8 @@ Tools to write the run selection run list
 Authors: Gersende Prior, Elisabeth Falk
         <gersende@lip.pt>, <E.Falk@sussex.ac.uk>
 """
+import os
+import json
 
 
 def write_header(file):
@@ -30,3 +32,101 @@ def write_header(file):
                "--------------------------" + \
                "------------------------------------------" + \
                "-----------------------------------------\n")
+
+# Fields of a run list record, in the order of the run list columns:
+DQLL_FIELDS = ['runtype', 'runduration', 'cratestatus', 'cratedac', 'cratealarmok']
+
+DQHL_FIELDS = ['trigger_proc_modif', 'time_proc_modif', 'run_proc_modif', 'pmt_proc_modif',
+               'trigger_proc', 'time_proc', 'run_proc', 'pmt_proc',
+               'n100l_trigger_rate', 'esumh_trigger_rate', 'missing_gtid',
+               'event_rate', 'event_separation', 'retriggers', 'run_header',
+               '10mhz_ut_comparison', 'clock_forward',
+               'run_type', 'mc_flag', 'trigger',
+               'general_coverage', 'crate_coverage', 'panel_coverage']
+
+RECORD_FIELDS = ['run'] + DQLL_FIELDS + DQHL_FIELDS
+
+# Column of each flag of a run list row, counted from the end of the run
+# number; the flags are single digits:
+ROW_OFFSETS = [12, 19, 26, 34, 42,
+               52, 53, 54, 55, 62, 63, 64, 65,
+               71, 77, 83,
+               91, 97, 104, 110, 117, 125,
+               133, 141, 147,
+               154, 161, 167]
+
+def parse_row(line):
+
+    # Return the record of a run list row, or None for the header and separator lines:
+    if not line[:1].isdigit():
+        return None
+
+    end = line.index(' ')
+
+    return tuple([int(line[:end])] + [int(line[end + offset]) for offset in ROW_OFFSETS])
+
+def checkpoint_name(runlistname):
+
+    # Checkpoint file kept next to the run list:
+    return runlistname + ".checkpoint"
+
+def _checkpoint_state(runlist, state):
+
+    # The state with the run list size, once the run list is written out:
+    runlist.flush()
+
+    state = dict(state)
+    state['offset'] = runlist.tell()
+
+    return state
+
+def write_checkpoint(runlist, state):
+
+    # Record the state after the last completed run and the run list
+    # size at that point, so an interrupted run list can be resumed:
+    state = _checkpoint_state(runlist, state)
+
+    name = checkpoint_name(runlist.name)
+
+    # Write to a temporary file first so the checkpoint is never half written:
+    checkpoint = open(name + ".tmp", 'w')
+    json.dump(state, checkpoint)
+    checkpoint.write("\n")
+    checkpoint.close()
+
+    os.rename(name + ".tmp", name)
+
+def open_checkpoint(runlist):
+
+    # Open the checkpoint written by write_checkpoint() to append the
+    # checkpoints of the next runs to it:
+    return open(checkpoint_name(runlist.name), 'a')
+
+def append_checkpoint(checkpoint, runlist, state):
+
+    # Same as write_checkpoint() but added as one line at the end of the
+    # checkpoint opened by open_checkpoint(), cheap enough to be done after
+    # every run; read_checkpoint() returns the last complete line:
+    checkpoint.write(json.dumps(_checkpoint_state(runlist, state)) + "\n")
+    checkpoint.flush()
+
+def read_checkpoint(runlistname):
+
+    # Return the state of the last checkpoint of a run list, or None:
+    name = checkpoint_name(runlistname)
+
+    if not os.path.exists(name):
+        return None
+
+    checkpoint = open(name)
+    lines = checkpoint.read().splitlines()
+    checkpoint.close()
+
+    # The last line can be cut short by an interruption
+    for line in reversed(lines):
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+
+    return None
@@ -0,0 +1,113 @@
+"""rstrace.py
+Optional tracing of the Run Selection checks.
+
+Once enabled, spans record the start and duration of each fetch, evaluation
+and write step, and of the per run steps, with attributes such as the run
+number, the table and the GTID counts of the run. They are written as a
+Chrome trace (chrome://tracing, https://ui.perfetto.dev). When tracing is
+not enabled, spans do nothing.
+"""
+import os
+import json
+import bisect
+import time
+import threading
+
+_enabled = False
+
+_lock = threading.Lock()
+
+_events = []
+
+def enable():
+    """Start recording spans. """
+
+    global _enabled
+
+    _enabled = True
+
+def enabled():
+
+    return _enabled
+
+class span(object):
+    """Context manager recording its block as a span.
+    :param: The name of the span (string)
+    :param: Attributes of the span (keyword arguments), more can be set in
+            the args dictionary of the span inside the block
+    """
+
+    def __init__(self, name, **args):
+
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+
+        if _enabled:
+            self.start = time.time()
+
+        return self
+
+    def __exit__(self, *exc):
+
+        if not _enabled:
+            return
+
+        event = {'name': self.name, 'cat': self.name.split('.')[0], 'ph': 'X',
+                 'ts': int(self.start * 1e6), 'dur': int((time.time() - self.start) * 1e6),
+                 'pid': os.getpid(), 'tid': threading.current_thread().ident, 'args': self.args}
+
+        with _lock:
+            _events.append(event)
+
+def slowest_runs(n):
+    """Return the n runs with the longest total time.
+    The total time of a run is the time of its own spans (spans with a run
+    attribute) plus an equal share, among the traced runs of the chunk, of
+    the time of the spans of its chunk of runs (spans with first and last
+    attributes: fetch, batch evaluation and write).
+    :returns: A list of (run, seconds, attributes of the spans of the run), slowest first
+    """
+
+    runs = {}
+    chunks = []
+
+    with _lock:
+        events = list(_events)
+
+    for event in events:
+
+        if 'run' in event['args']:
+
+            total, args = runs.setdefault(event['args']['run'], [0, {}])
+            runs[event['args']['run']][0] = total + event['dur']
+            args.update(event['args'])
+
+        elif 'first' in event['args'] and 'last' in event['args']:
+
+            chunks.append(event)
+
+    ordered = sorted(runs)
+
+    for event in chunks:
+
+        inchunk = ordered[bisect.bisect_left(ordered, event['args']['first']):
+                          bisect.bisect_right(ordered, event['args']['last'])]
+
+        for run in inchunk:
+            runs[run][0] += float(event['dur']) / len(inchunk)
+
+    slowest = sorted(runs.items(), key = lambda item: -item[1][0])[:n]
+
+    return [(run, total / 1e6, args) for run, (total, args) in slowest]
+
+def write_trace(path):
+    """Write the recorded spans to a Chrome trace file. """
+
+    with _lock:
+        events = list(_events)
+
+    tracefile = open(path, 'w')
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, tracefile)
+    tracefile.close()